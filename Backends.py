@@ -0,0 +1,213 @@
+import os
+import re
+from pathlib import Path
+
+from LabGuruUploader import ATTACHMENT_INDEX_PATH, LABGURU_URL, UPLOAD_STATUS_FILE, LabGuruUploader
+
+# Backend the analyses resolve collaboration paths and talk to LabGuru through: 'labguru' on the lab network (Foundry
+# and LabGuruAPI), 'local' for a local folder and a LabGuru stub server, 'dry-run' for a local folder sending nothing
+BACKENDS = ['labguru', 'local', 'dry-run']
+# Folder standing in for the collaboration paths of the local and dry-run backends
+LOCAL_ROOT = Path.home() / '.cache' / 'UricaseActivityAssay' / 'local'
+# LabGuru stub server of the local backend, see LabGuruStub.py
+LOCAL_LABGURU_URL = 'http://127.0.0.1:8765'
+# "{sample_vol}" in protocol element data, other braces such as those of json steps are left alone
+PLACEHOLDER = re.compile(r'\{(\w+)\}')
+
+_backend = None
+
+
+class LabGuruBackend:
+    """
+    The lab network: collaboration paths from Foundry, experiments and protocols from LabGuruAPI
+    """
+    name = 'labguru'
+    dry_run = False
+    # Ledger stage, run folder status file and attachment index of the uploads
+    upload_stage = 'upload'
+    status_file = UPLOAD_STATUS_FILE
+    attachment_index = ATTACHMENT_INDEX_PATH
+
+    def __init__(self, base_url=LABGURU_URL):
+        self.base_url = base_url
+
+    @staticmethod
+    def collaboration_path(expt_id):
+        from Foundry import get_collaboration_path
+        return Path(get_collaboration_path(expt_id))
+
+    @staticmethod
+    def token():
+        from LabGuruAPI import SESSION
+        SESSION.login()
+        return SESSION.token
+
+    @staticmethod
+    def experiment(expt_id):
+        from LabGuruAPI import Experiment
+        return Experiment.from_id(expt_id)
+
+    @staticmethod
+    def protocol(protocol_id):
+        from LabGuruAPI import Protocol
+        return Protocol.from_id(protocol_id)
+
+
+class LocalProtocolElement:
+    def __init__(self, data):
+        self.data = data
+
+    def format_data(self, **kwargs):
+        """
+        :param kwargs: values of the {placeholders} of the element data
+        :return: element data with the placeholders filled in, placeholders without a value are kept as they are
+        """
+        return PLACEHOLDER.sub(lambda match: str(kwargs.get(match.group(1), match.group(0))), self.data)
+
+
+class LocalProtocolSection:
+    def __init__(self, elements):
+        self.elements = [LocalProtocolElement(element.get('data', '')) for element in elements]
+
+
+class LocalProtocol:
+    def __init__(self, protocol_id, sections):
+        self.id = protocol_id
+        self.sections = [LocalProtocolSection(section.get('elements', [])) for section in sections]
+
+
+class LocalSection:
+    def __init__(self, client, section_id, name):
+        self.client = client
+        self.id = section_id
+        self.name = name
+
+    def add_text_element(self, data):
+        return self.client.add_element(self.id, 'text', data)
+
+    def add_steps_element(self, data):
+        return self.client.add_element(self.id, 'steps', data)
+
+
+class LocalExperiment:
+    def __init__(self, client, expt_id, uuid):
+        self.client = client
+        self.id = expt_id
+        self.uuid = uuid
+
+    def add_section(self, name, position):
+        """
+        :param name: section name
+        :param position: position of the section in the experiment, -1 for the end
+        :return: LocalSection
+        """
+        response, _ = self.client.request('POST', '/api/v1/sections', json={'token': self.client.token, 'item': {
+            'name': name, 'container_id': self.id, 'container_type': 'Projects::Experiment', 'position': position}})
+        return LocalSection(self.client, response['id'], name)
+
+
+class LocalBackend:
+    """
+    Stand-in for the lab network on any machine: collaboration paths are folders below a local root, and experiments,
+    sections, protocols and attachments go through the same LabGuru client as the uploads, to a LabGuru stub server.
+    In a dry run nothing is sent, every request is answered at once with a new id.
+    """
+
+    def __init__(self, root=LOCAL_ROOT, base_url=LOCAL_LABGURU_URL, dry_run=False, token='local'):
+        """
+        :param root: folder holding one collaboration folder per experiment
+        :param base_url: LabGuru stub server, ignored in a dry run
+        :param dry_run: if True, send nothing
+        :param token: API token sent to the stub server
+        """
+        self.root = Path(root)
+        self.dry_run = dry_run
+        self.base_url = None if dry_run else base_url
+        self._token = token
+        self._client = None
+        self.name = 'dry-run' if dry_run else 'local'
+        # A dry run records no upload, so a later upload still sends every file
+        self.upload_stage = None if dry_run else 'upload:local'
+        self.status_file = None if dry_run else 'LabGuruUpload.local.json'
+        # The stub forgets its attachments when it stops, so files are never linked to attachments of an earlier one
+        self.attachment_index = None
+
+    def collaboration_path(self, expt_id):
+        return self.root / 'Collaborations' / str(expt_id)
+
+    def token(self):
+        return self._token
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = LabGuruUploader(token=self._token, base_url=self.base_url or '', attachment_index=None,
+                                           dry_run=self.dry_run)
+        return self._client
+
+    def experiment(self, expt_id):
+        response, _ = self.client.request('GET', f'/api/v1/experiments/{expt_id}', params={'token': self._token})
+        return LocalExperiment(self.client, expt_id, response.get('uuid', f'{self.name}-experiment-{expt_id}'))
+
+    def protocol(self, protocol_id):
+        from LabGuruStub import DEFAULT_PROTOCOL
+        response, _ = self.client.request('GET', f'/api/v1/protocols/{protocol_id}', params={'token': self._token})
+        return LocalProtocol(protocol_id, response.get('sections') or
+                             [{'elements': [{'data': data} for data in DEFAULT_PROTOCOL]}])
+
+
+def get_backend():
+    """
+    :return: the backend set with set_backend, otherwise the one named by $UOX_BACKEND, the lab network by default
+    """
+    global _backend
+    if _backend is None:
+        name = os.environ.get('UOX_BACKEND', 'labguru')
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown backend {name}, expected one of {', '.join(BACKENDS)}")
+        if name == 'labguru':
+            _backend = LabGuruBackend()
+        else:
+            _backend = LocalBackend(os.environ.get('UOX_LOCAL_ROOT', LOCAL_ROOT),
+                                    os.environ.get('UOX_LABGURU_URL', LOCAL_LABGURU_URL), dry_run=name == 'dry-run')
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Use a backend for every following collaboration path, LabGuru section and upload of this process
+    :param backend: LabGuruBackend or LocalBackend, None to go back to $UOX_BACKEND
+    :return: the previous backend
+    """
+    global _backend
+    previous, _backend = _backend, backend
+    return previous
+
+
+def add_backend_arguments(parser):
+    """
+    Add the backend options to a command line parser
+    :param parser: argparse.ArgumentParser
+    :return:
+    """
+    parser.add_argument('--backend', choices=BACKENDS, default=None,
+                        help="where collaboration paths and LabGuru requests go (default: $UOX_BACKEND or labguru)")
+    parser.add_argument('--dry-run', action='store_const', const='dry-run', dest='backend',
+                        help="write run folders locally and send nothing to LabGuru, same as --backend dry-run")
+    parser.add_argument('--labguru-url', default=None, help="LabGuru stub server of the local backend")
+    parser.add_argument('--local-root', default=None, help="collaboration folder root of the local backends")
+
+
+def apply_backend_arguments(args):
+    """
+    Select the backend given on the command line. It is passed on through the environment, so worker processes use
+    it too.
+    :param args: parsed arguments of a parser with add_backend_arguments
+    :return: the selected backend
+    """
+    for key, value in [('UOX_BACKEND', args.backend), ('UOX_LABGURU_URL', args.labguru_url),
+                       ('UOX_LOCAL_ROOT', args.local_root)]:
+        if value is not None:
+            os.environ[key] = value
+    set_backend(None)
+    return get_backend()
@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import re
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import yaml
+
+from Backends import add_backend_arguments, apply_backend_arguments
+
+# Input files required by each kind of run, in the order the analysis functions take them
+RUN_FILES = {
+    'uox': ['yaml', 'background', 'kinetic', 'platemap'],
+    'pierce': ['yaml', 'pierce1', 'pierce2', 'platemap'],
+}
+# Reads of Pierce reader plates beyond the first two, e.g. pierce3, pierce4
+EXTRA_PIERCE = re.compile(r'^pierce([3-9]|[1-9]\d+)$')
+
+
+def read_manifest(manifest_path):
+    """
+    Read a yaml manifest listing the runs to analyse. Each entry gives the run type ('uox' or 'pierce') and the paths
+    of its input files, relative paths are resolved against the folder of the manifest:
+        - type: uox
+          yaml: 2024-09-05_12-34-53_Donphan.yaml
+          background: UoxBG_WCL-240905-005.asc
+          kinetic: UoxKinetic_WCL-240905-006.asc
+          platemap: platemap.xlsx
+        - type: pierce
+          yaml: 2024-10-16_11-36-09_Donphan.yaml
+          pierce1: PierceData-241017-001.asc
+          pierce2: PierceData-241017-002.asc
+          platemap: platemap.xlsx
+    Pierce runs of more than two reader plates list them as pierce3, pierce4, ..., and can give a yaml plate layout
+    (see PlateLayout.layout_from_dict) under layout.
+    :param manifest_path: file path of the yaml manifest
+    :return: list of run dictionaries with absolute file paths
+    """
+    manifest_path = Path(manifest_path)
+    with open(manifest_path, 'r') as stream:
+        entries = yaml.safe_load(stream) or []
+
+    runs = []
+    for i, entry in enumerate(entries):
+        run_type = entry.get('type', 'uox').lower()
+        if run_type not in RUN_FILES:
+            raise ValueError(f"Manifest entry {i} has unknown type '{run_type}'")
+        missing = [key for key in RUN_FILES[run_type] if key not in entry]
+        if missing:
+            raise ValueError(f"Manifest entry {i} is missing {', '.join(missing)}")
+        run = {'type': run_type, 'name': entry.get('name', Path(entry['yaml']).stem)}
+        keys = RUN_FILES[run_type] + [key for key in entry if run_type == 'pierce' and
+                                      (EXTRA_PIERCE.match(key) or key == 'layout')]
+        for key in keys:
+            run[key] = str((manifest_path.parent / entry[key]).resolve())
+        runs.append(run)
+    return runs
+
+
+def discover_runs(directory):
+    """
+    Find run folders below a directory. A folder is a run when it holds exactly one yaml log file and one xlsx plate
+    map, plus either a UoxBG_*.asc and a UoxKinetic_*.asc read (Uox run) or two or more PierceData-*.asc reads (Pierce
+    run, one per reader plate in file name order)
+    :param directory: root directory to search
+    :return: tuple of the list of run dictionaries and a list of (folder, reason) tuples for skipped folders
+    """
+    runs = []
+    skipped = []
+    for folder, _, filenames in sorted(os.walk(directory)):
+        folder = Path(folder)
+        yamls = sorted(name for name in filenames if name.lower().endswith('.yaml'))
+        if not yamls:
+            continue
+        platemaps = sorted(name for name in filenames if name.lower().endswith('.xlsx') and not name.startswith('~$'))
+        backgrounds = sorted(name for name in filenames if name.startswith('UoxBG') and name.endswith('.asc'))
+        kinetics = sorted(name for name in filenames if name.startswith('UoxKinetic') and name.endswith('.asc'))
+        pierces = sorted(name for name in filenames if name.startswith('PierceData') and name.endswith('.asc'))
+
+        if len(yamls) != 1 or len(platemaps) != 1:
+            skipped.append((str(folder), f"expected one yaml and one xlsx, found {len(yamls)} and {len(platemaps)}"))
+            continue
+        run = {'name': folder.name, 'yaml': str(folder / yamls[0]), 'platemap': str(folder / platemaps[0])}
+        if len(backgrounds) == 1 and len(kinetics) == 1:
+            run.update(type='uox', background=str(folder / backgrounds[0]), kinetic=str(folder / kinetics[0]))
+        elif len(pierces) >= 2:
+            run.update(type='pierce', **{f'pierce{i + 1}': str(folder / name) for i, name in enumerate(pierces)})
+        else:
+            skipped.append((str(folder), "no complete set of Uox or Pierce ascii reads"))
+            continue
+        runs.append(run)
+    return runs, skipped
+
+
+def run_job(run, output_dir=None, upload=False, results_store=None, curve_model=None, force=False, streaming=False):
+    """
+    Analyse a single run. Used as the process pool worker, so all failures are caught and reported in the result
+    :param run: run dictionary from read_manifest or discover_runs
+    :param output_dir: parent directory for the run folder, defaults to the experiment collaboration path
+    :param upload: if True, also create the LabGuru section and attachments
+    :param results_store: root directory of the columnar results dataset, defaults to the UOX_RESULTS_STORE variable
+    :param curve_model: standard curve model ('linear', 'quadratic' or '4pl') to re-quantify Pierce runs from the raw
+    A660, defaults to the Magellan concentrations
+    :param force: if True, redo every stage even if the run ledger has it up to date
+    :param streaming: if True, analyse Uox kinetic reads in a single bounded memory pass
+    :return: dictionary of the run name, status, output folder, stages ran or skipped, error message and elapsed seconds
+    """
+    start = time.perf_counter()
+    result = {'name': run['name'], 'type': run['type'], 'status': 'success', 'work_dir': None, 'stages': None,
+              'error': None}
+    try:
+        paths = [Path(run[key]) for key in RUN_FILES[run['type']]]
+        if run['type'] == 'uox':
+            import UoxActivityAnalysis as analysis
+            outputs = analysis.run_analysis(*paths, work_dir=output_dir,
+                                            results_store=results_store or analysis.STORE_DIR, force=force,
+                                            streaming=streaming)
+            if upload:
+                analysis.upload_to_labguru(outputs['yaml_dict'], *paths, outputs['summary_path'],
+                                           outputs['scatterplot_path'], force=force)
+        else:
+            import TecanPierceAnalysis as analysis
+            extra = [Path(run[key]) for key in sorted((key for key in run if EXTRA_PIERCE.match(key)),
+                                                      key=lambda key: int(key[6:]))]
+            outputs = analysis.run_analysis(*paths, work_dir=output_dir,
+                                            results_store=results_store or analysis.STORE_DIR, curve_model=curve_model,
+                                            layout=run.get('layout'), extra_pierce_filepaths=extra, force=force)
+            if upload:
+                analysis.upload_to_labguru(outputs['yaml_dict'], *paths, outputs['summary_path'],
+                                           extra_pierce_filepaths=extra, force=force)
+        result['work_dir'] = str(outputs['work_dir'])
+        result['stages'] = outputs['stages']
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f"{type(e).__name__}: {e}"
+        result['traceback'] = traceback.format_exc()
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def run_batch(runs, workers=None, output_dir=None, upload=False, results_store=None, curve_model=None, force=False,
+              streaming=False):
+    """
+    Analyse many runs in a process pool and print the outcome of each run as it finishes
+    :param runs: list of run dictionaries
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :param output_dir: parent directory for the run folders, defaults to each experiment's collaboration path
+    :param upload: if True, also create the LabGuru sections and attachments
+    :param results_store: root directory of the columnar results dataset, defaults to the UOX_RESULTS_STORE variable
+    :param curve_model: standard curve model to re-quantify Pierce runs from the raw A660
+    :param force: if True, redo every stage even if the run ledger has it up to date
+    :param streaming: if True, analyse Uox kinetic reads in a single bounded memory pass
+    :return: list of result dictionaries in completion order
+    """
+    results = []
+    if workers == 1:
+        for run in runs:
+            results.append(run_job(run, output_dir, upload, results_store, curve_model, force, streaming))
+            print_result(results[-1])
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_job, run, output_dir, upload, results_store, curve_model, force, streaming)
+                   for run in runs]
+        for future in as_completed(futures):
+            results.append(future.result())
+            print_result(results[-1])
+    return results
+
+
+def print_result(result):
+    if result['status'] == 'success' and result['stages'] and 'ran' not in result['stages'].values():
+        print(f"CURRENT {result['name']} ({result['seconds']}s) -> {result['work_dir']}")
+    elif result['status'] == 'success':
+        print(f"OK      {result['name']} ({result['seconds']}s) -> {result['work_dir']}")
+    else:
+        print(f"FAILED  {result['name']} ({result['seconds']}s): {result['error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless batch analysis of Uox activity and Pierce runs")
+    parser.add_argument('source', help="yaml manifest of runs, or a directory of run folders")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help="write run folders here instead of the experiment collaboration paths")
+    parser.add_argument('--upload', action='store_true', help="create LabGuru sections and upload attachments")
+    parser.add_argument('--results-store', default=None,
+                        help="append every run to this columnar results dataset (default: $UOX_RESULTS_STORE)")
+    parser.add_argument('--pierce-curve', choices=['linear', 'quadratic', '4pl'], default=None,
+                        help="fit Pierce standard curves to the raw A660 instead of using Magellan concentrations")
+    parser.add_argument('--force', action='store_true',
+                        help="redo every run even if the run ledger has it up to date with its inputs and code")
+    parser.add_argument('--streaming', action='store_true',
+                        help="analyse Uox kinetic reads in one bounded memory pass, for very long runs; the figures "
+                             "and workbook then hold evenly spaced frames of the run")
+    parser.add_argument('--report', default=None, help="write the per-run results to this json file")
+    add_backend_arguments(parser)
+    args = parser.parse_args(argv)
+    backend = apply_backend_arguments(args)
+
+    # Worker processes only ever save figures
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+    source = Path(args.source)
+    if source.is_dir():
+        runs, skipped = discover_runs(source)
+        for folder, reason in skipped:
+            print(f"SKIPPED {folder}: {reason}")
+    else:
+        runs = read_manifest(source)
+
+    print(f"Analysing {len(runs)} runs with {args.workers} workers on the {backend.name} backend")
+    results = run_batch(runs, workers=args.workers, output_dir=args.output_dir, upload=args.upload,
+                        results_store=args.results_store, curve_model=args.pierce_curve, force=args.force,
+                        streaming=args.streaming)
+    failed = [result for result in results if result['status'] != 'success']
+    print(f"{len(results) - len(failed)} succeeded, {len(failed)} failed")
+
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(results, file, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
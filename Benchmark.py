@@ -0,0 +1,358 @@
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import SyntheticData
+from RunLedger import code_version
+
+# Default scales, 10000 cycles can be added on the command line but plots of that many points take minutes
+DEFAULT_WELLS = (96, 384)
+DEFAULT_CYCLES = (10, 100, 1000)
+# Seconds the LabGuru stub takes to answer each request, and the concurrent uploads tried against each latency
+DEFAULT_UPLOAD_LATENCIES = (0.05, 0.2)
+DEFAULT_UPLOAD_WORKERS = (1, 4, 8)
+# Last source plate well of the default Pierce layout of a number of reader plates: a 96 well plate, the first row band
+# of a 384 well plate and all of it
+PIERCE_LAST_WELLS = {2: 'H12', 4: 'H24', 8: 'P24'}
+# Modules whose source identifies the version of the code being benchmarked
+BENCHMARK_MODULES = ['UoxActivityAnalysis', 'TecanAscii', 'PlateGeometry', 'PlateMap', 'PlateLayout', 'KineticFits',
+                     'KineticStream', 'PlateQC', 'PlateRun', 'PlotRendering', 'PierceStandardCurve', 'LabGuruUploader',
+                     'Backends']
+# Modules a headless analysis worker imports, and the dependencies they may only load once they are used
+STARTUP_MODULES = ['UoxActivityAnalysis', 'TecanPierceAnalysis', 'BatchAnalysis', 'WatchFolder']
+LAZY_MODULES = ['tkinter', 'matplotlib', 'requests', 'Foundry', 'LabGuruAPI', 'AWSHelper']
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+try:
+    # VmHWM starts afresh in the new interpreter, unlike ru_maxrss which carries over the parent's peak
+    with open('/proc/self/status') as file:
+        peak = next(int(line.split()[1]) * 1024 for line in file if line.startswith('VmHWM'))
+except (OSError, StopIteration):
+    peak = 0
+print(json.dumps({{'seconds': seconds, 'peak_bytes': peak, 'eager': [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(function, *args, repeat=3):
+    """
+    Time a stage, then run it once more under tracemalloc for its peak memory. Timings are taken without tracing.
+    :param function: stage function
+    :param args: arguments of the stage function
+    :param repeat: number of timed runs
+    :return: tuple of the result of the last run and a dictionary of the best and median seconds and the peak bytes
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {'seconds': min(seconds), 'median_seconds': statistics.median(seconds), 'peak_bytes': peak}
+
+
+def benchmark_uox(run, work_dir, repeat=3):
+    """
+    Benchmark every stage of the Uox activity analysis of one run
+    :param run: run dictionary from SyntheticData.uox_run
+    :param work_dir: directory for the figures and summary workbook
+    :param repeat: number of timed runs per stage
+    :return: list of dictionaries of the stage name and its measurements
+    """
+    import UoxActivityAnalysis as analysis
+    from KineticFits import fit_reads
+    from PlateQC import uox_run_qc
+
+    records = []
+
+    def stage(name, function, *args):
+        result, measurement = measure(function, *args, repeat=repeat)
+        records.append({'stage': name, **measurement})
+        return result
+
+    date_time, expt_id = 'benchmark', '0000'
+    bg_df = stage('read_ascii_background', analysis.read_ascii, run['background'])
+    kinetic_df = stage('read_ascii_kinetic', analysis.read_ascii, run['kinetic'])
+    transformed = stage('remove_background', analysis.remove_background, bg_df, kinetic_df)
+    samples = stage('map_sample_names', analysis.map_sample_names, transformed, run['platemap'])
+    # standardize_data works in place, every run gets a fresh copy
+    standardized = stage('standardize_data', lambda: analysis.standardize_data(samples.copy()))
+    wells = analysis.standardize_data(transformed.copy())
+    plate_run = stage('plate_run', analysis.build_plate_run, bg_df, kinetic_df, run['platemap'])
+    well_fits = stage('fit_kinetics_wells', fit_reads, plate_run.relative_time, plate_run.background_subtracted,
+                      plate_run.well_names)
+    sample_fits = stage('fit_kinetics_samples', fit_reads, plate_run.relative_time, plate_run.sample_absolute,
+                        plate_run.labels)
+    stage('stream_data', analysis.stream_data, run['background'], run['kinetic'], run['platemap'])
+    qc = stage('plate_qc', uox_run_qc, plate_run)
+    stage('plate_run_save', plate_run.save, Path(work_dir) / 'run.platerun')
+    stage('scatterplot_wellnames_relative_abs', analysis.scatterplot_wellnames_relative_abs, wells, date_time,
+          expt_id, work_dir)
+    stage('scatterplot_samplenames_relative_abs', analysis.scatterplot_samplenames_relative_abs, standardized,
+          date_time, expt_id, work_dir)
+    stage('final_percentage_consumed', analysis.final_percentage_consumed, standardized, date_time, expt_id, work_dir)
+    stage('final_overall_uric_acid', analysis.final_overall_uric_acid, samples, date_time, expt_id, work_dir)
+    stage('excel_export', analysis.write_summary, Path(work_dir) / 'summary.xlsx', bg_df, plate_run, sample_fits,
+          well_fits, qc)
+    return records
+
+
+def benchmark_pierce(run, repeat=3):
+    """
+    Benchmark reading the Pierce plates and remapping them onto the source plate
+    :param run: run dictionary from SyntheticData.pierce_run
+    :param repeat: number of timed runs per stage
+    :return: list of dictionaries of the stage name and its measurements
+    """
+    from TecanAscii import read_ascii
+    from PlateLayout import apply_layout, compile_layout, pierce_layout
+
+    paths = [run[key] for key in sorted((key for key in run if key.startswith('pierce') and key[6:].isdigit()),
+                                        key=lambda key: int(key[6:]))]
+    records = []
+    dfs, measurement = measure(lambda: [read_ascii(path, calculated=True) for path in paths], repeat=repeat)
+    records.append({'stage': 'read_ascii_pierce', **measurement})
+    layout = pierce_layout(len(paths))
+    well_names = [col for col in dfs[0].columns if col not in ['Relative Time', 'Temperature']]
+    last_well = PIERCE_LAST_WELLS.get(len(paths))
+    source_wells = compile_layout(layout, well_names).source_wells
+    if last_well and source_wells[-1] != last_well:
+        raise AssertionError(f"{len(paths)} Pierce plates end at source well {source_wells[-1]}, not {last_well}")
+    plate_values = [df.loc[1, well_names].to_numpy(dtype=float) for df in dfs]
+    _, measurement = measure(lambda: apply_layout(compile_layout(layout, well_names), plate_values, 2.0), repeat=repeat)
+    records.append({'stage': 'pierce_remapping', **measurement})
+    return records
+
+
+def benchmark_upload(run, work_dir, latencies=DEFAULT_UPLOAD_LATENCIES, workers=DEFAULT_UPLOAD_WORKERS, error_rate=0.0,
+                     repeat=3):
+    """
+    Benchmark creating the LabGuru section of an analysed Uox run, formatting its protocol, and uploading its
+    attachments, against a local LabGuru stub server answering every request after a simulated latency
+    :param run: run dictionary from SyntheticData.uox_run
+    :param work_dir: directory for the run folder
+    :param latencies: seconds the stub takes to answer each request
+    :param workers: numbers of files uploaded at the same time
+    :param error_rate: fraction of requests the stub answers with a retryable error
+    :param repeat: number of timed runs per stage
+    :return: list of dictionaries of the case, stage name and measurements
+    """
+    import UoxActivityAnalysis as analysis
+    from Backends import LocalBackend, set_backend
+    from LabGuruStub import running
+
+    results = analysis.run_analysis(run['yaml'], run['background'], run['kinetic'], run['platemap'], work_dir=work_dir,
+                                    results_store=None, ledger=None, stage_cache=None)
+    records = []
+    for latency in latencies:
+        with running(latency=latency, error_rate=error_rate, seed=0) as stub:
+            backend = LocalBackend(Path(work_dir) / 'local', stub.url)
+            status_path = Path(results['summary_path']).parent / backend.status_file
+            previous = set_backend(backend)
+            try:
+                _, measurement = measure(analysis.create_labguru_section, results['yaml_dict'], repeat=repeat)
+                records.append({'case': {'kind': 'upload', 'latency': latency}, 'stage': 'create_labguru_section',
+                                **measurement})
+                for n_workers in workers:
+                    def upload():
+                        # Every upload starts afresh in a new section, without the per file report
+                        status_path.unlink(missing_ok=True)
+                        with redirect_stdout(io.StringIO()):
+                            return analysis.upload_to_labguru(
+                                results['yaml_dict'], run['yaml'], run['background'], run['kinetic'], run['platemap'],
+                                results['summary_path'], results['scatterplot_path'], max_workers=n_workers,
+                                ledger=None)
+
+                    _, measurement = measure(upload, repeat=repeat)
+                    records.append({'case': {'kind': 'upload', 'latency': latency, 'workers': n_workers},
+                                    'stage': 'upload_to_labguru', **measurement})
+            finally:
+                set_backend(previous)
+    return records
+
+
+def benchmark_startup(modules=STARTUP_MODULES, repeat=3):
+    """
+    Time the cold import of every analysis module in a fresh interpreter, as paid by every new worker process, and
+    list the lazily loaded dependencies it imported anyway
+    :param modules: module names
+    :param repeat: number of fresh interpreters per module
+    :return: list of dictionaries of the module and its measurements
+    """
+    records = []
+    for module in modules:
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT.format(module=module, lazy=LAZY_MODULES)],
+                                    capture_output=True, text=True, cwd=Path(__file__).parent, check=True).stdout
+            runs.append({**json.loads(output), 'process_seconds': time.perf_counter() - start})
+        seconds = [run['seconds'] for run in runs]
+        records.append({'module': module, 'seconds': min(seconds), 'median_seconds': statistics.median(seconds),
+                        'process_seconds': min(run['process_seconds'] for run in runs),
+                        'peak_bytes': max(run['peak_bytes'] for run in runs), 'eager': runs[-1]['eager']})
+    return records
+
+
+def environment():
+    """
+    :return: dictionary describing the code version and the machine, stored with every benchmark
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'code_version': code_version(BENCHMARK_MODULES),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def run_benchmarks(wells=DEFAULT_WELLS, cycles=DEFAULT_CYCLES, pierce_plates=(2, 4), repeat=3, seed=0,
+                   startup_modules=STARTUP_MODULES, upload_latencies=DEFAULT_UPLOAD_LATENCIES,
+                   upload_workers=DEFAULT_UPLOAD_WORKERS, upload_error_rate=0.0):
+    """
+    Generate synthetic runs at every scale and benchmark the analysis stages on them, after the cold start imports
+    :param wells: plate sizes of the Uox runs
+    :param cycles: kinetic cycle counts of the Uox runs
+    :param pierce_plates: reader plate counts of the Pierce runs
+    :param repeat: number of timed runs per stage
+    :param seed: random seed of the synthetic runs
+    :param startup_modules: modules whose cold import is timed
+    :param upload_latencies: seconds the LabGuru stub takes to answer each request, empty to skip the uploads
+    :param upload_workers: numbers of files uploaded at the same time
+    :param upload_error_rate: fraction of requests the LabGuru stub answers with a retryable error
+    :return: dictionary of the environment and a list of result dictionaries, one per case and stage
+    """
+    results = []
+    for record in benchmark_startup(startup_modules, repeat):
+        results.append({'case': {'kind': 'startup', 'module': record.pop('module')}, 'stage': 'import', **record})
+        print_record(results[-1])
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for n_wells in wells:
+            for n_cycles in cycles:
+                case = {'kind': 'uox', 'wells': n_wells, 'cycles': n_cycles}
+                run = SyntheticData.uox_run(tmp / f'uox_{n_wells}_{n_cycles}', n_wells, n_cycles, seed=seed)
+                for record in benchmark_uox(run, tmp / f'uox_{n_wells}_{n_cycles}', repeat):
+                    results.append({'case': case, **record})
+                    print_record(results[-1])
+        for n_plates in pierce_plates:
+            case = {'kind': 'pierce', 'plates': n_plates}
+            run = SyntheticData.pierce_run(tmp / f'pierce_{n_plates}', n_plates, seed=seed)
+            for record in benchmark_pierce(run, repeat):
+                results.append({'case': case, **record})
+                print_record(results[-1])
+        if upload_latencies:
+            run = SyntheticData.uox_run(tmp / 'upload', seed=seed)
+            for record in benchmark_upload(run, tmp / 'upload', upload_latencies, upload_workers, upload_error_rate,
+                                           repeat):
+                results.append(record)
+                print_record(results[-1])
+    return {'environment': environment(), 'results': results}
+
+
+def _case_name(case):
+    return ' '.join(f'{key}={value}' for key, value in case.items())
+
+
+def print_record(record):
+    print(f"{_case_name(record['case']):<36} {record['stage']:<40} {record['seconds'] * 1000:>10.1f} ms "
+          f"{record['peak_bytes'] / 2 ** 20:>9.1f} MiB")
+
+
+def compare(current, baseline, threshold=1.25):
+    """
+    Compare a benchmark against a baseline benchmark, matching results by case and stage
+    :param current: benchmark dictionary from run_benchmarks
+    :param baseline: benchmark dictionary of the baseline
+    :param threshold: ratio of the best times above which a stage counts as a regression
+    :return: list of (case, stage, baseline seconds, current seconds, ratio) of the regressed stages
+    """
+    baseline_seconds = {(_case_name(r['case']), r['stage']): r['seconds'] for r in baseline['results']}
+    regressions = []
+    for record in current['results']:
+        key = (_case_name(record['case']), record['stage'])
+        if key in baseline_seconds and baseline_seconds[key] > 0:
+            ratio = record['seconds'] / baseline_seconds[key]
+            if ratio > threshold:
+                regressions.append((*key, baseline_seconds[key], record['seconds'], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time and memory profile the analysis stages on synthetic runs")
+    parser.add_argument('-o', '--output', default='benchmark.json', help="write the results to this json file")
+    parser.add_argument('--wells', type=int, nargs='+', default=list(DEFAULT_WELLS), help="Uox plate sizes")
+    parser.add_argument('--cycles', type=int, nargs='+', default=list(DEFAULT_CYCLES), help="Uox kinetic cycles")
+    parser.add_argument('--pierce-plates', type=int, nargs='+', default=[2, 4], help="Pierce reader plate counts")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per stage, the best is reported")
+    parser.add_argument('--startup-only', action='store_true',
+                        help="only time the cold start imports, skip the synthetic runs")
+    parser.add_argument('--upload-latency', type=float, nargs='*', default=list(DEFAULT_UPLOAD_LATENCIES),
+                        help="seconds the LabGuru stub takes to answer each request, none to skip the uploads")
+    parser.add_argument('--upload-workers', type=int, nargs='+', default=list(DEFAULT_UPLOAD_WORKERS),
+                        help="numbers of files uploaded at the same time")
+    parser.add_argument('--upload-error-rate', type=float, default=0.0,
+                        help="fraction of requests the LabGuru stub answers with a retryable error")
+    parser.add_argument('--baseline', default=None, help="benchmark json of an earlier version to compare against")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="slowdown ratio against the baseline reported as a regression")
+    args = parser.parse_args(argv)
+
+    # Figures are only ever saved
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    if args.startup_only:
+        benchmark = run_benchmarks((), (), (), args.repeat, upload_latencies=())
+    else:
+        benchmark = run_benchmarks(args.wells, args.cycles, args.pierce_plates, args.repeat,
+                                   upload_latencies=args.upload_latency, upload_workers=args.upload_workers,
+                                   upload_error_rate=args.upload_error_rate)
+    with open(args.output, 'w') as file:
+        json.dump(benchmark, file, indent=2)
+    print(f"Wrote {len(benchmark['results'])} results to {args.output}")
+
+    # A dependency imported at startup slows every worker, whether or not the run needs it
+    eager = [record for record in benchmark['results'] if record.get('eager')]
+    for record in eager:
+        print(f"EAGER IMPORT {record['case']['module']}: {', '.join(record['eager'])}")
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = compare(benchmark, json.load(file), args.threshold)
+        for case, stage, before, after, ratio in regressions:
+            print(f"REGRESSION {case} {stage}: {before * 1000:.1f} ms -> {after * 1000:.1f} ms ({ratio:.2f}x)")
+    return 1 if regressions or eager else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
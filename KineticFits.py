@@ -0,0 +1,237 @@
+import numpy as np
+import pandas as pd
+
+# Number of kinetic frames used for the initial velocity
+INITIAL_POINTS = 3
+# Shortest window, and the R² a window must keep, for the automatic linear range
+MIN_LINEAR_POINTS = 3
+LINEAR_R2 = 0.98
+
+
+def _running_sums(t, y, start=None):
+    """
+    Cumulative sums over the frame axis of the terms of a least squares line fit of every well. NaN reads are left out
+    of the sums of their well.
+    :param t: float array of frame times (frames,)
+    :param y: float array of reads (frames x wells)
+    :param start: list of the sums (wells,) of earlier frames to continue from, None to start from the first frame
+    :return: list of (frames x wells) arrays: n, sum t, sum y, sum t², sum ty and sum y²
+    """
+    mask = ~np.isnan(y)
+    y = np.where(mask, y, 0.0)
+    t = np.where(mask, t[:, None], 0.0)
+
+    sums = [np.cumsum(mask, axis=0), np.cumsum(t, axis=0), np.cumsum(y, axis=0), np.cumsum(t * t, axis=0),
+            np.cumsum(t * y, axis=0), np.cumsum(y * y, axis=0)]
+    if start is not None:
+        sums = [total + before for total, before in zip(sums, start)]
+    return sums
+
+
+def _regression(n, s_t, s_y, s_tt, s_ty, s_yy):
+    """
+    Least squares line fits from the sums of _running_sums
+    :return: tuple of arrays shaped like the sums: slope, intercept and r2
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var_t = n * s_tt - s_t ** 2
+        var_y = n * s_yy - s_y ** 2
+        cov = n * s_ty - s_t * s_y
+        slope = cov / var_t
+        intercept = (s_y - slope * s_t) / n
+        r2 = cov ** 2 / (var_t * var_y)
+    # Fewer than two points do not define a line
+    slope = np.where(n < 2, np.nan, slope)
+    intercept = np.where(n < 2, np.nan, intercept)
+    r2 = np.where(n < 2, np.nan, r2)
+    return slope, intercept, r2
+
+
+def _prefix_regressions(t, y):
+    """
+    Least squares line fits of every prefix window (frames 0..L-1, for all L) of every well at once, from cumulative
+    sums over the frame axis. NaN reads are left out of the fit of their well.
+    :param t: float array of frame times (frames,)
+    :param y: float array of reads (frames x wells)
+    :return: tuple of (frames x wells) arrays: slope, intercept, r2 and number of points of each prefix window
+    """
+    n, *sums = _running_sums(t, y)
+    slope, intercept, r2 = _regression(n, *sums)
+    return slope, intercept, r2, n
+
+
+def _log_reads(y):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(y > 0, np.log(y), np.nan)
+
+
+def initial_velocity(t, y, n_points=INITIAL_POINTS):
+    """
+    Slope of the first frames of every well
+    :param t: float array of frame times (frames,)
+    :param y: float array of reads (frames x wells)
+    :param n_points: number of frames to fit
+    :return: float array of slopes (wells,)
+    """
+    n_points = min(n_points, y.shape[0])
+    slope, _, _, _ = _prefix_regressions(t[:n_points], y[:n_points])
+    return slope[-1]
+
+
+def linear_range_slope(t, y, min_points=MIN_LINEAR_POINTS, r2_threshold=LINEAR_R2):
+    """
+    Slope of the linear range of every well. The window always starts at the first frame and is extended for as long
+    as the fit keeps an R² of at least r2_threshold; wells that never reach it fall back to the shortest window.
+    :param t: float array of frame times (frames,)
+    :param y: float array of reads (frames x wells)
+    :param min_points: shortest window in frames
+    :param r2_threshold: minimum R² of the selected window
+    :return: tuple of float arrays (wells,): slope, R², number of frames and end time of the selected window
+    """
+    slope, _, r2, n = _prefix_regressions(t, y)
+    frames = np.arange(1, y.shape[0] + 1)[:, None]
+    valid = (frames >= min_points) & (r2 >= r2_threshold)
+    # Index of the longest valid window, counted from the end so argmax finds the last True
+    longest = y.shape[0] - 1 - np.argmax(valid[::-1], axis=0)
+    shortest = min(min_points, y.shape[0]) - 1
+    window = np.where(valid.any(axis=0), longest, shortest)
+
+    wells = np.arange(y.shape[1])
+    return slope[window, wells], r2[window, wells], n[window, wells], t[window]
+
+
+def first_order_rate(t, y):
+    """
+    First-order decay rate constant k of every well, from a line fit of ln(read) against time (read = A0·e^(-kt)).
+    Reads at or below zero are left out of the fit.
+    :param t: float array of frame times (frames,)
+    :param y: float array of reads (frames x wells)
+    :return: tuple of float arrays (wells,): rate constant k and R² of the log-linear fit
+    """
+    slope, _, r2, _ = _prefix_regressions(t, _log_reads(y))
+    return -slope[-1], r2[-1]
+
+
+def _fits_dataframe(names, initial, linear_slope, linear_r2, linear_points, linear_end, k, k_r2):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        half_life = np.log(2) / k
+    return pd.DataFrame({
+        'Initial Velocity (A292/min)': initial,
+        'Linear Slope (A292/min)': linear_slope,
+        'Linear R2': linear_r2,
+        'Linear Points': linear_points,
+        'Linear Window (min)': linear_end,
+        'First Order k (1/min)': k,
+        'First Order R2': k_r2,
+        'Half Life (min)': half_life,
+    }, index=pd.Index(names, name='Name'))
+
+
+def fit_kinetics(df):
+    """
+    Fit the initial velocity, the automatically selected linear range slope and the first-order decay rate of every
+    column of a background subtracted kinetic dataframe
+    :param df: pandas dataframe with a 'Relative Time' column in seconds and one column of reads per well or sample
+    :return: pandas dataframe of the fitted metrics with one row per well or sample, rates per minute
+    """
+    headers_to_exclude = ['Relative Time', 'Temperature']
+    headers_to_include = [col for col in df.columns if col not in headers_to_exclude]
+    return fit_reads(df['Relative Time'].to_numpy(dtype=np.float64),
+                     df.loc[:, headers_to_include].to_numpy(dtype=np.float64), headers_to_include)
+
+
+def fit_reads(relative_time, values, names):
+    """
+    Fit the metrics of fit_kinetics on frame arrays, e.g. the background subtracted views of a PlateRun
+    :param relative_time: float array of the relative time of each frame in seconds
+    :param values: float array of background subtracted reads (frames x wells or samples)
+    :param names: list of the well or sample names of the columns of values
+    :return: pandas dataframe of the fitted metrics with one row per well or sample, rates per minute
+    """
+    t = np.asarray(relative_time, dtype=np.float64) / 60
+    y = np.asarray(values, dtype=np.float64)
+
+    k, k_r2 = first_order_rate(t, y)
+    return _fits_dataframe(names, initial_velocity(t, y), *linear_range_slope(t, y), k, k_r2)
+
+
+class KineticAccumulator:
+    """
+    The fits of fit_kinetics built up block by block from a stream of frames. Running sums carry the prefix windows
+    from one block to the next, and the longest linear window of every well is tracked as the frames arrive, so the
+    memory used does not grow with the number of frames.
+    """
+
+    def __init__(self, names, n_points=INITIAL_POINTS, min_points=MIN_LINEAR_POINTS, r2_threshold=LINEAR_R2):
+        """
+        :param names: list of the well or sample names of the columns of every block
+        :param n_points: number of frames used for the initial velocity
+        :param min_points: shortest linear range window in frames
+        :param r2_threshold: minimum R² of the linear range window
+        """
+        self.names = list(names)
+        self.n_points = n_points
+        self.min_points = min_points
+        self.r2_threshold = r2_threshold
+        self.n_frames = 0
+        self.sums = None
+        self.log_sums = None
+        n_wells = len(self.names)
+        # (slope, r2, points, end time) of the initial, shortest, longest valid and whole run window of every well
+        self.initial = None
+        self.shortest = None
+        self.longest = (np.full(n_wells, np.nan), np.full(n_wells, np.nan), np.zeros(n_wells, dtype=np.int64),
+                        np.full(n_wells, np.nan))
+        self.found = np.zeros(n_wells, dtype=bool)
+        self.last = None
+
+    def update(self, relative_time, y):
+        """
+        Add a block of frames to the fits
+        :param relative_time: float array of the relative time of each frame in seconds (frames,)
+        :param y: float array of background subtracted reads (frames x wells)
+        :return:
+        """
+        if not len(relative_time):
+            return
+        t = np.asarray(relative_time, dtype=np.float64) / 60
+        n, *sums = _running_sums(t, y, self.sums)
+        slope, _, r2 = _regression(n, *sums)
+        frames = self.n_frames + np.arange(1, len(t) + 1)
+
+        def window(row):
+            return slope[row], r2[row], n[row], np.full(y.shape[1], t[row])
+
+        if self.initial is None and frames[-1] >= self.n_points:
+            self.initial = window(self.n_points - 1 - self.n_frames)[0]
+        if self.shortest is None and frames[-1] >= self.min_points:
+            self.shortest = window(self.min_points - 1 - self.n_frames)
+        valid = (frames[:, None] >= self.min_points) & (r2 >= self.r2_threshold)
+        found = valid.any(axis=0)
+        # Last valid window of the block, counted from the end so argmax finds the last True
+        rows = len(t) - 1 - np.argmax(valid[::-1], axis=0)
+        wells = np.arange(y.shape[1])
+        for longest, block in zip(self.longest, (slope, r2, n, np.broadcast_to(t[:, None], slope.shape))):
+            longest[found] = block[rows, wells][found]
+        self.found |= found
+        self.last = window(-1)
+        self.sums = [total[-1] for total in (n, *sums)]
+        log_n, *log_sums = _running_sums(t, _log_reads(y), self.log_sums)
+        self.log_sums = [total[-1] for total in (log_n, *log_sums)]
+        self.n_frames = int(frames[-1])
+
+    def result(self):
+        """
+        :return: pandas dataframe of the fitted metrics with one row per well or sample, as returned by fit_kinetics
+        """
+        n_wells = len(self.names)
+        if self.last is None:
+            empty = np.full(n_wells, np.nan)
+            return _fits_dataframe(self.names, empty, empty, empty, np.zeros(n_wells, dtype=np.int64), empty, empty,
+                                   empty)
+        # Runs shorter than the windows fall back to all of their frames, as the batch fits do
+        initial = self.last[0] if self.initial is None else self.initial
+        shortest = self.last if self.shortest is None else self.shortest
+        linear = [np.where(self.found, longest, fallback) for longest, fallback in zip(self.longest, shortest)]
+        log_slope, _, log_r2 = _regression(*self.log_sums)
+        return _fits_dataframe(self.names, initial, *linear, -log_slope, log_r2)
@@ -0,0 +1,173 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from KineticFits import KineticAccumulator
+from PlateGeometry import infer_geometry
+from PlateMap import average_replicates
+
+# Frames of a streamed run kept for the figures and the summary workbook, evenly spaced over the whole run
+PLOT_FRAMES = int(os.environ.get('UOX_PLOT_FRAMES', 2000))
+
+
+def background_columns(kinetic_wells, bg_wells):
+    """
+    Match the background well of every kinetic well by plate well index
+    :param kinetic_wells: list of the well names of the kinetic read
+    :param bg_wells: list of the well names of the background read
+    :return: integer array of the background read column of every kinetic read column
+    """
+    geometry = infer_geometry(kinetic_wells + bg_wells)
+    bg_position = np.full(geometry.n_wells, -1, dtype=np.intp)
+    bg_position[geometry.parse(bg_wells)] = np.arange(len(bg_wells))
+    kinetic_index = geometry.parse(kinetic_wells)
+    columns = np.where(kinetic_index >= 0, bg_position[np.maximum(kinetic_index, 0)], -1)
+    if (columns < 0).any():
+        missing = [well for well, col in zip(kinetic_wells, columns) if col < 0]
+        raise ValueError(f"Background read has no value for wells {', '.join(missing[:5])}")
+    return columns
+
+
+class FrameBuffer:
+    """
+    Fixed size buffer of the frames of a run. Frames are kept at a stride: once the buffer is full every other frame
+    is dropped and the stride doubles, so it always holds evenly spaced frames of the whole run starting at the first.
+    The latest frame is kept apart so the final reads are never dropped.
+    """
+
+    def __init__(self, n_columns, max_frames=PLOT_FRAMES):
+        """
+        :param n_columns: number of wells of every frame
+        :param max_frames: number of frames kept, at least 2
+        """
+        max_frames = max(2, max_frames)
+        self.values = np.empty((max_frames, n_columns))
+        self.relative_time = np.empty(max_frames)
+        self.temperature = np.empty(max_frames)
+        self.size = 0
+        self.stride = 1
+        self.n_frames = 0
+        self.latest = None
+
+    def _halve(self):
+        kept = (self.size + 1) // 2
+        for array in (self.values, self.relative_time, self.temperature):
+            array[:kept] = array[:self.size:2].copy()
+        self.size = kept
+        self.stride *= 2
+
+    def extend(self, values, relative_time, temperature):
+        """
+        Add a block of consecutive frames
+        :param values: float array of reads (frames x wells)
+        :param relative_time: float array of the relative time of each frame
+        :param temperature: float array of the temperature of each frame
+        :return:
+        """
+        n = len(relative_time)
+        if not n:
+            return
+        start = self.n_frames
+        self.n_frames += n
+        self.latest = (values[-1].copy(), relative_time[-1], temperature[-1])
+        offset = 0
+        while offset < n:
+            # Frames of the block on the current stride, counted over the whole run
+            selected = np.arange(offset + (-(start + offset)) % self.stride, n, self.stride)
+            room = len(self.relative_time) - self.size
+            taken = selected[:room]
+            self.values[self.size:self.size + len(taken)] = values[taken]
+            self.relative_time[self.size:self.size + len(taken)] = relative_time[taken]
+            self.temperature[self.size:self.size + len(taken)] = temperature[taken]
+            self.size += len(taken)
+            if len(selected) <= room:
+                break
+            self._halve()
+            offset = selected[room]
+
+    def frames(self):
+        """
+        :return: tuple of float arrays (values, relative_time, temperature) of the kept frames and the latest frame
+        """
+        values = self.values[:self.size]
+        relative_time = self.relative_time[:self.size]
+        temperature = self.temperature[:self.size]
+        if self.latest is not None and (self.n_frames - 1) % self.stride:
+            latest_values, latest_time, latest_temperature = self.latest
+            values = np.vstack([values, latest_values])
+            relative_time = np.append(relative_time, latest_time)
+            temperature = np.append(temperature, latest_temperature)
+        return values.copy(), relative_time.copy(), temperature.copy()
+
+
+class KineticStream:
+    """
+    Single pass analysis of a kinetic read, fed blocks of frames as they are parsed. Every block is background
+    subtracted, standardized to the first kinetic frame and added to the running kinetic fits of the wells and of the
+    replicate averaged samples. Only a downsampled buffer of the frames is kept, so memory stays bounded however many
+    cycles the read has.
+    """
+
+    def __init__(self, background, well_names, compiled=None, plot_frames=PLOT_FRAMES):
+        """
+        :param background: float array of the background read of every kinetic read column (wells,)
+        :param well_names: list of the well names of the kinetic read columns
+        :param compiled: CompiledPlateMap of the kinetic read to also fit the replicate averaged samples, or None
+        :param plot_frames: number of frames kept in the buffer
+        """
+        self.background = np.asarray(background, dtype=np.float64)
+        self.well_names = list(well_names)
+        self.compiled = compiled
+        self.well_fits = KineticAccumulator(self.well_names)
+        self.sample_fits = KineticAccumulator(compiled.labels) if compiled is not None else None
+        self.buffer = FrameBuffer(len(self.well_names), plot_frames)
+        self.t0 = None
+        self.latest = None
+        self.relative_time = None
+
+    @property
+    def n_frames(self):
+        return self.buffer.n_frames
+
+    def update(self, values, relative_time, temperature):
+        """
+        Analyse a block of consecutive frames
+        :param values: float array of raw reads (frames x wells)
+        :param relative_time: float array of the relative time of each frame in seconds
+        :param temperature: float array of the temperature of each frame in °C
+        :return: number of frames in the block
+        """
+        if not len(relative_time):
+            return 0
+        bg_removed = values - self.background
+        if self.t0 is None:
+            self.t0 = bg_removed[0].copy()
+        self.well_fits.update(relative_time, bg_removed)
+        if self.sample_fits is not None:
+            self.sample_fits.update(relative_time, average_replicates(bg_removed, self.compiled))
+        self.buffer.extend(values, relative_time, temperature)
+        self.latest = bg_removed[-1].copy()
+        self.relative_time = relative_time[-1]
+        return len(relative_time)
+
+    def percent_remaining(self):
+        """
+        :return: tuple of float arrays (wells,) of the first and latest read standardized to the first, i.e. the same
+        scaling as standardize_data: % of the first kinetic read
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.t0 / self.t0 / 0.01, self.latest / self.t0 / 0.01
+
+    def summary(self):
+        """
+        :return: dataframe of the current % remaining and % consumed of every well
+        """
+        first, last = self.percent_remaining()
+        return pd.DataFrame({
+            'Well Name': self.well_names,
+            'Frames': self.n_frames,
+            'Relative Time': self.relative_time,
+            'Percent Remaining': last,
+            'Percent Consumed': first - last,
+        })
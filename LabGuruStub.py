@@ -0,0 +1,209 @@
+import argparse
+import email.parser
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Elements of the protocols served by the stub, with the placeholders the Uox and Pierce sections fill in
+DEFAULT_PROTOCOL = [
+    '<p>Source plate {input_plate}</p>',
+    json.dumps([
+        {'title': 'Lysis', 'description': '{lysis_description} {lysate_description}'},
+        {'title': 'Sample dilution', 'description': '{dilution_description}'},
+        {'title': 'Assay', 'description': '{sample_vol}uL of sample added to {sodiumphos_vol}uL of sodium phosphate'},
+        {'title': 'Standard curve', 'description': '{standard_curve}'},
+        {'title': 'Pierce dilution', 'description': '{sample_vol}uL of sample added to {diluent_vol}uL of diluent'},
+    ]),
+]
+# "/api/v1/elements/12" -> ("elements", "12")
+API_PATH = re.compile(r'^/api/v1/(\w+)(?:/(\d+))?/?(?:\?.*)?$')
+
+
+class StubLabGuru:
+    """
+    In-memory stand-in of the parts of the LabGuru API the analyses use: experiments, protocols, sections, elements and
+    attachments. Every request can be delayed and a fraction of them answered with a retryable error, to measure the
+    uploads against realistic latencies. Attachments are optionally written to a folder, as a filesystem stand-in.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, storage_dir=None, seed=None):
+        """
+        :param latency: seconds added to every response
+        :param jitter: standard deviation in seconds of the latency, drawn per request
+        :param error_rate: fraction of requests answered with error_status
+        :param error_status: status code of the injected errors
+        :param storage_dir: folder to write the uploaded attachments into, None to only count them
+        :param seed: random seed of the latency and the errors
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.storage_dir = Path(storage_dir) if storage_dir else None
+        self.rng = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.sections = {}
+        self.elements = {}
+        self.attachments = {}
+        self.stats = {'requests': 0, 'errors': 0, 'attachments': 0, 'attachment_bytes': 0}
+        self.url = None
+
+    def delay(self):
+        with self.lock:
+            seconds = max(0.0, self.rng.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+            fail = self.rng.random() < self.error_rate
+            self.stats['requests'] += 1
+            self.stats['errors'] += fail
+        if seconds:
+            time.sleep(seconds)
+        return fail
+
+    def new_id(self):
+        with self.lock:
+            return next(self.ids)
+
+    def handle(self, method, resource, resource_id, headers, body):
+        """
+        Answer one API request
+        :return: tuple of the status code and the json response
+        """
+        if method == 'GET' and resource == 'experiments' and resource_id:
+            return 200, {'id': int(resource_id), 'uuid': f'stub-experiment-{resource_id}'}
+        if method == 'GET' and resource == 'protocols' and resource_id:
+            return 200, {'id': int(resource_id), 'sections': [{'elements': [{'data': data}
+                                                                            for data in DEFAULT_PROTOCOL]}]}
+        if method == 'GET' and resource == 'stats':
+            with self.lock:
+                return 200, dict(self.stats, sections=len(self.sections), elements=len(self.elements))
+        if method == 'POST' and resource == 'sections':
+            item = json.loads(body or b'{}').get('item', {})
+            section_id = self.new_id()
+            self.sections[section_id] = item
+            return 200, {'id': section_id, **item}
+        if method == 'POST' and resource == 'elements':
+            item = json.loads(body or b'{}').get('item', {})
+            element_id = self.new_id()
+            self.elements[element_id] = item
+            return 200, {'id': element_id, **item}
+        if method == 'PUT' and resource == 'elements' and resource_id:
+            item = json.loads(body or b'{}').get('item', {})
+            if int(resource_id) not in self.elements:
+                return 404, {'error': f'element {resource_id} not found'}
+            self.elements[int(resource_id)].update(item)
+            return 200, {'id': int(resource_id), **self.elements[int(resource_id)]}
+        if method == 'POST' and resource == 'attachments':
+            attachment_id = self.new_id()
+            name, data = self._attachment(headers, body)
+            with self.lock:
+                self.attachments[attachment_id] = {'name': name, 'size': len(data)}
+                self.stats['attachments'] += 1
+                self.stats['attachment_bytes'] += len(data)
+            if self.storage_dir:
+                folder = self.storage_dir / 'attachments'
+                folder.mkdir(parents=True, exist_ok=True)
+                (folder / f'{attachment_id}_{Path(name).name}').write_bytes(data)
+            return 200, {'id': attachment_id, 'name': name}
+        return 404, {'error': f'{method} {resource} is not served by the stub'}
+
+    @staticmethod
+    def _attachment(headers, body):
+        """
+        :return: tuple of the file name and the contents of the item[attachment] part of a multipart upload
+        """
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {headers.get('Content-Type', '')}\r\n\r\n".encode() + body)
+        for part in message.get_payload() if message.is_multipart() else []:
+            if part.get_param('name', header='content-disposition') == 'item[attachment]':
+                return part.get_filename() or 'attachment', part.get_payload(decode=True) or b''
+        return 'attachment', b''
+
+
+def _handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body are written separately, without this every keep-alive response waits on a delayed ack
+        disable_nagle_algorithm = True
+
+        def _respond(self, method):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            match = API_PATH.match(self.path)
+            if stub.delay():
+                status, response = stub.error_status, {'error': 'injected error'}
+            elif match is None:
+                status, response = 404, {'error': f'{self.path} is not an API path'}
+            else:
+                status, response = stub.handle(method, match.group(1), match.group(2), self.headers, body)
+            data = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._respond('GET')
+
+        def do_POST(self):
+            self._respond('POST')
+
+        def do_PUT(self):
+            self._respond('PUT')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+@contextmanager
+def running(port=0, **kwargs):
+    """
+    Serve a StubLabGuru from a background thread for the duration of a with block
+    :param port: port to listen on, 0 for any free port
+    :param kwargs: keyword arguments of StubLabGuru
+    :return: the StubLabGuru, its url attribute is the base url of the server
+    """
+    stub = StubLabGuru(**kwargs)
+    server = ThreadingHTTPServer(('127.0.0.1', port), _handler(stub))
+    server.daemon_threads = True
+    stub.url = f'http://127.0.0.1:{server.server_port}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield stub
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a local stand-in of the LabGuru API")
+    parser.add_argument('--port', type=int, default=8765, help="port to listen on")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="standard deviation of the latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with an error")
+    parser.add_argument('--error-status', type=int, default=503, help="status code of the injected errors")
+    parser.add_argument('--storage-dir', default=None, help="write the uploaded attachments into this folder")
+    parser.add_argument('--seed', type=int, default=None, help="random seed of the latency and the errors")
+    args = parser.parse_args(argv)
+
+    with running(args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                 error_status=args.error_status, storage_dir=args.storage_dir, seed=args.seed) as stub:
+        print(f"LabGuru stub serving on {stub.url}, set UOX_BACKEND=local and UOX_LABGURU_URL={stub.url}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            print(json.dumps(stub.stats))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
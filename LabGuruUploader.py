@@ -0,0 +1,419 @@
+import hashlib
+import itertools
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from RunTrace import in_context, span
+
+LABGURU_URL = 'https://my.labguru.com'
+# Upload progress of a run, kept in the run folder next to the summary workbook
+UPLOAD_STATUS_FILE = 'LabGuruUpload.json'
+# Status codes worth retrying, anything else in the 4xx range is a permanent failure
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+# Status codes a POST is retried on, they say the request was not processed. Any other error may have come after the
+# server stored the new section, element or attachment, and sending it again would create a duplicate.
+POST_RETRY_STATUS = {408, 429, 503}
+# Content hashes of the files already attached to each LabGuru experiment, unset means every file is uploaded
+ATTACHMENT_INDEX_PATH = Path(os.environ.get('UOX_ATTACHMENT_INDEX',
+                                            Path.home() / '.cache' / 'UricaseActivityAssay' / 'attachments.sqlite'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS attachments (
+    base_url TEXT,
+    experiment TEXT,
+    sha256 TEXT,
+    attachment_id INTEGER,
+    name TEXT,
+    size INTEGER,
+    uploaded TEXT,
+    PRIMARY KEY (base_url, experiment, sha256)
+);
+"""
+
+
+class UploadError(Exception):
+    """
+    A LabGuru request that failed, attempts is the number of times it was sent, None if it was not sent
+    """
+
+    def __init__(self, message, attempts=None):
+        super().__init__(message)
+        self.attempts = attempts
+
+
+def content_hash(path):
+    """
+    :param path: file path
+    :return: hex sha256 of the file contents, read in blocks
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AttachmentIndex:
+    """
+    Local index of the files attached to LabGuru experiments, by content hash. An attachment belongs to its experiment,
+    so a file with the same contents as one attached to the experiment before (e.g. the plate map shared by every plate
+    of the experiment, or an unchanged input of a re-analysed run) is referenced rather than uploaded again.
+    """
+
+    def __init__(self, index_path=None):
+        self.index_path = Path(index_path or ATTACHMENT_INDEX_PATH)
+        os.makedirs(self.index_path.parent, exist_ok=True)
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # Upload threads and batch workers share the index, wait for each other's writes rather than failing
+        connection = sqlite3.connect(self.index_path, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def lookup(self, base_url, experiment, sha256):
+        """
+        :param base_url: LabGuru server
+        :param experiment: uuid of the experiment
+        :param sha256: content hash of the file
+        :return: LabGuru id of the attachment with these contents, or None if there is none
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT attachment_id FROM attachments WHERE base_url = ? AND experiment = ? AND sha256 = ?',
+                (base_url, experiment, sha256)).fetchone()
+        return row[0] if row else None
+
+    def record(self, base_url, experiment, sha256, attachment_id, path):
+        """
+        Record a file uploaded to an experiment
+        :param base_url: LabGuru server
+        :param experiment: uuid of the experiment
+        :param sha256: content hash of the file
+        :param attachment_id: LabGuru id of the new attachment
+        :param path: file path of the uploaded file
+        :return:
+        """
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?, ?, ?, ?)', (
+                base_url, experiment, sha256, attachment_id, Path(path).name, Path(path).stat().st_size,
+                datetime.now().isoformat(timespec='seconds')
+            ))
+
+    def forget(self, base_url, experiment, attachment_id):
+        """
+        Drop an attachment from the index, e.g. one deleted in LabGuru, so its contents are uploaded again
+        :param base_url: LabGuru server
+        :param experiment: uuid of the experiment
+        :param attachment_id: LabGuru id of the attachment
+        :return:
+        """
+        with self._connect() as connection:
+            connection.execute('DELETE FROM attachments WHERE base_url = ? AND experiment = ? AND attachment_id = ?',
+                               (base_url, experiment, attachment_id))
+
+
+def _not_sent(error):
+    """
+    :param error: requests exception of a failed request
+    :return: True if the request failed before it reached the server, so sending it again cannot process it twice
+    """
+    import requests
+    from urllib3.exceptions import NewConnectionError
+
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class LabGuruUploader:
+    """
+    Uploads the attachments of one run to a LabGuru experiment section. Requests share a pooled session, files are
+    sent by a bounded thread pool, failed requests are retried with exponential backoff, and the progress is kept in
+    a json status file so an interrupted upload resumes where it stopped instead of starting a new section. Files
+    whose contents are already attached to the experiment are referenced in the attachments element instead of being
+    uploaded again.
+    """
+
+    def __init__(self, token=None, base_url=None, status_path=None, max_workers=4, retries=5, backoff=1.0,
+                 timeout=(10, 300), attachment_index=ATTACHMENT_INDEX_PATH, dry_run=None):
+        """
+        :param token: LabGuru API token, defaults to the token of the backend, i.e. the instrument token of
+        LabGuruAPI.SESSION
+        :param base_url: LabGuru server, defaults to the server of the backend, e.g. a local stub server
+        :param status_path: json file recording the section, element and uploaded attachments of the run
+        :param max_workers: number of files uploaded at the same time
+        :param retries: number of retries of a failed request
+        :param backoff: seconds before the first retry, doubled for every further retry
+        :param timeout: (connect, read) timeout of every request in seconds
+        :param attachment_index: file path of the AttachmentIndex, None to upload every file
+        :param dry_run: if True, send nothing and answer every request with a new id, defaults to the backend's mode
+        """
+        if token is None or base_url is None or dry_run is None:
+            from Backends import get_backend
+            backend = get_backend()
+            dry_run = backend.dry_run if dry_run is None else dry_run
+            base_url = base_url or backend.base_url or ''
+            token = backend.token() if token is None else token
+        self.token = token
+        self.base_url = base_url.rstrip('/')
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.dry_run = dry_run
+        # A dry run uploads nothing, so it must not record attachments a later real upload would link to
+        self.attachments = AttachmentIndex(attachment_index) if attachment_index and not dry_run else None
+        self._dry_run_ids = itertools.count(1)
+
+        self.session = None
+        if not dry_run:
+            # requests is only imported once something is uploaded, so the analysis modules import without it
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+
+        self.status_path = Path(status_path) if status_path else None
+        self._lock = threading.Lock()
+        self.state = {'files': {}}
+        if self.status_path and self.status_path.exists():
+            with open(self.status_path, 'r') as file:
+                self.state = json.load(file)
+
+    def _save_state(self):
+        if not self.status_path:
+            return
+        with self._lock:
+            tmp_path = self.status_path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as file:
+                json.dump(self.state, file, indent=2)
+            os.replace(tmp_path, self.status_path)
+
+    def request(self, method, path, **kwargs):
+        """
+        Send a request to the LabGuru API, retrying connection errors, timeouts and retryable status codes. A POST is
+        only retried when it cannot have been processed: failed connections and POST_RETRY_STATUS.
+        :param method: HTTP method
+        :param path: API path, e.g. /api/v1/elements
+        :param kwargs: keyword arguments passed on to requests, callables are called again for every attempt
+        :return: tuple of the decoded json response and the number of attempts, raises UploadError with the number of
+        attempts if the request failed
+        """
+        if self.dry_run:
+            with span(f'{method} {path}', 'http', attempt=1, dry_run=True):
+                with self._lock:
+                    return {'id': next(self._dry_run_ids)}, 1
+
+        import requests
+
+        retry_status = POST_RETRY_STATUS if method == 'POST' else RETRY_STATUS
+        for attempt in range(self.retries + 1):
+            # File bodies have to be reopened for every attempt
+            call_kwargs = {key: value() if callable(value) else value for key, value in kwargs.items()}
+            try:
+                attachment = call_kwargs.get('files', {}).get('item[attachment]', (None,))[0]
+                with span(f'{method} {path}', 'http', attempt=attempt + 1, file=attachment) as details:
+                    response = self.session.request(method, self.base_url + path, timeout=self.timeout,
+                                                    **call_kwargs)
+                    details['status'] = response.status_code
+                if response.status_code not in retry_status:
+                    if not response.ok:
+                        raise UploadError(f"{method} {path} failed with {response.status_code}: {response.text[:200]}",
+                                          attempt + 1)
+                    return response.json(), attempt + 1
+                error = f"{method} {path} returned {response.status_code}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = f"{method} {path} failed: {e}"
+                if method == 'POST' and not _not_sent(e):
+                    raise UploadError(f"{error}, not retried as the server may have processed it", attempt + 1) from e
+            finally:
+                for value in call_kwargs.get('files', {}).values():
+                    if hasattr(value[1], 'close'):
+                        value[1].close()
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt * (0.5 + random.random() / 2))
+        raise UploadError(f"{error} after {self.retries + 1} attempts", self.retries + 1)
+
+    def add_element(self, section_id, element_type, data, name=None):
+        """
+        Add an element to an experiment section
+        :param section_id: id of the experiment section
+        :param element_type: LabGuru element type, e.g. 'attachments' or 'text'
+        :param data: element data
+        :param name: optional element name
+        :return: json response of the new element
+        """
+        item = {
+            'container_id': section_id,
+            'container_type': 'ExperimentProcedure',
+            'element_type': element_type,
+            'data': data
+        }
+        if name is not None:
+            item['name'] = name
+        response, _ = self.request('POST', '/api/v1/elements', json={'token': self.token, 'item': item})
+        return response
+
+    def begin(self, section_id, attach_to_uuid):
+        """
+        Record the section of the run and create its attachments element, unless a resumed upload already has one
+        :param section_id: id of the experiment section
+        :param attach_to_uuid: uuid of the experiment
+        :return: id of the attachments element
+        """
+        if self.state.get('section_id') != section_id or not self.state.get('element_id'):
+            element = self.add_element(section_id, 'attachments', '[]', name='Attachments')
+            self.state.update(section_id=section_id, attach_to_uuid=attach_to_uuid, element_id=element['id'],
+                              files={}, linked_ids=[])
+            self._save_state()
+        return self.state['element_id']
+
+    def resume(self, state):
+        """
+        Continue in the section of an earlier upload of the run, e.g. one recorded in the run ledger after the run
+        folder was cleared. Files are uploaded again unless the status file already lists them.
+        :param state: uploader state of the earlier upload
+        :return:
+        """
+        for key in ('section_id', 'attach_to_uuid', 'element_id', 'image_element_id', 'image_attachment_id'):
+            if state.get(key) is not None and self.state.get(key) is None:
+                self.state[key] = state[key]
+        self._save_state()
+
+    def upload_file(self, path):
+        """
+        Upload one file to the attachments element of the run. Files uploaded before with the same size and
+        modification time are skipped, and files with the same contents as an attachment of the experiment are linked
+        to it without an upload.
+        :param path: file path
+        :return: status dictionary with the path, status, attachment id, number of attempts and error
+        """
+        path = Path(path)
+        stat = path.stat()
+        signature = [stat.st_size, stat.st_mtime_ns]
+        previous = self.state['files'].get(str(path))
+        if previous and previous.get('signature') == signature and previous.get('attachment_id'):
+            return {'path': str(path), 'status': 'skipped', 'attachment_id': previous['attachment_id'],
+                    'attempts': 0, 'error': None}
+
+        sha256 = content_hash(path) if self.attachments else None
+        if sha256:
+            attachment_id = self.attachments.lookup(self.base_url, self.state['attach_to_uuid'], sha256)
+            if attachment_id is not None:
+                with self._lock:
+                    self.state['files'][str(path)] = {'signature': signature, 'attachment_id': attachment_id,
+                                                      'linked': True}
+                self._save_state()
+                return {'path': str(path), 'status': 'linked', 'attachment_id': attachment_id, 'attempts': 0,
+                        'error': None}
+
+        def files():
+            return {
+                'token': (None, self.token),
+                'item[attachment]': (path.name, path.open('rb')),
+                'item[attach_to_uuid]': (None, self.state['attach_to_uuid']),
+                'item[section_id]': (None, self.state['section_id']),
+                'item[element_id]': (None, self.state['element_id'])
+            }
+
+        try:
+            response, attempts = self.request('POST', '/api/v1/attachments', headers={'accept': '*/*'}, files=files)
+        except UploadError as e:
+            return {'path': str(path), 'status': 'failed', 'attachment_id': None, 'attempts': e.attempts or 0,
+                    'error': str(e)}
+        if sha256:
+            self.attachments.record(self.base_url, self.state['attach_to_uuid'], sha256, response['id'], path)
+        with self._lock:
+            self.state['files'][str(path)] = {'signature': signature, 'attachment_id': response['id']}
+        self._save_state()
+        return {'path': str(path), 'status': 'uploaded', 'attachment_id': response['id'], 'attempts': attempts,
+                'error': None}
+
+    def upload_files(self, paths):
+        """
+        Upload files concurrently to the attachments element of the run, then list the linked attachments in the
+        element
+        :param paths: list of file paths
+        :return: list of status dictionaries in the order of paths
+        """
+        if not self.state.get('element_id'):
+            raise UploadError("begin() has to be called before uploading files")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            # Every upload runs in a copy of this thread's context, so its requests are traced into the calling run
+            futures = [pool.submit(in_context(self.upload_file), path) for path in paths]
+            statuses = [future.result() for future in futures]
+        if any(status['status'] == 'linked' for status in statuses):
+            self.link_attachments()
+        return statuses
+
+    def link_attachments(self):
+        """
+        Set the attachments element of the run to every attachment of the run, uploaded or linked. Uploads are added to
+        the element by LabGuru, linked attachments only once they are listed in the element data. The element is only
+        updated when the linked attachments changed.
+        :return: list of the attachment ids of the element
+        """
+        attachment_ids = sorted({file['attachment_id'] for file in self.state['files'].values()
+                                 if file.get('attachment_id') is not None})
+        linked = sorted({file['attachment_id'] for file in self.state['files'].values() if file.get('linked')})
+        if self.state.get('linked_ids') != linked:
+            self.request('PUT', f"/api/v1/elements/{self.state['element_id']}",
+                         json={'token': self.token, 'item': {'data': json.dumps(attachment_ids)}})
+            self.state['linked_ids'] = linked
+            self._save_state()
+        return attachment_ids
+
+    def add_image(self, attachment_id, image_path):
+        """
+        Embed an uploaded image in the run section. A run has one image element, which is pointed at the new attachment
+        when the image was uploaded again.
+        :param attachment_id: LabGuru id of the uploaded image attachment
+        :param image_path: file path of the image
+        :return: json response of the text element
+        """
+        if self.state.get('image_element_id') and self.state.get('image_attachment_id') == attachment_id:
+            return {'id': self.state['image_element_id']}
+        jpg_name = Path(str(image_path).replace('\\', '/')).name.replace('.png', '.jpg')
+        img_html_path = f'{attachment_id}/annotated/{jpg_name}'
+        data = f'<img class="fancybox-image" src="/user_assets/415072/attachments/{img_html_path}" alt="">'
+        if self.state.get('image_element_id'):
+            element, _ = self.request('PUT', f"/api/v1/elements/{self.state['image_element_id']}",
+                                      json={'token': self.token, 'item': {'data': data}})
+        else:
+            element = self.add_element(self.state['section_id'], 'text', data)
+        self.state.update(image_element_id=element['id'], image_attachment_id=attachment_id)
+        self._save_state()
+        return element
+
+
+def report(statuses):
+    """
+    Print one line per uploaded file and raise if any upload failed
+    :param statuses: list of status dictionaries from LabGuruUploader.upload_files
+    :return:
+    """
+    for status in statuses:
+        print(f"{status['status']:<9}{Path(status['path']).name}"
+              + (f" ({status['attempts']} attempts)" if status['attempts'] > 1 else '')
+              + (f": {status['error']}" if status['error'] else ''))
+    failed = [status['path'] for status in statuses if status['status'] == 'failed']
+    if failed:
+        raise UploadError(f"{len(failed)} of {len(statuses)} attachments failed to upload, re-run to resume")
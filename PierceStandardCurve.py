@@ -0,0 +1,216 @@
+import json
+import os
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from PlateGeometry import parse_well_names
+from PlateMap import file_hash
+from TecanAscii import parse_ascii
+
+# Fitted standard curves are cached here, keyed by the sha256 of the ascii read, the model and the interferent flag
+CACHE_DIR = Path(os.environ.get('UOX_CURVE_CACHE', Path.home() / '.cache' / 'UricaseActivityAssay' / 'standard_curves'))
+# BSA standards (mg/mL) in rows A-H of the standard columns, halved by the buffer of the Interferent protocol
+STANDARD_CONCENTRATIONS = np.array([2.0, 1.5, 1.0, 0.75, 0.5, 0.125, 0.05, 0.0])
+STANDARD_COLUMNS = (1, 2, 3)
+CURVE_MODELS = ('linear', 'quadratic', '4pl')
+
+# Standard curves already fitted by this process, keyed like the on-disk cache
+_fitted = {}
+
+
+class StandardCurve(NamedTuple):
+    """
+    Standard curve of one Pierce plate, absorbance as a function of concentration
+    model: 'linear', 'quadratic' or '4pl'
+    params: linear (slope, intercept), quadratic (a, b, c) of a*x² + b*x + c, 4pl (bottom, hill slope, ec50, top)
+    r2: coefficient of determination over the standard wells
+    n_points: number of standard wells in the fit
+    """
+    model: str
+    params: tuple
+    r2: float
+    n_points: int
+
+
+def standard_wells(well_names, interferent=False, columns=STANDARD_COLUMNS):
+    """
+    :param well_names: list of the well names of a read
+    :param interferent: if True, the standards were diluted 2-fold by the interferent buffer
+    :param columns: plate columns holding the standards
+    :return: tuple of the integer array of the standard well positions and the float array of their concentrations
+    """
+    concentrations = STANDARD_CONCENTRATIONS / 2 if interferent else STANDARD_CONCENTRATIONS
+    rows, well_columns = parse_well_names(well_names)
+    index = np.flatnonzero(np.isin(well_columns, columns) & (rows >= 0) & (rows < len(concentrations)))
+    return index.astype(np.intp), concentrations[rows[index]]
+
+
+def _four_pl(x, params):
+    bottom, slope, ec50, top = params
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        return top + (bottom - top) / (1 + (np.maximum(x, 0) / ec50) ** slope)
+
+
+def _fit_four_pl(x, y, iterations=200):
+    """
+    Levenberg-Marquardt least squares fit of a 4 parameter logistic, with the hill slope and ec50 fitted on log scale
+    so they stay positive
+    """
+    def model(p):
+        return _four_pl(x, (p[0], np.exp(p[1]), np.exp(p[2]), p[3]))
+
+    positive = x[x > 0]
+    p = np.array([y.min(), 0.0, np.log(np.median(positive)), y.max() + (y.max() - y.min())])
+    residual = y - model(p)
+    cost = residual @ residual
+    damping = 1e-3
+    for _ in range(iterations):
+        # Forward difference jacobian of the model
+        step = 1e-6 * np.maximum(np.abs(p), 1)
+        fitted = y - residual
+        jacobian = np.stack([(model(p + dp) - fitted) / h for dp, h in zip(np.diag(step), step)], axis=1)
+        jtj = jacobian.T @ jacobian
+        gradient = jacobian.T @ residual
+        try:
+            delta = np.linalg.solve(jtj + damping * np.diag(np.diag(jtj)), gradient)
+        except np.linalg.LinAlgError:
+            break
+        candidate = p + delta
+        candidate_residual = y - model(candidate)
+        candidate_cost = candidate_residual @ candidate_residual
+        if np.isfinite(candidate_cost) and candidate_cost < cost:
+            converged = cost - candidate_cost < 1e-12 * max(cost, 1e-12)
+            p, residual, cost = candidate, candidate_residual, candidate_cost
+            damping = max(damping / 10, 1e-12)
+            if converged:
+                break
+        else:
+            damping *= 10
+            if damping > 1e12:
+                break
+    return (float(p[0]), float(np.exp(p[1])), float(np.exp(p[2])), float(p[3]))
+
+
+def fit_standard_curve(concentrations, absorbance, model='4pl'):
+    """
+    Fit a standard curve through the standard wells. NaN reads are left out.
+    :param concentrations: float array of the standard concentrations
+    :param absorbance: float array of the standard reads
+    :param model: 'linear', 'quadratic' or '4pl'
+    :return: a StandardCurve
+    """
+    if model not in CURVE_MODELS:
+        raise ValueError(f"Unknown standard curve model '{model}', expected one of {', '.join(CURVE_MODELS)}")
+    present = ~np.isnan(absorbance)
+    x = np.asarray(concentrations, dtype=np.float64)[present]
+    y = np.asarray(absorbance, dtype=np.float64)[present]
+
+    if model == 'linear':
+        params = tuple(float(p) for p in np.polyfit(x, y, 1))
+    elif model == 'quadratic':
+        params = tuple(float(p) for p in np.polyfit(x, y, 2))
+    else:
+        params = _fit_four_pl(x, y)
+    curve = StandardCurve(model=model, params=params, r2=np.nan, n_points=int(len(x)))
+    residual = y - predict_absorbance(curve, x)
+    total = y - y.mean()
+    return curve._replace(r2=float(1 - residual @ residual / (total @ total)))
+
+
+def predict_absorbance(curve, concentrations):
+    """
+    :param curve: StandardCurve
+    :param concentrations: float array of concentrations
+    :return: float array of the absorbance the curve predicts
+    """
+    x = np.asarray(concentrations, dtype=np.float64)
+    if curve.model == '4pl':
+        return _four_pl(x, curve.params)
+    return np.polyval(curve.params, x)
+
+
+def back_calculate(curve, absorbance):
+    """
+    Concentration of every read from the inverse of the standard curve, in a single array operation. Reads outside
+    the range the curve can reach are NaN.
+    :param curve: StandardCurve
+    :param absorbance: float array of reads of any shape
+    :return: float array of concentrations with the shape of absorbance
+    """
+    y = np.asarray(absorbance, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if curve.model == 'linear':
+            slope, intercept = curve.params
+            return (y - intercept) / slope
+        if curve.model == 'quadratic':
+            a, b, c = curve.params
+            if a == 0:
+                return (y - c) / b
+            # Root on the rising branch of the parabola, where the slope 2ax + b equals +sqrt(discriminant)
+            return (-b + np.sqrt(b * b - 4 * a * (c - y))) / (2 * a)
+        bottom, slope, ec50, top = curve.params
+        ratio = (bottom - top) / (y - top) - 1
+        return np.where(ratio >= 0, ec50 * np.abs(ratio) ** (1 / slope), np.nan)
+
+
+def _cache_key(digest, model, interferent, standard_columns):
+    columns = '' if tuple(standard_columns) == STANDARD_COLUMNS else '_' + '-'.join(map(str, standard_columns))
+    return f"{digest}_{model}{'_interferent' if interferent else ''}{columns}"
+
+
+def plate_standard_curve(ascii_path, interferent=False, model='4pl', cache_dir=None, data=None,
+                         standard_columns=STANDARD_COLUMNS):
+    """
+    Standard curve of a Pierce plate, fitted from the first raw A660 read of its standard wells. A plate is only fitted
+    the first time its contents are seen, afterwards the curve comes from an on-disk cache keyed by the content hash.
+    :param ascii_path: file path of the Pierce ascii read
+    :param interferent: if True, the standards were diluted 2-fold by the interferent buffer
+    :param model: 'linear', 'quadratic' or '4pl'
+    :param cache_dir: cache directory, defaults to CACHE_DIR
+    :param data: AsciiData of the read if it is already parsed
+    :param standard_columns: plate columns holding the standards
+    :return: a StandardCurve
+    """
+    key = _cache_key(file_hash(ascii_path), model, interferent, standard_columns)
+    if key in _fitted:
+        return _fitted[key]
+
+    cache_path = Path(cache_dir or CACHE_DIR) / f'{key}.json'
+    try:
+        with open(cache_path, 'r') as file:
+            cached = json.load(file)
+        curve = StandardCurve(model=cached['model'], params=tuple(cached['params']), r2=cached['r2'],
+                              n_points=cached['n_points'])
+    except (OSError, ValueError, KeyError):
+        if data is None:
+            data = parse_ascii(ascii_path)
+        index, concentrations = standard_wells(data.well_names, interferent, standard_columns)
+        curve = fit_standard_curve(concentrations, data.values[0, index], model)
+        try:
+            os.makedirs(cache_path.parent, exist_ok=True)
+            tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp_path, 'w') as file:
+                json.dump(curve._asdict(), file)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+    _fitted[key] = curve
+    return curve
+
+
+def quantify_plate(ascii_path, interferent=False, model='4pl', cache_dir=None, standard_columns=STANDARD_COLUMNS):
+    """
+    Back-calculate the protein concentration of every well of a Pierce plate from its own standard curve
+    :param ascii_path: file path of the Pierce ascii read
+    :param interferent: if True, the standards were diluted 2-fold by the interferent buffer
+    :param model: 'linear', 'quadratic' or '4pl'
+    :param cache_dir: cache directory for the fitted curves, defaults to CACHE_DIR
+    :param standard_columns: plate columns holding the standards
+    :return: tuple of the StandardCurve and a pandas series of the concentrations (mg/mL) indexed by well name
+    """
+    data = parse_ascii(ascii_path)
+    curve = plate_standard_curve(ascii_path, interferent, model, cache_dir, data, standard_columns)
+    return curve, pd.Series(back_calculate(curve, data.values[0]), index=data.well_names)
@@ -0,0 +1,138 @@
+import re
+from typing import NamedTuple
+
+import numpy as np
+
+# "H12" -> ("H", "12"), "AF48" -> ("AF", "48")
+WELL_NAME = re.compile(r'^([A-Z]+)0*(\d+)$')
+
+
+class PlateGeometry(NamedTuple):
+    """
+    Row and column layout of a microplate. Wells are identified by a compact integer index in the column-major order
+    of the Magellan ascii export (A1, B1, ..., H1, A2, ...), i.e. index = (column - 1) * n_rows + row, with 0 based rows
+    and 1 based columns.
+    """
+    n_rows: int
+    n_columns: int
+
+    @property
+    def n_wells(self):
+        return self.n_rows * self.n_columns
+
+    def row_names(self):
+        """
+        :return: list of the row letters, A-Z then AA, AB, ... for plates of more than 26 rows
+        """
+        return [row_name(row) for row in range(self.n_rows)]
+
+    def well_rows(self):
+        """
+        :return: integer array of the 0 based row of every well index
+        """
+        return np.tile(np.arange(self.n_rows, dtype=np.intp), self.n_columns)
+
+    def well_columns(self):
+        """
+        :return: integer array of the 1 based column of every well index
+        """
+        return np.repeat(np.arange(1, self.n_columns + 1, dtype=np.intp), self.n_rows)
+
+    def well_names(self):
+        """
+        :return: list of the well names of every well index
+        """
+        rows = self.row_names()
+        return [f'{row}{column}' for column in range(1, self.n_columns + 1) for row in rows]
+
+    def index(self, rows, columns):
+        """
+        :param rows: integer array of 0 based rows
+        :param columns: integer array of 1 based columns
+        :return: integer array of the well indices, -1 for positions off the plate
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        columns = np.asarray(columns, dtype=np.intp)
+        on_plate = (rows >= 0) & (rows < self.n_rows) & (columns >= 1) & (columns <= self.n_columns)
+        return np.where(on_plate, (columns - 1) * self.n_rows + rows, -1)
+
+    def parse(self, well_names):
+        """
+        :param well_names: list of well names, e.g. ['A1', 'B01', 'P24']
+        :return: integer array of the well indices, -1 for names that are not wells of this plate
+        """
+        return self.index(*parse_well_names(well_names))
+
+    def column_groups(self, well_index):
+        """
+        Group the wells of a read by plate column
+        :param well_index: integer array of the well index of every column of the read
+        :return: dictionary of plate column number to an integer array of the positions of its wells in the read
+        """
+        well_index = np.asarray(well_index, dtype=np.intp)
+        columns = np.where(well_index >= 0, self.well_columns()[np.maximum(well_index, 0)], 0)
+        return {int(n): np.flatnonzero(columns == n) for n in np.unique(columns[columns > 0])}
+
+
+PLATE_96 = PlateGeometry(8, 12)
+PLATE_384 = PlateGeometry(16, 24)
+PLATE_1536 = PlateGeometry(32, 48)
+# Standard plates by number of wells
+GEOMETRIES = {geometry.n_wells: geometry for geometry in (PLATE_96, PLATE_384, PLATE_1536)}
+
+
+def row_name(row):
+    """
+    0 -> 'A', 25 -> 'Z', 26 -> 'AA'
+    """
+    name = ''
+    row += 1
+    while row:
+        row, remainder = divmod(row - 1, 26)
+        name = chr(ord('A') + remainder) + name
+    return name
+
+
+def parse_well_names(well_names):
+    """
+    :param well_names: list of well names
+    :return: tuple of the integer arrays of the 0 based row and 1 based column of every well, -1 for other names
+    """
+    rows = np.full(len(well_names), -1, dtype=np.intp)
+    columns = np.full(len(well_names), -1, dtype=np.intp)
+    for i, name in enumerate(well_names):
+        match = WELL_NAME.match(str(name).strip())
+        if match:
+            row = 0
+            for letter in match.group(1):
+                row = row * 26 + ord(letter) - ord('A') + 1
+            rows[i] = row - 1
+            columns[i] = int(match.group(2))
+    return rows, columns
+
+
+def geometry_for(n_wells, n_rows=None):
+    """
+    :param n_wells: number of wells of a read
+    :param n_rows: number of plate rows, if the read is not a standard 96, 384 or 1536 well plate
+    :return: PlateGeometry of the plate
+    """
+    if n_rows:
+        return PlateGeometry(n_rows, n_wells // n_rows)
+    if n_wells not in GEOMETRIES:
+        raise ValueError(f"No standard plate has {n_wells} wells, give the number of rows")
+    return GEOMETRIES[n_wells]
+
+
+def infer_geometry(well_names):
+    """
+    Smallest standard plate that holds all named wells, or a custom plate just large enough to hold them
+    :param well_names: list of well names
+    :return: PlateGeometry
+    """
+    rows, columns = parse_well_names(well_names)
+    n_rows, n_columns = rows.max(initial=-1) + 1, columns.max(initial=0)
+    for geometry in GEOMETRIES.values():
+        if n_rows <= geometry.n_rows and n_columns <= geometry.n_columns:
+            return geometry
+    return PlateGeometry(int(n_rows), int(n_columns))
@@ -0,0 +1,173 @@
+from typing import NamedTuple
+
+import numpy as np
+import yaml
+
+from PlateGeometry import GEOMETRIES, parse_well_names, row_name
+
+# Reader plate columns holding samples on a Pierce plate, columns 1-3 hold the standard curve
+PIERCE_SAMPLE_COLUMNS = (4, 5, 6, 7, 8, 9)
+PIERCE_STANDARD_COLUMNS = (1, 2, 3)
+
+
+class LayoutBlock(NamedTuple):
+    """
+    Rectangle of reader plate wells that holds samples of the source plate
+    plate: position of the reader plate in the list of reads, from 0
+    columns: reader plate columns of the block
+    source_columns: source plate column of each reader column
+    source_row_offset: number of rows the block is shifted down on the source plate
+    dilution: dilution factor of the block, on top of the run's dilution factor
+    """
+    plate: int
+    columns: tuple
+    source_columns: tuple
+    source_row_offset: int = 0
+    dilution: float = 1.0
+
+
+class PlateLayout(NamedTuple):
+    """
+    Declarative mapping of N reader plates onto the wells of one logical source plate
+    n_plates: number of reader plates
+    blocks: tuple of LayoutBlocks, reader wells outside every block (e.g. the standards) are not mapped
+    standard_columns: reader plate columns holding the standard curve
+    """
+    n_plates: int
+    blocks: tuple
+    standard_columns: tuple = PIERCE_STANDARD_COLUMNS
+
+
+class CompiledLayout(NamedTuple):
+    """
+    A PlateLayout compiled against the well order of the reads
+    plate_index: integer array of the reader plate of every mapped well
+    well_index: integer array of the position of every mapped well in its read
+    source_wells: object array of the source plate well names, in output order
+    dilution: float array of the block dilution of every mapped well
+    """
+    plate_index: np.ndarray
+    well_index: np.ndarray
+    source_wells: np.ndarray
+    dilution: np.ndarray
+
+
+def pierce_layout(n_plates=2, source_columns=None, sample_columns=PIERCE_SAMPLE_COLUMNS, n_rows=8):
+    """
+    Default Pierce layout. Each reader plate carries the next sample_columns-wide slice of the source plate, and when a
+    row band of the source plate is full the next plates continue one band of n_rows further down. Two plates cover a
+    96 well source plate, four a row band of a 384 well source plate and eight all of it.
+    :param n_plates: number of reader plates
+    :param source_columns: number of columns of the source plate, defaults to the smallest standard plate the reader
+    plates fit on
+    :param sample_columns: reader plate columns holding samples
+    :param n_rows: number of rows of a reader plate
+    :return: a PlateLayout
+    """
+    width = len(sample_columns)
+    if source_columns is None:
+        for geometry in GEOMETRIES.values():
+            if -(-n_plates // max(geometry.n_columns // width, 1)) * n_rows <= geometry.n_rows:
+                source_columns = geometry.n_columns
+                break
+        else:
+            raise ValueError(f"{n_plates} reader plates do not fit on a standard source plate, give a layout")
+    plates_per_band = max(source_columns // width, 1)
+    blocks = []
+    for plate in range(n_plates):
+        band, position = divmod(plate, plates_per_band)
+        first = position * width + 1
+        blocks.append(LayoutBlock(plate=plate, columns=tuple(sample_columns),
+                                  source_columns=tuple(range(first, first + width)), source_row_offset=band * n_rows))
+    return PlateLayout(n_plates=n_plates, blocks=tuple(blocks))
+
+
+def layout_from_dict(spec):
+    """
+    Build a layout from its dictionary form:
+        plates: 2
+        standard_columns: [1, 2, 3]
+        blocks:
+          - {plate: 0, columns: [4, 5, 6, 7, 8, 9], source_columns: [1, 2, 3, 4, 5, 6]}
+          - {plate: 1, columns: [4, 5, 6, 7, 8, 9], source_columns: [7, 8, 9, 10, 11, 12], dilution: 2}
+    :param spec: layout dictionary
+    :return: a PlateLayout
+    """
+    blocks = []
+    for i, block in enumerate(spec['blocks']):
+        columns = tuple(int(c) for c in block['columns'])
+        source = tuple(int(c) for c in block['source_columns'])
+        if len(columns) != len(source):
+            raise ValueError(f"Layout block {i} maps {len(columns)} reader columns onto {len(source)} source columns")
+        blocks.append(LayoutBlock(plate=int(block['plate']), columns=columns, source_columns=source,
+                                  source_row_offset=int(block.get('source_row_offset', 0)),
+                                  dilution=float(block.get('dilution', 1.0))))
+    n_plates = int(spec.get('plates', max(block.plate for block in blocks) + 1))
+    return PlateLayout(n_plates=n_plates, blocks=tuple(blocks),
+                       standard_columns=tuple(spec.get('standard_columns', PIERCE_STANDARD_COLUMNS)))
+
+
+def load_layout(layout_path):
+    """
+    :param layout_path: file path of a yaml layout, see layout_from_dict
+    :return: a PlateLayout
+    """
+    with open(layout_path, 'r') as stream:
+        return layout_from_dict(yaml.safe_load(stream))
+
+
+def compile_layout(layout, well_names):
+    """
+    Compile a layout into index arrays over the wells of the reads. The mapped wells are ordered by block, then by the
+    well order of the read.
+    :param layout: PlateLayout
+    :param well_names: list of the well names of the reads, all reader plates share the same well order
+    :return: a CompiledLayout
+    """
+    rows, columns = parse_well_names(well_names)
+    plate_index = []
+    well_index = []
+    source_rows = []
+    source_columns = []
+    dilution = []
+    for i, block in enumerate(layout.blocks):
+        if not 0 <= block.plate < layout.n_plates:
+            raise ValueError(f"Layout block {i} is on plate {block.plate}, the layout has {layout.n_plates} plates")
+        # Lookup from reader column to source column, 0 for columns outside the block
+        lookup = np.zeros(max(columns.max(), max(block.columns)) + 1, dtype=np.intp)
+        lookup[list(block.columns)] = block.source_columns
+        wells = np.flatnonzero((columns > 0) & (lookup[np.maximum(columns, 0)] > 0))
+        plate_index.append(np.full(len(wells), block.plate, dtype=np.intp))
+        well_index.append(wells)
+        source_rows.append(rows[wells] + block.source_row_offset)
+        source_columns.append(lookup[columns[wells]])
+        dilution.append(np.full(len(wells), block.dilution))
+
+    source_rows = np.concatenate(source_rows)
+    source_columns = np.concatenate(source_columns)
+    source_wells = np.array([row_name(row) + str(column) for row, column in zip(source_rows, source_columns)],
+                            dtype=object)
+    unique, counts = np.unique(source_wells, return_counts=True)
+    if (counts > 1).any():
+        raise ValueError(f"Layout maps several reader wells onto source wells {', '.join(unique[counts > 1][:5])}")
+    return CompiledLayout(
+        plate_index=np.concatenate(plate_index),
+        well_index=np.concatenate(well_index),
+        source_wells=source_wells,
+        dilution=np.concatenate(dilution)
+    )
+
+
+def apply_layout(compiled, plate_values, dilution=1.0):
+    """
+    Gather the values of the mapped wells of every reader plate onto the source plate and apply the dilution factors,
+    in a single indexing step
+    :param compiled: CompiledLayout
+    :param plate_values: list of float arrays of one value per well, one array per reader plate
+    :param dilution: dilution factor of the whole run
+    :return: float array of the values of compiled.source_wells
+    """
+    if len(plate_values) <= compiled.plate_index.max(initial=-1):
+        raise ValueError(f"Layout needs {compiled.plate_index.max() + 1} reader plates, got {len(plate_values)}")
+    values = np.stack([np.asarray(v, dtype=np.float64) for v in plate_values])
+    return values[compiled.plate_index, compiled.well_index] * compiled.dilution * dilution
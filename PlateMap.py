@@ -0,0 +1,159 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from PlateGeometry import infer_geometry
+
+# Parsed plate maps are cached here, keyed by the sha256 of the xlsx file
+CACHE_DIR = Path(os.environ.get('UOX_PLATEMAP_CACHE', Path.home() / '.cache' / 'UricaseActivityAssay' / 'platemaps'))
+PLATEMAP_COLUMNS = ['Well Name', 'Sample Name', 'Control?']
+# Control? entries (case insensitive) marking a negative control, which should consume no uric acid over the run. Any
+# other entry marks a positive control, a reference enzyme that has to consume it.
+NEGATIVE_CONTROLS = ('negative', 'neg', 'no enzyme')
+
+# Plate maps already loaded by this process, keyed by content hash
+_loaded = {}
+
+
+class CompiledPlateMap(NamedTuple):
+    """
+    Well to sample mapping of a plate map compiled against the well order of a read
+    labels: sorted list of sample labels, controls end in ' (Control)'
+    well_index: integer array of the positions of the mapped wells in the read
+    group_index: integer array of the label of each mapped well, aligned with well_index
+    is_control: boolean array marking the control labels
+    negative_control: boolean array marking the negative control labels, a subset of is_control
+    """
+    labels: list
+    well_index: np.ndarray
+    group_index: np.ndarray
+    is_control: np.ndarray
+    negative_control: np.ndarray
+
+
+def file_hash(path):
+    """
+    :param path: file path
+    :return: hex sha256 of the file contents
+    """
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+def load_platemap(samplemap_path, cache_dir=None):
+    """
+    Load the Well Name, Sample Name and Control? columns of an xlsx plate map. The xlsx is only parsed the first time
+    its contents are seen, afterwards the columns come from an on-disk cache keyed by the content hash.
+    :param samplemap_path: file path of the xlsx plate map
+    :param cache_dir: cache directory, defaults to CACHE_DIR
+    :return: pandas dataframe of the plate map columns
+    """
+    digest = file_hash(samplemap_path)
+    if digest in _loaded:
+        return _loaded[digest].copy()
+
+    cache_path = Path(cache_dir or CACHE_DIR) / f'{digest}.pkl'
+    try:
+        platemap = pd.read_pickle(cache_path)
+    except Exception:
+        # Missing, truncated or written by another pandas version, parse the xlsx again and replace it
+        platemap = pd.read_excel(samplemap_path)
+        platemap = platemap.reindex(columns=PLATEMAP_COLUMNS)
+        try:
+            os.makedirs(cache_path.parent, exist_ok=True)
+            # Write to a temporary name first so parallel workers never read a partial file
+            tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+            platemap.to_pickle(tmp_path)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+    _loaded[digest] = platemap
+    return platemap.copy()
+
+
+def compile_platemap(platemap, well_names, geometry=None):
+    """
+    Compile a plate map into index arrays over the wells of a read. Plate map and read wells are matched by their plate
+    well index, so 'A01' and 'A1' name the same well. Wells with an empty sample name are dropped, wells missing from
+    the plate map keep their well name, and controls get a ' (Control)' suffix. Controls whose Control? entry is one of
+    NEGATIVE_CONTROLS are negative controls, every other control is a positive control.
+    :param platemap: pandas dataframe with Well Name, Sample Name and Control? columns
+    :param well_names: list of the well names of the read, in column order
+    :param geometry: PlateGeometry of the plate, defaults to the smallest standard plate holding the read
+    :return: a CompiledPlateMap
+    """
+    geometry = geometry or infer_geometry(well_names)
+    read_index = geometry.parse(well_names)
+    map_index = geometry.parse(platemap['Well Name'].tolist())
+    # Keep the last plate map row of every well
+    _, last_rows = np.unique(map_index[::-1], return_index=True)
+    on_plate = np.zeros(len(map_index), dtype=bool)
+    on_plate[len(map_index) - 1 - last_rows] = True
+    on_plate &= map_index >= 0
+
+    # Sample name and control flag by plate well index
+    names_by_well = np.full(geometry.n_wells, None, dtype=object)
+    controls_by_well = np.full(geometry.n_wells, None, dtype=object)
+    in_platemap = np.zeros(geometry.n_wells, dtype=bool)
+    names_by_well[map_index[on_plate]] = platemap['Sample Name'].to_numpy(dtype=object)[on_plate]
+    controls_by_well[map_index[on_plate]] = platemap['Control?'].to_numpy(dtype=object)[on_plate]
+    in_platemap[map_index[on_plate]] = True
+
+    found = read_index >= 0
+    names = np.where(found, names_by_well[np.maximum(read_index, 0)], None)
+    controls = np.where(found, controls_by_well[np.maximum(read_index, 0)], None)
+    present = found & in_platemap[np.maximum(read_index, 0)]
+
+    well_labels = []
+    negative_wells = np.zeros(len(well_names), dtype=bool)
+    for i, (well, name, control, mapped) in enumerate(zip(well_names, names, controls, present)):
+        if not mapped:
+            well_labels.append(well)
+        elif isinstance(control, str) and not pd.isna(name):
+            well_labels.append(f'{name} (Control)')
+            negative_wells[i] = control.strip().lower() in NEGATIVE_CONTROLS
+        elif isinstance(name, str):
+            well_labels.append(name)
+        else:
+            well_labels.append(None)
+
+    well_index = np.array([i for i, label in enumerate(well_labels) if label is not None], dtype=np.intp)
+    labels, group_index = np.unique(np.array([well_labels[i] for i in well_index], dtype=object),
+                                    return_inverse=True)
+    labels = [str(label) for label in labels]
+    group_index = group_index.astype(np.intp)
+    is_control = np.array([label.endswith(' (Control)') for label in labels], dtype=bool)
+    negative_control = np.zeros(len(labels), dtype=bool)
+    negative_control[group_index[negative_wells[well_index]]] = True
+    return CompiledPlateMap(
+        labels=labels,
+        well_index=well_index,
+        group_index=group_index,
+        is_control=is_control,
+        negative_control=negative_control & is_control
+    )
+
+
+def average_replicates(values, compiled):
+    """
+    Average the replicate wells of every sample in a single reduction over the well matrix. NaN reads are left out of
+    their sample's average.
+    :param values: float array of reads (frames x wells)
+    :param compiled: CompiledPlateMap of the read
+    :return: float array of sample averages (frames x samples), in the order of compiled.labels
+    """
+    if not compiled.labels:
+        return np.empty((values.shape[0], 0))
+    order = np.argsort(compiled.group_index, kind='stable')
+    columns = compiled.well_index[order]
+    starts = np.flatnonzero(np.r_[True, np.diff(compiled.group_index[order]) != 0])
+
+    selected = values[:, columns]
+    present = ~np.isnan(selected)
+    sums = np.add.reduceat(np.where(present, selected, 0.0), starts, axis=1)
+    counts = np.add.reduceat(present, starts, axis=1)
+    with np.errstate(invalid='ignore'):
+        return sums / counts
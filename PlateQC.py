@@ -0,0 +1,281 @@
+import argparse
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from ResultsStore import STORE_DIR, load_results, write_partition
+
+# Reads at or above this absorbance are past the linear range of the reader, 'OVER' cells count as saturated too
+SATURATION = 3.0
+# Background subtracted first kinetic reads below this carry too little uric acid signal to follow its consumption
+LOW_SIGNAL = 0.1
+# Background subtracted reads below minus this are flagged, small negatives are read noise on fully consumed wells
+NEGATIVE_TOLERANCE = 0.02
+# Coefficient of variation (%) of the mean background subtracted read of the replicate wells of a sample
+MAX_CV = 20.0
+# Incubation temperature of the kinetic read, the tolerance on every frame and the largest drift over the run in °C
+TEMPERATURE_TARGET = 37.0
+TEMPERATURE_TOLERANCE = 1.0
+MAX_DRIFT = 0.5
+# % of the uric acid a positive control sample has to consume over the run, and a negative control may consume at most
+CONTROL_MIN_CONSUMED = 20.0
+NEGATIVE_CONTROL_MAX_CONSUMED = 5.0
+
+# Columns of the long QC table, one row per run, sample or well and check
+QC_COLUMNS = ['run', 'level', 'name', 'check', 'value', 'flagged']
+
+
+def plate_qc(background, raw, relative_time, temperature, group, is_control, negative_control=None):
+    """
+    Compute every QC check of a batch of Uox activity runs in one pass over stacked arrays. Runs with fewer frames or
+    wells than the largest run of the batch are padded with NaN.
+    :param background: float array of the background read of every well (runs x wells)
+    :param raw: float array of the kinetic reads (runs x frames x wells), NaN for 'OVER' cells and padding
+    :param relative_time: float array of the relative time of every frame in seconds (runs x frames), NaN for padding
+    :param temperature: float array of the temperature of every frame in °C (runs x frames)
+    :param group: integer array of the sample of every well (runs x wells), numbered over the whole batch, -1 for wells
+    without a sample and for padding
+    :param is_control: boolean array marking the control samples (samples,)
+    :param negative_control: boolean array marking the negative control samples (samples,), which must not consume the
+    uric acid, defaults to every control being a positive control that has to consume it
+    :return: dictionary of 'wells' (runs x wells), 'samples' (samples,) and 'runs' (runs,) dictionaries of check name
+    to a tuple of the value and flagged arrays, and the 'present' (runs x wells) boolean array of the wells of each run
+    """
+    n_runs = raw.shape[0]
+    frames = ~np.isnan(relative_time)
+    n_valid = frames.sum(axis=1)
+    present = ~np.isnan(background) | (~np.isnan(raw)).any(axis=1) | (group >= 0)
+    bg_removed = raw - background[:, None, :]
+
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        # nan reductions over all-NaN padding warn, and give the NaN wanted
+        warnings.simplefilter('ignore', RuntimeWarning)
+        # Well checks
+        over = (np.isnan(raw) & frames[:, :, None]).any(axis=1) | np.isnan(background)
+        max_read = np.fmax(np.nanmax(raw, axis=1), background)
+        first = bg_removed[:, 0, :]
+        last = bg_removed[np.arange(n_runs), np.maximum(n_valid - 1, 0), :]
+        lowest = np.nanmin(bg_removed, axis=1)
+        wells = {
+            'saturated': (max_read, present & (over | (max_read >= SATURATION))),
+            'low_signal': (first, present & (first < LOW_SIGNAL)),
+            'negative_after_background': (lowest, present & (lowest < -NEGATIVE_TOLERANCE)),
+        }
+
+        # Sample checks, summed over the replicate wells of every sample with bincount
+        n_samples = len(is_control)
+        mapped = group >= 0
+        sample = group[mapped]
+
+        def sample_sum(values):
+            values = values[mapped]
+            known = ~np.isnan(values)
+            return (np.bincount(sample[known], weights=values[known], minlength=n_samples),
+                    np.bincount(sample[known], minlength=n_samples))
+
+        # The mean over the run follows the whole curve, so it catches pipetting and activity differences alike
+        mean_signal = np.nanmean(bg_removed, axis=1)
+        total, count = sample_sum(mean_signal)
+        total_squares, _ = sample_sum(mean_signal ** 2)
+        mean = total / count
+        variance = np.maximum(total_squares - total * mean, 0) / (count - 1)
+        cv = np.where(count >= 2, 100 * np.sqrt(variance) / np.abs(mean), np.nan)
+        first_total, first_count = sample_sum(first)
+        last_total, last_count = sample_sum(last)
+        consumed = 100 * (1 - (last_total / last_count) / (first_total / first_count))
+        negative = np.zeros_like(is_control) if negative_control is None else negative_control & is_control
+        positive = is_control & ~negative
+        samples = {
+            'replicate_cv': (cv, cv > MAX_CV),
+            'control_consumed': (np.where(is_control, consumed, np.nan),
+                                 (positive & ~(consumed >= CONTROL_MIN_CONSUMED))
+                                 | (negative & ~(consumed <= NEGATIVE_CONTROL_MAX_CONSUMED))),
+        }
+
+        # Run checks
+        temperature = np.where(frames, temperature, np.nan)
+        low = np.nanmin(temperature, axis=1)
+        high = np.nanmax(temperature, axis=1)
+        # Least squares temperature slope over the relative time, times the run duration
+        t = np.where(frames & ~np.isnan(temperature), relative_time, np.nan)
+        t_centered = t - np.nanmean(t, axis=1, keepdims=True)
+        slope = (np.nansum(t_centered * (temperature - np.nanmean(temperature, axis=1, keepdims=True)), axis=1)
+                 / np.nansum(t_centered ** 2, axis=1))
+        drift = slope * (np.nanmax(t, axis=1) - np.nanmin(t, axis=1))
+        n_controls = np.bincount(np.nonzero(mapped)[0], weights=is_control[sample], minlength=n_runs)
+        runs = {
+            'temperature_min': (low, low < TEMPERATURE_TARGET - TEMPERATURE_TOLERANCE),
+            'temperature_max': (high, high > TEMPERATURE_TARGET + TEMPERATURE_TOLERANCE),
+            'temperature_drift': (drift, np.abs(drift) > MAX_DRIFT),
+            'control_wells': (n_controls, n_controls == 0),
+        }
+    return {'wells': wells, 'samples': samples, 'runs': runs, 'present': present}
+
+
+def qc_table(checks, well_names, sample_names, sample_runs):
+    """
+    Flatten the checks of plate_qc into one long table
+    :param checks: dictionary returned by plate_qc
+    :param well_names: list of the well names of the columns of the stacked arrays
+    :param sample_names: list of the names of the samples
+    :param sample_runs: integer array of the run of every sample
+    :return: pandas dataframe with the QC_COLUMNS, run is the position of the run in the batch
+    """
+    present = checks['present']
+    run, well = np.nonzero(present)
+    parts = []
+    for check, (value, flagged) in checks['wells'].items():
+        parts.append(pd.DataFrame({'run': run, 'level': 'well', 'name': np.asarray(well_names, dtype=object)[well],
+                                   'check': check, 'value': value[run, well], 'flagged': flagged[run, well]}))
+    for check, (value, flagged) in checks['samples'].items():
+        # Checks that do not apply to a sample, e.g. the control check of an experimental sample, are left out
+        applies = ~np.isnan(value) | flagged
+        parts.append(pd.DataFrame({'run': sample_runs[applies], 'level': 'sample',
+                                   'name': np.asarray(sample_names, dtype=object)[applies], 'check': check,
+                                   'value': value[applies], 'flagged': flagged[applies]}))
+    for check, (value, flagged) in checks['runs'].items():
+        parts.append(pd.DataFrame({'run': np.arange(len(value)), 'level': 'run', 'name': None, 'check': check,
+                                   'value': value.astype(np.float64), 'flagged': flagged}))
+    return pd.concat(parts, ignore_index=True)[QC_COLUMNS]
+
+
+def uox_run_qc(plate_run):
+    """
+    QC checks of a single Uox activity run
+    :param plate_run: PlateRun of the run
+    :return: pandas dataframe of every check with the level, name, check, value and flagged columns
+    """
+    compiled = plate_run.compiled
+    group = np.full(len(plate_run.well_names), -1, dtype=np.intp)
+    group[compiled.well_index] = compiled.group_index
+    checks = plate_qc(
+        np.asarray(plate_run.background, dtype=np.float64)[np.newaxis],
+        np.asarray(plate_run.raw, dtype=np.float64)[np.newaxis],
+        np.asarray(plate_run.relative_time, dtype=np.float64)[np.newaxis],
+        np.asarray(plate_run.temperature, dtype=np.float64)[np.newaxis],
+        group[np.newaxis],
+        compiled.is_control,
+        compiled.negative_control
+    )
+    table = qc_table(checks, plate_run.well_names, compiled.labels, np.zeros(len(compiled.labels), dtype=np.intp))
+    return table.drop(columns='run')
+
+
+def _stacked_checks(reads, run_index, n_runs, well_index, well_names):
+    """
+    plate_qc of the runs of one frame count, laid out as stacked arrays
+    :param reads: dataframe of the background and raw reads of the runs
+    :param run_index: integer array of the run of every row, numbered within the group
+    :param n_runs: number of runs of the group
+    :param well_index: integer array of the well of every row in well_names
+    :param well_names: well names of the batch
+    :return: the qc_table of the runs, run is numbered within the group
+    """
+    is_raw = (reads['measure'] == 'raw').to_numpy()
+    frame = reads['frame'].to_numpy()
+    n_wells, n_frames = len(well_names), int(frame[is_raw].max(initial=-1)) + 1
+
+    background = np.full((n_runs, n_wells), np.nan)
+    raw = np.full((n_runs, n_frames, n_wells), np.nan)
+    relative_time = np.full((n_runs, n_frames), np.nan)
+    temperature = np.full((n_runs, n_frames), np.nan)
+    value = reads['value'].to_numpy(dtype=np.float64)
+    background[run_index[~is_raw], well_index[~is_raw]] = value[~is_raw]
+    raw[run_index[is_raw], frame[is_raw], well_index[is_raw]] = value[is_raw]
+    relative_time[run_index[is_raw], frame[is_raw]] = reads['relative_time'].to_numpy(dtype=np.float64)[is_raw]
+    temperature[run_index[is_raw], frame[is_raw]] = reads['temperature'].to_numpy(dtype=np.float64)[is_raw]
+
+    # Number the samples over the group, a sample is its name within its run
+    has_sample = reads['sample'].notna().to_numpy() & is_raw
+    sample_keys = pd.MultiIndex.from_arrays([run_index[has_sample], reads['sample'].to_numpy(dtype=object)[has_sample]])
+    sample_index, samples = sample_keys.factorize()
+    group = np.full((n_runs, n_wells), -1, dtype=np.intp)
+    group[run_index[has_sample], well_index[has_sample]] = sample_index
+    is_control = np.zeros(len(samples), dtype=bool)
+    is_control[sample_index] = reads['is_control'].to_numpy(dtype=bool)[has_sample]
+    # Runs appended before the control type was recorded hold no negative controls
+    negative_control = np.zeros(len(samples), dtype=bool)
+    negative_control[sample_index] = reads['negative_control'].fillna(False).to_numpy(dtype=bool)[has_sample]
+
+    checks = plate_qc(background, raw, relative_time, temperature, group, is_control, negative_control)
+    return qc_table(checks, list(well_names), list(samples.get_level_values(1)),
+                    samples.get_level_values(0).to_numpy())
+
+
+def sweep_store(store_dir, experiment=None):
+    """
+    QC every Uox activity run of the results dataset in batched passes. The background and raw kinetic reads of all
+    runs are loaded in one scan of the reads table, and the runs of each frame count are laid out as stacked arrays and
+    checked together, so a long run does not pad every other run to its length.
+    :param store_dir: root directory of the results dataset
+    :param experiment: experiment id, or list of ids, to check, defaults to every run
+    :return: pandas dataframe of every check with experiment_id, run_start and plate columns
+    """
+    reads = load_results(store_dir, 'reads', experiment=experiment, measure=['background', 'raw'],
+                         columns=['experiment_id', 'run_start', 'plate', 'well', 'sample', 'is_control',
+                                  'negative_control', 'measure', 'frame', 'relative_time', 'temperature', 'value'])
+    if reads.empty:
+        return pd.DataFrame(columns=['experiment_id', 'run_start', 'plate'] + QC_COLUMNS[1:])
+
+    run_index, runs = pd.MultiIndex.from_frame(reads[['experiment_id', 'run_start', 'plate']]).factorize()
+    well_index, well_names = pd.factorize(reads['well'])
+    is_raw = (reads['measure'] == 'raw').to_numpy()
+    n_frames = np.zeros(len(runs), dtype=np.int64)
+    np.maximum.at(n_frames, run_index[is_raw], reads['frame'].to_numpy()[is_raw].astype(np.int64) + 1)
+
+    tables = []
+    for count in np.unique(n_frames):
+        members = np.flatnonzero(n_frames == count)
+        local = np.full(len(runs), -1, dtype=np.intp)
+        local[members] = np.arange(len(members))
+        rows = np.flatnonzero(local[run_index] >= 0)
+        table = _stacked_checks(reads.iloc[rows], local[run_index[rows]], len(members), well_index[rows], well_names)
+        tables.append(table.assign(run=members[table['run'].to_numpy(dtype=np.intp)]))
+    table = pd.concat(tables, ignore_index=True)
+    keys = runs.to_frame(index=False, name=['experiment_id', 'run_start', 'plate'])
+    keys = keys.iloc[table['run']].reset_index(drop=True)
+    return pd.concat([keys, table.drop(columns='run')], axis=1)
+
+
+def write_qc(store_dir, qc):
+    """
+    Write the QC checks of swept runs into the qc table of the results dataset, one partition per run
+    :param store_dir: root directory of the results dataset
+    :param qc: dataframe from sweep_store
+    :return: number of written runs
+    """
+    for (experiment_id, run_start), run_qc in qc.groupby(['experiment_id', 'run_start'], sort=False):
+        write_partition(store_dir, 'qc', experiment_id, run_start, run_qc)
+    return qc.groupby(['experiment_id', 'run_start']).ngroups
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="QC every Uox activity run of the results dataset")
+    parser.add_argument('--store', default=STORE_DIR, help="results dataset (default: $UOX_RESULTS_STORE)")
+    parser.add_argument('--experiment', type=int, nargs='+', default=None, help="only check these experiment ids")
+    parser.add_argument('--write', action='store_true', help="write the checks into the qc table of the dataset")
+    parser.add_argument('-o', '--output', default=None, help="write the flagged checks to this csv file")
+    args = parser.parse_args(argv)
+    if not args.store:
+        parser.error("no results dataset given and UOX_RESULTS_STORE is not set")
+
+    start = time.perf_counter()
+    qc = sweep_store(args.store, args.experiment)
+    flagged = qc[qc['flagged']]
+    n_runs = qc.groupby(['experiment_id', 'run_start', 'plate']).ngroups
+    print(f"Checked {n_runs} runs in {time.perf_counter() - start:.2f}s, "
+          f"{flagged.groupby(['experiment_id', 'run_start', 'plate']).ngroups} with flags")
+    with pd.option_context('display.max_rows', 200, 'display.width', 200):
+        print(flagged.groupby(['plate', 'run_start', 'check']).size().rename('flags').reset_index().to_string(
+            index=False))
+    if args.output:
+        flagged.to_csv(args.output, index=False)
+    if args.write:
+        print(f"Wrote the checks of {write_qc(args.store, qc)} runs")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,214 @@
+import json
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+
+from KineticStream import background_columns
+from PlateMap import CompiledPlateMap, average_replicates
+from PlotRendering import split_columns
+from TecanAscii import frames_dataframe
+
+# First bytes of a plate run file, followed by the little endian length of its json header
+MAGIC = b'PLATERUN2\n'
+# Arrays of a plate run file start on multiples of this many bytes, so memory mapped arrays are aligned
+ALIGNMENT = 64
+# Views of the well reads and of the sample averages
+WELL_VIEWS = ['raw', 'background_subtracted', 'standardized']
+SAMPLE_VIEWS = ['sample_absolute', 'sample_standardized']
+# Arrays written to a plate run file
+ARRAYS = ['raw', 'background', 'relative_time', 'temperature', 'well_index', 'group_index', 'is_control',
+          'negative_control']
+
+
+class PlateRun:
+    """
+    Compact container of the reads of a Uox activity run. Only the raw reads (frames x wells) and the background read
+    of every well are stored, float32 by default. The background subtracted and standardized wells and the replicate
+    averaged samples are exact functions of these and the first frame, so they are computed when they are read rather
+    than kept as dataframes of their own. Saved to a file the arrays are memory mapped when loaded, and a loaded run is
+    pickled as its file path, so worker processes share the pages of the file instead of receiving a copy of the reads.
+    """
+    __slots__ = ('raw', 'background', 'relative_time', 'temperature', 'well_names', 'compiled', 'metadata', 'path')
+
+    def __init__(self, raw, background, relative_time, temperature, well_names, compiled, metadata=None, path=None):
+        """
+        :param raw: float array of the raw kinetic reads (frames x wells)
+        :param background: float array of the background read of every well
+        :param relative_time: float array of the relative time of each frame in seconds
+        :param temperature: float array of the temperature of each frame in °C
+        :param well_names: list of well names matching the last axis of raw
+        :param compiled: CompiledPlateMap of the wells, its labels name the samples
+        :param metadata: dictionary of the Tecan FluentControl yaml log file contents
+        :param path: file the run was loaded from, None if it lives in memory only
+        """
+        self.raw = raw
+        self.background = background
+        self.relative_time = relative_time
+        self.temperature = temperature
+        self.well_names = well_names
+        self.compiled = compiled
+        self.metadata = metadata or {}
+        self.path = path
+
+    @classmethod
+    def from_frames(cls, bg_df, kinetic_df, compiled, metadata=None, dtype=np.float32):
+        """
+        Build a run from the background and kinetic read dataframes, matching the background well of every kinetic
+        well by plate well index
+        :param bg_df: pandas dataframe of the background read
+        :param kinetic_df: pandas dataframe of the kinetic read
+        :param compiled: CompiledPlateMap of the wells of the kinetic read
+        :param metadata: dictionary of the Tecan FluentControl yaml log file contents
+        :param dtype: float dtype the reads are stored in
+        :return: PlateRun
+        """
+        relative_time, raw, well_names = split_columns(kinetic_df)
+        _, bg_values, bg_wells = split_columns(bg_df)
+        background = bg_values[0, background_columns(well_names, bg_wells)]
+        return cls(raw.astype(dtype, copy=False), background.astype(dtype), relative_time,
+                   kinetic_df['Temperature'].to_numpy(dtype=np.float64), well_names, compiled, metadata)
+
+    @property
+    def background_subtracted(self):
+        """
+        :return: float array of the background subtracted reads (frames x wells), as remove_background gives
+        """
+        return self.raw - self.background
+
+    @property
+    def standardized(self):
+        """
+        :return: float array of the background subtracted reads in % of their first frame (frames x wells)
+        """
+        return _standardize(self.background_subtracted)
+
+    @property
+    def sample_absolute(self):
+        """
+        :return: float array of the replicate averaged background subtracted reads (frames x samples), as
+        map_sample_names gives
+        """
+        return average_replicates(self.background_subtracted, self.compiled)
+
+    @property
+    def sample_standardized(self):
+        """
+        :return: float array of the sample averages in % of their first frame (frames x samples), as standardize_data
+        gives
+        """
+        return _standardize(self.sample_absolute)
+
+    @property
+    def labels(self):
+        return self.compiled.labels
+
+    @property
+    def nbytes(self):
+        """
+        :return: bytes of the arrays of the run
+        """
+        return sum(self._arrays()[name].nbytes for name in ARRAYS)
+
+    def view(self, name):
+        """
+        :param name: name of a view in WELL_VIEWS or SAMPLE_VIEWS
+        :return: float array (frames x wells) or (frames x samples), the raw view shares the memory of the run
+        """
+        if name in WELL_VIEWS + SAMPLE_VIEWS:
+            return getattr(self, name)
+        raise KeyError(f"Unknown view {name}, expected one of {', '.join(WELL_VIEWS + SAMPLE_VIEWS)}")
+
+    def to_frame(self, name='raw'):
+        """
+        :param name: name of a view in WELL_VIEWS or SAMPLE_VIEWS
+        :return: pandas dataframe of the view in the read_ascii layout, with well or sample name columns
+        """
+        columns = self.well_names if name in WELL_VIEWS else self.labels
+        return frames_dataframe(self.view(name).astype(np.float64), self.relative_time, self.temperature, columns)
+
+    def _arrays(self):
+        return {
+            'raw': self.raw,
+            'background': self.background,
+            'relative_time': self.relative_time,
+            'temperature': self.temperature,
+            'well_index': self.compiled.well_index,
+            'group_index': self.compiled.group_index,
+            'is_control': self.compiled.is_control,
+            'negative_control': self.compiled.negative_control,
+        }
+
+    def save(self, path):
+        """
+        Write the run to a memory mappable file: a json header of the names, metadata and array layout followed by
+        the arrays, each aligned to ALIGNMENT bytes
+        :param path: file path
+        :return: the run loaded back from the file, memory mapped
+        """
+        path = Path(path)
+        arrays = {name: np.ascontiguousarray(array) for name, array in self._arrays().items()}
+        layout, offset = {}, 0
+        for name in ARRAYS:
+            layout[name] = {'dtype': arrays[name].dtype.str, 'shape': list(arrays[name].shape), 'offset': offset}
+            offset += -(-arrays[name].nbytes // ALIGNMENT) * ALIGNMENT
+        # yaml timestamps are kept as their text
+        header = json.dumps({'well_names': list(self.well_names), 'labels': list(self.labels),
+                             'metadata': self.metadata, 'arrays': layout}, default=str).encode()
+        start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+        # Write to a temporary name first so parallel workers never read a partial file
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as file:
+            file.write(MAGIC + struct.pack('<Q', len(header)) + header)
+            for name in ARRAYS:
+                file.seek(start + layout[name]['offset'])
+                file.write(arrays[name].tobytes())
+            file.truncate(start + offset)
+        os.replace(tmp_path, path)
+        return PlateRun.load(path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        :param path: file path of a run written by save
+        :param mmap: if True the arrays are read only memory maps of the file, otherwise they are read into memory
+        :return: PlateRun
+        """
+        with open(path, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a plate run file")
+            (length,) = struct.unpack('<Q', file.read(8))
+            header = json.loads(file.read(length))
+        start = -(-(len(MAGIC) + 8 + length) // ALIGNMENT) * ALIGNMENT
+
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype, shape = np.dtype(spec['dtype']), tuple(spec['shape'])
+            if not np.prod(shape, dtype=np.int64):
+                # Empty arrays have nothing to map
+                arrays[name] = np.empty(shape, dtype=dtype)
+            elif mmap:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=start + spec['offset'], shape=shape)
+            else:
+                arrays[name] = np.fromfile(path, dtype=dtype, count=int(np.prod(shape)),
+                                           offset=start + spec['offset']).reshape(shape)
+        compiled = CompiledPlateMap(header['labels'], arrays['well_index'], arrays['group_index'],
+                                    arrays['is_control'], arrays['negative_control'])
+        return cls(arrays['raw'], arrays['background'], arrays['relative_time'], arrays['temperature'],
+                   header['well_names'], compiled, header['metadata'], Path(path))
+
+    def __reduce__(self):
+        # A run loaded from a file is sent to other processes as its path and mapped again there
+        if self.path is not None:
+            return PlateRun.load, (self.path,)
+        return PlateRun, tuple(getattr(self, name) for name in self.__slots__)
+
+
+def _standardize(values):
+    """
+    :return: float array of values in % of their first frame
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return values / values[:1] / 0.01
@@ -0,0 +1,241 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from PlateGeometry import infer_geometry
+
+
+def well_column_groups(well_names, geometry=None):
+    """
+    Group the well columns of a dataframe or array by plate column
+    :param well_names: list of well names, e.g. ['A1', 'B1', ..., 'H12']
+    :param geometry: PlateGeometry of the plate, defaults to the smallest standard plate holding the wells
+    :return: dictionary of plate column number to an integer array of the positions of its wells
+    """
+    geometry = geometry or infer_geometry(well_names)
+    return geometry.column_groups(geometry.parse(well_names))
+
+
+def _new_figure(figsize):
+    """
+    Create a figure drawn by the Agg canvas, without going through the pyplot state machine
+    :param figsize: tuple of the figure width and height in inches
+    :return: matplotlib Figure
+    """
+    # matplotlib is imported on the first figure, analyses that render none never load it
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _bar(ax, values, labels, colors):
+    """
+    Draw a bar chart laid out like pandas Series.plot(kind='bar')
+    """
+    positions = np.arange(len(values))
+    ax.bar(positions, values, width=0.5, color=colors)
+    ax.set_xticks(positions)
+    ax.set_xticklabels(labels, rotation=90)
+    ax.set_xlim(-0.5, len(values) - 0.5)
+
+
+def render_well_columns(relative_time, values, well_names, date_time, expt_id, dest_dir):
+    """
+    Scatter plot the standardized absorbance of every well, one figure per plate column. The figure and the tight
+    layout of the first column are reused for every column.
+    :param relative_time: float array of the frame times in seconds
+    :param values: float array of standardized reads (frames x wells)
+    :param well_names: list of well names matching the columns of values
+    :param date_time: run start used in the file names
+    :param expt_id: experiment id used in the file names
+    :param dest_dir: output directory
+    :return: list of the written file paths
+    """
+    fig = _new_figure((20, 12))
+    ax = fig.add_subplot()
+    paths = []
+    for n, wells in well_column_groups(well_names).items():
+        ax.cla()
+        for i in wells:
+            ax.scatter(relative_time, values[:, i], label=well_names[i])
+        ax.set_xlabel('Relative Time (s)')
+        ax.set_ylabel('Relative A292 (% of t0s)')
+        ax.set_title(f'Relative Absorbance Over Time \n Column {n}')
+        ax.legend()
+        ax.set_ylim([0, 110])
+        if not paths:
+            fig.tight_layout()
+        paths.append(Path(dest_dir) / f"{date_time}_{expt_id}_Column{n}.png")
+        fig.savefig(paths[-1])
+    return paths
+
+
+def render_sample_names(relative_time, values, labels, date_time, expt_id, dest_dir):
+    """
+    Scatter plot the standardized absorbance of every sample. Controls are marked with an x, and with more than 10
+    experimental samples they are spread over a 3x3 grid with the controls drawn in every panel.
+    :param relative_time: float array of the frame times in seconds
+    :param values: float array of standardized reads (frames x samples)
+    :param labels: list of sample names matching the columns of values, controls end in ' (Control)'
+    :param date_time: run start used in the file name
+    :param expt_id: experiment id used in the file name
+    :param dest_dir: output directory
+    :return: the written file path
+    """
+    path = Path(dest_dir) / f"{date_time}_{expt_id}_SampleNames.png"
+    control_columns = [i for i, label in enumerate(labels) if '(Control)' in label]
+    experiment_columns = [i for i, label in enumerate(labels) if '(Control)' not in label]
+
+    if len(experiment_columns) > 10:
+        fig = _new_figure((25, 15))
+        axs = fig.subplots(3, 3).ravel()
+        for ax in axs:
+            for i in control_columns:
+                ax.scatter(relative_time, values[:, i], label=labels[i], zorder=3, marker='x')
+        for n, i in enumerate(experiment_columns):
+            axs[n % 9].scatter(relative_time, values[:, i], label=labels[i])
+        # Label each panel once, rather than after every scatter
+        for ax in axs[:min(9, len(experiment_columns))]:
+            ax.set_xlabel('Relative Time (s)')
+            ax.set_ylabel('Relative A292 (% of t0s)')
+            ax.set_title('Relative Absorbance Over Time')
+            ax.legend()
+            ax.set_ylim([0, 110])
+    else:
+        fig = _new_figure((10, 6))
+        ax = fig.add_subplot()
+        for i, label in enumerate(labels):
+            ax.scatter(relative_time, values[:, i], label=label)
+        ax.set_xlabel('Relative Time (s)')
+        ax.set_ylabel('Relative A292 (% of t0s)')
+        ax.set_title('Relative Absorbance Over Time')
+        ax.legend()
+        ax.set_ylim([0, 110])
+        fig.tight_layout()
+    fig.savefig(path)
+    return path
+
+
+def render_percentage_consumed(values, labels, date_time, expt_id, dest_dir):
+    """
+    Bar charts of the % of uric acid consumed and remaining between the first and last plate read. Both charts are
+    drawn on the same figure.
+    :param values: float array of standardized reads (frames x samples)
+    :param labels: list of sample names matching the columns of values
+    :param date_time: run start used in the file names
+    :param expt_id: experiment id used in the file names
+    :param dest_dir: output directory
+    :return: list of the written file paths
+    """
+    labels = np.asarray(labels, dtype=object)
+    difference = values[0] - values[-1]
+    colors = np.where(['(Control)' in label for label in labels], 'red', 'blue')
+    fig = _new_figure((30, 12))
+    ax = fig.add_subplot()
+    paths = []
+
+    order = np.argsort(-difference, kind='stable')
+    _bar(ax, difference[order], labels[order], colors[order])
+    ax.set_ylabel('15 minute % Consumed')
+    ax.set_title('% of Uric Acid Consumed \nfrom First to Last Plate Read')
+    fig.tight_layout()
+    paths.append(Path(dest_dir) / f"{date_time}_{expt_id}_PercentConsumed.png")
+    fig.savefig(paths[-1])
+
+    ax.cla()
+    remaining = 100 - difference
+    order = np.argsort(remaining, kind='stable')
+    _bar(ax, remaining[order], labels[order], colors[order])
+    ax.set_ylabel('15 minute % Uric Acid Remaining')
+    ax.set_title('% of Uric Acid Remaining \nfrom First to Last Plate Read')
+    fig.tight_layout()
+    paths.append(Path(dest_dir) / f"{date_time}_{expt_id}_PercentRemaining.png")
+    fig.savefig(paths[-1])
+    return paths
+
+
+def render_uric_acid_remaining(values, labels, date_time, expt_id, dest_dir):
+    """
+    Bar chart of the background subtracted absorbance of every sample at the last plate read
+    :param values: float array of background subtracted reads (frames x samples)
+    :param labels: list of sample names matching the columns of values
+    :param date_time: run start used in the file name
+    :param expt_id: experiment id used in the file name
+    :param dest_dir: output directory
+    :return: the written file path
+    """
+    labels = np.asarray(labels, dtype=object)
+    order = np.argsort(values[-1], kind='stable')
+    colors = np.where(['(Control)' in label for label in labels[order]], 'red', 'blue')
+    fig = _new_figure((30, 12))
+    ax = fig.add_subplot()
+    _bar(ax, values[-1][order], labels[order], colors)
+    ax.set_ylabel('Background Subtracted Abs at 15 Min')
+    ax.set_title('Uric Acid Remaining\nat Last Plate Read')
+    fig.tight_layout()
+    path = Path(dest_dir) / f"{date_time}_{expt_id}_UricAcidRemaining.png"
+    fig.savefig(path)
+    return path
+
+
+def split_columns(df):
+    """
+    :param df: pandas dataframe with 'Relative Time' and 'Temperature' columns followed by one column per well/sample
+    :return: tuple of the relative time array, the (frames x columns) float array and the list of column labels
+    """
+    headers_to_exclude = ['Relative Time', 'Temperature']
+    headers_to_include = [col for col in df.columns if col not in headers_to_exclude]
+    return (df['Relative Time'].to_numpy(dtype=np.float64), df.loc[:, headers_to_include].to_numpy(dtype=np.float64),
+            [str(col) for col in headers_to_include])
+
+
+def _render_views(function, plate_run, views, args):
+    """
+    Call a render function with views of a PlateRun followed by further arguments
+    """
+    return function(*(getattr(plate_run, view) for view in views), *args)
+
+
+def plate_run_figure_tasks(plate_run, date_time, expt_id, dest_dir, wells=False):
+    """
+    Build the list of figures of a Uox activity run from a PlateRun. Each task holds the run rather than arrays of its
+    own, a run saved to a file is sent to worker processes as its path and memory mapped there.
+    :param plate_run: PlateRun of the run
+    :param date_time: run start used in the file names
+    :param expt_id: experiment id used in the file names
+    :param dest_dir: output directory
+    :param wells: if True, add the per plate column figures of the standardized wells
+    :return: list of (render function, argument tuple) tasks
+    """
+    names = (date_time, expt_id, dest_dir)
+    tasks = [
+        (_render_views, (render_sample_names, plate_run, ['relative_time', 'sample_standardized', 'labels'], names)),
+        (_render_views, (render_percentage_consumed, plate_run, ['sample_standardized', 'labels'], names)),
+        (_render_views, (render_uric_acid_remaining, plate_run, ['sample_absolute', 'labels'], names)),
+    ]
+    if wells:
+        tasks.append((_render_views, (render_well_columns, plate_run, ['relative_time', 'standardized', 'well_names'],
+                                      names)))
+    return tasks
+
+
+def _run_task(task):
+    function, args = task
+    return function(*args)
+
+
+def render_figures(tasks, workers=1):
+    """
+    Render figure tasks, in worker processes when more than one worker is requested
+    :param tasks: list of (render function, argument tuple) tasks
+    :param workers: number of worker processes
+    :return: list of the task results in task order
+    """
+    if workers is None or workers <= 1 or len(tasks) <= 1:
+        return [_run_task(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+        return list(pool.map(_run_task, tasks))
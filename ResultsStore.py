@@ -0,0 +1,239 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Root of the shared results dataset, unset means runs are not appended
+STORE_DIR = os.environ.get('UOX_RESULTS_STORE')
+
+# Columns of each table, besides the experiment_id and run_start partition keys
+TABLE_COLUMNS = {
+    # One row per well, frame and measure ('background', 'raw', 'background_subtracted', 'standardized')
+    'reads': [('plate', 'string'), ('well', 'string'), ('sample', 'string'), ('is_control', 'bool_'),
+              ('negative_control', 'bool_'), ('measure', 'string'), ('frame', 'int32'), ('relative_time', 'float64'),
+              ('temperature', 'float64'), ('value', 'float64')],
+    # One row per well or sample and fitted metric
+    'metrics': [('plate', 'string'), ('level', 'string'), ('name', 'string'), ('metric', 'string'),
+                ('value', 'float64')],
+    # One row per source plate well of a Pierce quantification
+    'pierce': [('plate', 'string'), ('well', 'string'), ('sample', 'string'), ('value', 'float64')],
+    # One row per run, sample or well and QC check, name is empty for the run checks
+    'qc': [('plate', 'string'), ('level', 'string'), ('name', 'string'), ('check', 'string'), ('value', 'float64'),
+           ('flagged', 'bool_')],
+    # One row per run of the wall clock times of the enzyme and substrate additions and the plate reads, and the
+    # seconds from each addition to the first kinetic frame
+    'timing': [('plate', 'string'), ('enzyme_added', 'string'), ('substrate_added', 'string'),
+               ('background_measured', 'string'), ('kinetic_measured', 'string'), ('substrate_offset', 'float64'),
+               ('enzyme_offset', 'float64')],
+    # One row per run and numeric yaml Metadata entry, e.g. the dilution factors and sample volumes
+    'conditions': [('plate', 'string'), ('assay', 'string'), ('key', 'string'), ('value', 'float64')],
+}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("The results store needs pyarrow, install it with 'pip install pyarrow'") from e
+    return pyarrow
+
+
+def _schema(pa, table):
+    return pa.schema([(name, getattr(pa, dtype)()) for name, dtype in TABLE_COLUMNS[table]])
+
+
+def write_partition(store_dir, table, experiment_id, run_start, df):
+    """
+    Write the rows of one run into its partition of a table, replacing any earlier write of the same run so re-runs
+    do not duplicate rows
+    :param store_dir: root directory of the results dataset
+    :param table: table name, one of TABLE_COLUMNS
+    :param experiment_id: LabGuru experiment id of the run
+    :param run_start: FluentControl start time of the run, e.g. 2024-09-05_12-34-53
+    :param df: pandas dataframe with the table columns
+    :return: file path of the written parquet file
+    """
+    pa = _pyarrow()
+    partition = Path(store_dir) / table / f'experiment_id={int(experiment_id)}' / f'run_start={run_start}'
+    os.makedirs(partition, exist_ok=True)
+    arrow_table = pa.Table.from_pandas(df[[name for name, _ in TABLE_COLUMNS[table]]], schema=_schema(pa, table),
+                                       preserve_index=False)
+    path = partition / 'part-0.parquet'
+    # Dataset scans skip names starting with '.', so a scan running meanwhile, or meeting the temporary file of a
+    # crashed writer, never reads a partial file
+    tmp_path = partition / f'.part-0.{os.getpid()}.tmp'
+    pa.parquet.write_table(arrow_table, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_partition(path, table, columns=None):
+    """
+    Read a single partition file of a table
+    :param path: file path of the parquet file of the partition
+    :param table: table name, one of TABLE_COLUMNS
+    :param columns: list of columns to load, defaults to all
+    :return: pandas dataframe of the rows of the partition, without the partition keys
+    """
+    pa = _pyarrow()
+    return pa.parquet.read_table(path, columns=columns, schema=_schema(pa, table)).to_pandas()
+
+
+def partition_files(store_dir, table):
+    """
+    List the partition files of a table
+    :param store_dir: root directory of the results dataset
+    :param table: table name, one of TABLE_COLUMNS
+    :return: list of tuples of the experiment id, run start and file path of every partition
+    """
+    partitions = []
+    for path in sorted((Path(store_dir) / table).glob('experiment_id=*/run_start=*/part-0.parquet')):
+        partitions.append((int(path.parent.parent.name.split('=', 1)[1]), path.parent.name.split('=', 1)[1], path))
+    return partitions
+
+
+def _conditions(yaml_dict, assay):
+    """
+    :return: dataframe of the numeric yaml Metadata entries of a run, in the conditions table columns
+    """
+    metadata = yaml_dict.get('Metadata') or {}
+    numeric = {key: float(value) for key, value in metadata.items()
+               if isinstance(value, (int, float)) and not isinstance(value, bool)}
+    return pd.DataFrame({'plate': yaml_dict['Input Plates'][0], 'assay': assay, 'key': list(numeric),
+                         'value': list(numeric.values())})
+
+
+def _long_reads(measure, values, relative_time, temperature, well_columns):
+    """
+    Melt a (frames x wells) array into tidy rows, well_columns maps column names to arrays of the value of every well
+    """
+    n_frames, n_wells = values.shape
+    return pd.DataFrame({
+        **{name: np.tile(column, n_frames) for name, column in well_columns.items()},
+        'measure': measure,
+        'frame': np.repeat(np.arange(n_frames, dtype=np.int32), n_wells),
+        'relative_time': np.repeat(relative_time, n_wells),
+        'temperature': np.repeat(temperature, n_wells),
+        'value': np.asarray(values, dtype=np.float64).ravel(),
+    })
+
+
+def append_uox_run(store_dir, yaml_dict, bg_df, plate_run, sample_fits, well_fits, qc=None, timing=None):
+    """
+    Append the reads, fitted metrics, QC checks, timing and run conditions of a Uox activity run to the results dataset
+    :param store_dir: root directory of the results dataset
+    :param yaml_dict: dictionary of the Tecan FluentControl yaml log file contents
+    :param bg_df: background read dataframe from read_ascii
+    :param plate_run: PlateRun of the run
+    :param sample_fits: dataframe of the per sample kinetic fits
+    :param well_fits: dataframe of the per well kinetic fits
+    :param qc: optional dataframe of the QC checks of the run from PlateQC.uox_run_qc
+    :param timing: optional TimeAlignment.RunTiming of the run
+    :return:
+    """
+    plate = yaml_dict['Input Plates'][0]
+    expt_id = int(plate[0:4])
+    well_names, compiled = plate_run.well_names, plate_run.compiled
+
+    # Sample name and control flags of every well, None for wells without a sample
+    sample_names = np.full(len(well_names), None, dtype=object)
+    sample_names[compiled.well_index] = np.asarray(compiled.labels, dtype=object)[compiled.group_index]
+    is_control = np.zeros(len(well_names), dtype=bool)
+    is_control[compiled.well_index] = compiled.is_control[compiled.group_index]
+    negative_control = np.zeros(len(well_names), dtype=bool)
+    negative_control[compiled.well_index] = compiled.negative_control[compiled.group_index]
+    wells = {'well': np.asarray(well_names, dtype=object), 'sample': sample_names, 'is_control': is_control,
+             'negative_control': negative_control}
+
+    relative_time = np.asarray(plate_run.relative_time, dtype=np.float64)
+    temperature = np.asarray(plate_run.temperature, dtype=np.float64)
+    reads = pd.concat([
+        _long_reads('background', plate_run.background[np.newaxis],
+                    bg_df['Relative Time'].to_numpy(dtype=np.float64)[:1],
+                    bg_df['Temperature'].to_numpy(dtype=np.float64)[:1], wells),
+        _long_reads('raw', plate_run.raw, relative_time, temperature, wells),
+        _long_reads('background_subtracted', plate_run.background_subtracted, relative_time, temperature, wells),
+        _long_reads('standardized', plate_run.standardized, relative_time, temperature, wells),
+    ], ignore_index=True)
+    reads['plate'] = plate
+    write_partition(store_dir, 'reads', expt_id, yaml_dict['Start'], reads)
+
+    metrics = pd.concat([
+        fits.rename_axis('name').reset_index().melt(id_vars='name', var_name='metric', value_name='value')
+        .assign(level=level)
+        for level, fits in [('sample', sample_fits), ('well', well_fits)]
+    ], ignore_index=True)
+    metrics['plate'] = plate
+    metrics['name'] = metrics['name'].astype(str)
+    write_partition(store_dir, 'metrics', expt_id, yaml_dict['Start'], metrics)
+    if qc is not None:
+        write_partition(store_dir, 'qc', expt_id, yaml_dict['Start'], qc.assign(plate=plate))
+    if timing is not None:
+        write_partition(store_dir, 'timing', expt_id, yaml_dict['Start'], timing.to_frame(plate))
+    write_partition(store_dir, 'conditions', expt_id, yaml_dict['Start'], _conditions(yaml_dict, 'uox'))
+
+
+def append_pierce_run(store_dir, yaml_dict, concentrations):
+    """
+    Append the protein concentrations and run conditions of a Pierce run to the results dataset
+    :param store_dir: root directory of the results dataset
+    :param yaml_dict: dictionary of the Tecan FluentControl yaml log file contents
+    :param concentrations: dataframe with Well Name, Protein Concentration (mg/mL) and Sample Name columns
+    :return:
+    """
+    plate = yaml_dict['Input Plates'][0]
+    pierce = pd.DataFrame({
+        'plate': plate,
+        'well': concentrations['Well Name'].astype(str),
+        'sample': concentrations['Sample Name'].astype(object).where(concentrations['Sample Name'].notna(), None),
+        'value': pd.to_numeric(concentrations['Protein Concentration (mg/mL)'], errors='coerce'),
+    })
+    write_partition(store_dir, 'pierce', int(plate[0:4]), yaml_dict['Start'], pierce)
+    write_partition(store_dir, 'conditions', int(plate[0:4]), yaml_dict['Start'], _conditions(yaml_dict, 'pierce'))
+
+
+def load_results(store_dir, table='reads', experiment=None, plate=None, sample=None, measure=None, columns=None):
+    """
+    Load a slice of the results dataset without opening any workbook
+    :param store_dir: root directory of the results dataset
+    :param table: table name, one of TABLE_COLUMNS
+    :param experiment: experiment id, or list of ids, to load
+    :param plate: plate barcode, or list of barcodes, to load
+    :param sample: sample name, or list of names, to load (sample name column of the reads/pierce tables, sample or
+    well name of the metrics table)
+    :param measure: measure, or list of measures, to load from the reads table
+    :param columns: list of columns to load, defaults to all
+    :return: pandas dataframe of the matching rows, with experiment_id and run_start columns
+    """
+    pa = _pyarrow()
+    ds = pa.dataset
+    root = Path(store_dir) / table
+    if not root.exists():
+        return pd.DataFrame(columns=['experiment_id', 'run_start'] + [name for name, _ in TABLE_COLUMNS[table]])
+
+    partitioning = ds.partitioning(pa.schema([('experiment_id', pa.int64()), ('run_start', pa.string())]),
+                                   flavor='hive')
+    dataset = ds.dataset(root, format='parquet', partitioning=partitioning, schema=_schema(pa, table).append(
+        pa.field('experiment_id', pa.int64())).append(pa.field('run_start', pa.string())),
+        ignore_prefixes=['.', '_'])
+
+    def is_in(field, value):
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        return ds.field(field).isin(list(values))
+
+    filters = []
+    if experiment is not None:
+        filters.append(is_in('experiment_id', [int(e) for e in np.atleast_1d(experiment)]))
+    if plate is not None:
+        filters.append(is_in('plate', plate))
+    if sample is not None:
+        filters.append(is_in('name' if table == 'metrics' else 'sample', sample))
+    if measure is not None:
+        filters.append(is_in('measure', measure))
+    expression = None
+    for f in filters:
+        expression = f if expression is None else expression & f
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
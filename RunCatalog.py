@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+import yaml
+
+# C accelerated loader when PyYAML is built against libyaml
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+# Local run metadata catalog
+CATALOG_PATH = Path(os.environ.get('UOX_RUN_CATALOG', Path.home() / '.cache' / 'UricaseActivityAssay' / 'runs.sqlite'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    yaml_path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    start TEXT,
+    end TEXT,
+    user TEXT,
+    protocol_name TEXT,
+    protocol_version TEXT,
+    metadata TEXT
+);
+CREATE TABLE IF NOT EXISTS plates (
+    yaml_path TEXT REFERENCES runs(yaml_path) ON DELETE CASCADE,
+    role TEXT,
+    position INTEGER,
+    plate TEXT
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    yaml_path TEXT REFERENCES runs(yaml_path) ON DELETE CASCADE,
+    key TEXT,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS plates_plate ON plates(plate);
+CREATE INDEX IF NOT EXISTS metadata_key ON metadata(key, value);
+CREATE INDEX IF NOT EXISTS runs_start ON runs(start);
+"""
+
+
+def load_yaml(yaml_path):
+    """
+    Parse a Tecan FluentControl yaml log file. Tabs are replaced in memory, the file itself is never rewritten.
+    :param yaml_path: file path of the input yaml file
+    :return: a dictionary variable storing the contents of the yaml file
+    """
+    with open(yaml_path, 'r') as file:
+        return yaml.load(file.read().replace('\t', '    '), Loader=SafeLoader)
+
+
+def connect(catalog_path=None):
+    """
+    Open the run catalog, creating it if needed
+    :param catalog_path: file path of the sqlite catalog, defaults to CATALOG_PATH
+    :return: sqlite3 connection
+    """
+    catalog_path = Path(catalog_path or CATALOG_PATH)
+    os.makedirs(catalog_path.parent, exist_ok=True)
+    connection = sqlite3.connect(catalog_path)
+    connection.execute('PRAGMA foreign_keys = ON')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _text(value):
+    return value if value is None or isinstance(value, str) else json.dumps(value, default=str)
+
+
+def _index_run(connection, yaml_path, stat, yaml_dict):
+    protocol = yaml_dict.get('Protocol') or {}
+    metadata = yaml_dict.get('Metadata') or {}
+    connection.execute('DELETE FROM runs WHERE yaml_path = ?', (yaml_path,))
+    connection.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+        yaml_path, stat.st_size, stat.st_mtime_ns, _text(yaml_dict.get('Start')), _text(yaml_dict.get('End')),
+        _text(yaml_dict.get('User')), _text(protocol.get('Name')), _text(protocol.get('Version')),
+        json.dumps(metadata, default=str)
+    ))
+    connection.executemany('INSERT INTO plates VALUES (?, ?, ?, ?)', [
+        (yaml_path, role, position, str(plate))
+        for role, key in [('input', 'Input Plates'), ('output', 'Output Plates')]
+        for position, plate in enumerate(yaml_dict.get(key) or [])
+    ])
+    connection.executemany('INSERT INTO metadata VALUES (?, ?, ?)', [
+        (yaml_path, str(key), _text(value)) for key, value in metadata.items()
+    ])
+
+
+def build_catalog(yaml_dir, catalog_path=None):
+    """
+    Index every FluentControl yaml log below a directory. Logs already indexed with the same size and modification
+    time are not read again, and logs that disappeared are dropped from the catalog.
+    :param yaml_dir: directory of FluentControl yaml log files, searched recursively
+    :param catalog_path: file path of the sqlite catalog, defaults to CATALOG_PATH
+    :return: dictionary of the number of added, updated, unchanged, removed and failed logs
+    """
+    counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0, 'failed': 0}
+    connection = connect(catalog_path)
+    try:
+        root = str(Path(yaml_dir).resolve())
+        # Only logs inside the directory, not those of a sibling sharing its name as a prefix, e.g. logs2 of logs
+        prefix = os.path.join(root, '')
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in connection.execute(
+            'SELECT yaml_path, size, mtime_ns FROM runs WHERE substr(yaml_path, 1, ?) = ?', (len(prefix), prefix))}
+        seen = set()
+        for folder, _, filenames in os.walk(root):
+            for name in filenames:
+                if not name.lower().endswith('.yaml'):
+                    continue
+                yaml_path = os.path.join(folder, name)
+                seen.add(yaml_path)
+                stat = os.stat(yaml_path)
+                if known.get(yaml_path) == (stat.st_size, stat.st_mtime_ns):
+                    counts['unchanged'] += 1
+                    continue
+                try:
+                    yaml_dict = load_yaml(yaml_path)
+                    if not isinstance(yaml_dict, dict):
+                        raise ValueError("not a FluentControl log")
+                except (yaml.YAMLError, ValueError, UnicodeDecodeError):
+                    counts['failed'] += 1
+                    continue
+                _index_run(connection, yaml_path, stat, yaml_dict)
+                counts['updated' if yaml_path in known else 'added'] += 1
+        removed = [(path,) for path in known if path not in seen]
+        connection.executemany('DELETE FROM runs WHERE yaml_path = ?', removed)
+        counts['removed'] = len(removed)
+        connection.commit()
+    finally:
+        connection.close()
+    return counts
+
+
+def find_runs(catalog_path=None, plate=None, protocol=None, since=None, until=None, **metadata):
+    """
+    Query the run catalog
+    :param catalog_path: file path of the sqlite catalog, defaults to CATALOG_PATH
+    :param plate: input or output plate barcode the run touched, e.g. 2065-UOX-0001
+    :param protocol: protocol name
+    :param since: earliest start, e.g. 2024-09-01
+    :param until: latest start, e.g. 2024-09-30_23-59-59
+    :param metadata: Metadata entries the run must have, with spaces in keys written as underscores,
+    e.g. Interferent='Yes'
+    :return: pandas dataframe of the matching runs, one row per run, with input and output plates comma separated
+    """
+    clauses = []
+    params = []
+    if plate is not None:
+        clauses.append('r.yaml_path IN (SELECT yaml_path FROM plates WHERE plate = ?)')
+        params.append(plate)
+    if protocol is not None:
+        clauses.append('r.protocol_name = ?')
+        params.append(protocol)
+    if since is not None:
+        clauses.append('r.start >= ?')
+        params.append(since)
+    if until is not None:
+        clauses.append('r.start <= ?')
+        params.append(until)
+    for key, value in metadata.items():
+        clauses.append('r.yaml_path IN (SELECT yaml_path FROM metadata WHERE key = ? AND value = ?)')
+        params += [key.replace('_', ' '), _text(value)]
+
+    query = f"""
+        SELECT r.start, r.end, r.user, r.protocol_name, r.protocol_version,
+               (SELECT group_concat(plate, ',') FROM plates p WHERE p.yaml_path = r.yaml_path AND role = 'input')
+                   AS input_plates,
+               (SELECT group_concat(plate, ',') FROM plates p WHERE p.yaml_path = r.yaml_path AND role = 'output')
+                   AS output_plates,
+               r.metadata, r.yaml_path
+        FROM runs r
+        {'WHERE ' + ' AND '.join(clauses) if clauses else ''}
+        ORDER BY r.start
+    """
+    connection = connect(catalog_path)
+    try:
+        return pd.read_sql_query(query, connection, params=params)
+    finally:
+        connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index FluentControl yaml logs and look up runs")
+    parser.add_argument('--catalog', default=None, help="sqlite catalog file (default: $UOX_RUN_CATALOG)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="index the yaml logs below a directory")
+    build.add_argument('yaml_dir', help="folder of FluentControl yaml log files")
+    lookup = commands.add_parser('find', help="list the runs matching all given filters")
+    lookup.add_argument('--plate', default=None, help="input or output plate barcode")
+    lookup.add_argument('--protocol', default=None, help="protocol name")
+    lookup.add_argument('--since', default=None, help="earliest run start, e.g. 2024-09-01")
+    lookup.add_argument('--until', default=None, help="latest run start")
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        counts = build_catalog(args.yaml_dir, args.catalog)
+        print(', '.join(f'{count} {name}' for name, count in counts.items()))
+    else:
+        runs = find_runs(args.catalog, plate=args.plate, protocol=args.protocol, since=args.since, until=args.until)
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(runs.drop(columns=['metadata']).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import hashlib
+import importlib.util
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+# Persistent record of the inputs and code each stage of each run was last produced from, unset means no ledger
+LEDGER_PATH = Path(os.environ.get('UOX_RUN_LEDGER', Path.home() / '.cache' / 'UricaseActivityAssay' / 'ledger.sqlite'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    run_key TEXT,
+    stage TEXT,
+    fingerprint TEXT,
+    outputs TEXT,
+    finished TEXT,
+    PRIMARY KEY (run_key, stage)
+);
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha256 TEXT
+);
+"""
+
+
+def code_version(module_names):
+    """
+    Hash of the source files of the modules a stage runs, so any code change invalidates the stage
+    :param module_names: list of module names, e.g. ['TecanAscii', 'KineticFits']
+    :return: hex sha256
+    """
+    digest = hashlib.sha256()
+    for name in module_names:
+        spec = importlib.util.find_spec(name)
+        digest.update(name.encode())
+        if spec is not None and spec.origin and os.path.isfile(spec.origin):
+            digest.update(Path(spec.origin).read_bytes())
+    return digest.hexdigest()
+
+
+class RunLedger:
+    """
+    Ledger of the stages of every analysed run. A stage is recorded with a fingerprint of its input file contents, its
+    code and its parameters, and is only redone when the fingerprint changes or its output files disappear.
+    """
+
+    def __init__(self, ledger_path=None):
+        self.ledger_path = Path(ledger_path or LEDGER_PATH)
+        os.makedirs(self.ledger_path.parent, exist_ok=True)
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # Batch workers share the ledger, wait for each other's writes rather than failing
+        connection = sqlite3.connect(self.ledger_path, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def file_hash(self, path):
+        """
+        Content hash of a file, re-read only when its size or modification time changed
+        :param path: file path
+        :return: hex sha256 of the file contents
+        """
+        path = str(Path(path).resolve())
+        stat = os.stat(path)
+        with self._connect() as connection:
+            row = connection.execute('SELECT size, mtime_ns, sha256 FROM file_hashes WHERE path = ?',
+                                     (path,)).fetchone()
+            if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+                return row[2]
+            digest = hashlib.sha256()
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+            connection.execute('INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)',
+                               (path, stat.st_size, stat.st_mtime_ns, digest.hexdigest()))
+        return digest.hexdigest()
+
+    def fingerprint(self, input_paths, module_names=(), params=None):
+        """
+        :param input_paths: list of input file paths
+        :param module_names: list of the modules the stage runs
+        :param params: json serialisable parameters of the stage
+        :return: hex sha256 over the input contents, code and parameters
+        """
+        digest = hashlib.sha256()
+        for path in input_paths:
+            digest.update(self.file_hash(path).encode())
+        digest.update(code_version(module_names).encode())
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def lookup(self, run_key, stage):
+        """
+        :param run_key: run identifier, e.g. uox:2065-UOX-0001:2024-09-05_12-34-53
+        :param stage: stage name
+        :return: dictionary of the fingerprint, outputs and paths of the last time the stage ran, or None
+        """
+        with self._connect() as connection:
+            row = connection.execute('SELECT fingerprint, outputs FROM stages WHERE run_key = ? AND stage = ?',
+                                     (run_key, stage)).fetchone()
+        if row is None:
+            return None
+        return {'fingerprint': row[0], **json.loads(row[1])}
+
+    def current(self, run_key, stage, fingerprint):
+        """
+        :param run_key: run identifier
+        :param stage: stage name
+        :param fingerprint: fingerprint of the stage's current inputs
+        :return: the recorded outputs if the stage ran with the same fingerprint and its output files still exist,
+        otherwise None
+        """
+        record = self.lookup(run_key, stage)
+        if record is None or record['fingerprint'] != fingerprint:
+            return None
+        if not all(os.path.exists(path) for path in record['paths']):
+            return None
+        return record['outputs']
+
+    def record(self, run_key, stage, fingerprint, outputs=None, paths=()):
+        """
+        :param run_key: run identifier
+        :param stage: stage name
+        :param fingerprint: fingerprint of the inputs the stage ran with
+        :param outputs: json serialisable outputs of the stage
+        :param paths: output file paths that have to exist for the stage to stay current
+        :return:
+        """
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)', (
+                run_key, stage, fingerprint, json.dumps({'outputs': outputs or {}, 'paths': [str(p) for p in paths]}),
+                datetime.now().isoformat(timespec='seconds')
+            ))
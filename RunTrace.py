@@ -0,0 +1,231 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# 'json' writes a trace next to the outputs of every run, 'chrome' also a Chrome trace format file, 'off' none
+TRACE_FORMAT = os.environ.get('UOX_TRACE', 'json').lower()
+
+# Trace of the analysis running in this context, spans outside of a traced call are not recorded. Each thread has its
+# own context, a worker thread records into the trace of a run when its task is submitted with in_context.
+_active = contextvars.ContextVar('active_trace', default=None)
+
+
+def _peak_rss():
+    """
+    :return: peak resident memory of the process in bytes so far, None where it can not be read
+    """
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if psutil is not None:
+        return getattr(psutil.Process().memory_info(), 'peak_wset', None)
+    return None
+
+
+def _io_bytes():
+    """
+    :return: tuple of the bytes the process read and wrote so far, through any file system including network shares,
+    (None, None) where the counters can not be read
+    """
+    try:
+        with open('/proc/self/io', 'rb') as file:
+            counters = dict(line.split(b':') for line in file.read().splitlines())
+        return int(counters[b'rchar']), int(counters[b'wchar'])
+    except (OSError, KeyError, ValueError):
+        pass
+    if psutil is not None:
+        counters = psutil.Process().io_counters()
+        return (getattr(counters, 'read_chars', counters.read_bytes),
+                getattr(counters, 'write_chars', counters.write_bytes))
+    return None, None
+
+
+def _delta(after, before):
+    return None if after is None or before is None else after - before
+
+
+class RunTrace:
+    """
+    Timeline of the stages and requests of one run. Every span records its wall time, the CPU time of its thread,
+    the bytes the process read and wrote, and the peak resident memory of the process at its end. Reading the
+    counters costs a few microseconds per span, so tracing is left on.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = datetime.now()
+        self.directory = None
+        self.events = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, category='stage', **args):
+        """
+        Record a span. The yielded dictionary of args can be added to inside the span, e.g. with a status code.
+        :param name: span name, e.g. 'read_ascii' or 'POST /api/v1/attachments'
+        :param category: span category, e.g. 'stage', 'labguru' or 'http'
+        :param args: extra json serialisable details of the span
+        :return:
+        """
+        read_before, written_before = _io_bytes()
+        peak_before = _peak_rss()
+        cpu_before = time.thread_time()
+        start = time.perf_counter()
+        try:
+            yield args
+        except BaseException as e:
+            args['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.thread_time() - cpu_before
+            read_after, written_after = _io_bytes()
+            peak_after = _peak_rss()
+            event = {
+                'name': name,
+                'category': category,
+                'thread': threading.current_thread().name,
+                'start': round(start - self._origin, 6),
+                'wall': round(wall, 6),
+                'cpu': round(cpu, 6),
+                'read_bytes': _delta(read_after, read_before),
+                'written_bytes': _delta(written_after, written_before),
+                'peak_rss': peak_after,
+                'peak_rss_growth': _delta(peak_after, peak_before),
+                'args': args
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def summary(self):
+        """
+        :return: dictionary of span name to the number of spans and their total wall and CPU time
+        """
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(event['name'], {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+            total['count'] += 1
+            total['wall'] += event['wall']
+            total['cpu'] += event['cpu']
+        return totals
+
+    def save(self, path, chrome=False):
+        """
+        Write the trace as json, and optionally in Chrome trace format next to it (open in chrome://tracing or
+        ui.perfetto.dev)
+        :param path: file path of the json trace
+        :param chrome: if True, also write <stem>.chrome.json
+        :return: list of the written file paths
+        """
+        path = Path(path)
+        trace = {'name': self.name, 'started': self.started.isoformat(timespec='seconds'), 'pid': os.getpid(),
+                 'summary': self.summary(), 'events': sorted(self.events, key=lambda event: event['start'])}
+        paths = [path]
+        with open(path, 'w') as file:
+            json.dump(trace, file, indent=1, default=str)
+        if chrome:
+            threads = {name: i for i, name in enumerate(dict.fromkeys(event['thread'] for event in trace['events']))}
+            chrome_events = [{
+                'name': event['name'], 'cat': event['category'], 'ph': 'X', 'pid': os.getpid(),
+                'tid': threads[event['thread']], 'ts': round(event['start'] * 1e6), 'dur': round(event['wall'] * 1e6),
+                'args': {key: event[key] for key in ('cpu', 'read_bytes', 'written_bytes', 'peak_rss')} | event['args']
+            } for event in trace['events']]
+            chrome_events += [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                              for name, tid in threads.items()]
+            paths.append(path.with_name(f'{path.stem}.chrome.json'))
+            with open(paths[-1], 'w') as file:
+                json.dump({'traceEvents': chrome_events, 'displayTimeUnit': 'ms'}, file, default=str)
+        return paths
+
+
+@contextmanager
+def span(name, category='stage', **args):
+    """
+    Record a span in the active trace, does nothing outside of a traced call
+    :param name: span name
+    :param category: span category
+    :param args: extra json serialisable details of the span
+    :return:
+    """
+    trace = _active.get()
+    if trace is None:
+        yield args
+        return
+    with trace.span(name, category, **args) as span_args:
+        yield span_args
+
+
+def trace_to(directory):
+    """
+    Set the folder the active trace is written to when its traced call returns
+    :param directory: run folder
+    :return:
+    """
+    trace = _active.get()
+    if trace is not None:
+        trace.directory = Path(directory)
+
+
+def discard_trace():
+    """
+    Leave the trace of the active traced call unwritten, so a call that found nothing to do, e.g. a rerun whose stages
+    are all up to date, does not replace the trace of the last call that did the work
+    :return:
+    """
+    trace = _active.get()
+    if trace is not None:
+        trace.directory = None
+
+
+def in_context(function):
+    """
+    Bind a function to a copy of the calling thread's context, so spans it opens in a worker thread are recorded in
+    the trace of the run that submitted it
+    :param function: callable to run in another thread
+    :return: callable running function in the copied context
+    """
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+def traced(file_name):
+    """
+    Decorator tracing every call of an analysis entry point. The trace is written to file_name in the folder given to
+    trace_to, also when the call fails. Calls made inside an already traced call add to its trace.
+    :param file_name: file name of the json trace, e.g. 'AnalysisTrace.json'
+    :return: decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if TRACE_FORMAT == 'off' or _active.get() is not None:
+                return function(*args, **kwargs)
+            trace = RunTrace(function.__module__ + '.' + function.__qualname__)
+            token = _active.set(trace)
+            try:
+                with trace.span(function.__name__, 'run'):
+                    return function(*args, **kwargs)
+            finally:
+                _active.reset(token)
+                if trace.directory is not None:
+                    try:
+                        trace.save(trace.directory / file_name, chrome=TRACE_FORMAT == 'chrome')
+                    except OSError:
+                        pass
+        return wrapper
+    return decorator
@@ -0,0 +1,236 @@
+import argparse
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ResultsStore import STORE_DIR, partition_files, read_partition
+
+# Kinetic fit of a well taken as its uricase activity, negated so uric acid consumption is positive
+ACTIVITY_METRIC = 'Initial Velocity (A292/min)'
+# yaml Metadata entries of the Uox assay: the fold dilution of the source sample and the µL of it added to the assay
+ASSAY_DILUTION = 'Assay Sample Dilution Factor'
+ASSAY_VOLUME = 'Assay Sample Volume'
+# yaml Metadata entry of the fold dilution of the source sample in the Pierce quantification
+PIERCE_DILUTION = 'Dilution Factor'
+# Tables of the results dataset the index is built from
+INDEXED_TABLES = ['pierce', 'metrics', 'conditions']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS partitions (
+    path TEXT PRIMARY KEY,
+    tbl TEXT,
+    experiment_id INTEGER,
+    run_start TEXT,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS pierce (
+    path TEXT REFERENCES partitions(path) ON DELETE CASCADE,
+    run_start TEXT,
+    plate TEXT,
+    well TEXT,
+    sample TEXT,
+    concentration REAL
+);
+CREATE TABLE IF NOT EXISTS activity (
+    path TEXT REFERENCES partitions(path) ON DELETE CASCADE,
+    experiment_id INTEGER,
+    run_start TEXT,
+    plate TEXT,
+    well TEXT,
+    activity REAL
+);
+CREATE TABLE IF NOT EXISTS conditions (
+    path TEXT REFERENCES partitions(path) ON DELETE CASCADE,
+    experiment_id INTEGER,
+    run_start TEXT,
+    plate TEXT,
+    assay TEXT,
+    key TEXT,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS pierce_well ON pierce(plate, well);
+CREATE INDEX IF NOT EXISTS activity_well ON activity(plate, well);
+CREATE INDEX IF NOT EXISTS conditions_run ON conditions(experiment_id, run_start);
+"""
+
+
+def index_path(store_dir):
+    """
+    :param store_dir: root directory of the results dataset
+    :return: file path of the specific activity index of the dataset, kept next to its tables
+    """
+    return Path(store_dir) / 'specific_activity.sqlite'
+
+
+def connect(store_dir):
+    """
+    Open the specific activity index of a results dataset, creating it if needed
+    :param store_dir: root directory of the results dataset
+    :return: sqlite3 connection
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    # Batch workers may update the index together, wait for each other's writes rather than failing
+    connection = sqlite3.connect(index_path(store_dir), timeout=60)
+    connection.execute('PRAGMA foreign_keys = ON')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _index_partition(connection, table, experiment_id, run_start, path):
+    """
+    Replace the index rows of one partition of the results dataset
+    """
+    connection.execute('DELETE FROM partitions WHERE path = ?', (str(path),))
+    stat = os.stat(path)
+    connection.execute('INSERT INTO partitions VALUES (?, ?, ?, ?, ?, ?)',
+                       (str(path), table, experiment_id, run_start, stat.st_size, stat.st_mtime_ns))
+    df = read_partition(path, table)
+    if table == 'pierce':
+        rows = zip(df['plate'], df['well'], df['sample'], df['value'])
+        connection.executemany('INSERT INTO pierce VALUES (?, ?, ?, ?, ?, ?)', [
+            (str(path), run_start, plate, well, None if pd.isna(sample) else sample, None if np.isnan(value) else value)
+            for plate, well, sample, value in rows
+        ])
+    elif table == 'metrics':
+        df = df[(df['level'] == 'well') & (df['metric'] == ACTIVITY_METRIC)]
+        connection.executemany('INSERT INTO activity VALUES (?, ?, ?, ?, ?, ?)', [
+            (str(path), experiment_id, run_start, plate, well, None if np.isnan(value) else -value)
+            for plate, well, value in zip(df['plate'], df['name'], df['value'])
+        ])
+    else:
+        connection.executemany('INSERT INTO conditions VALUES (?, ?, ?, ?, ?, ?, ?)', [
+            (str(path), experiment_id, run_start, plate, assay, key, value)
+            for plate, assay, key, value in zip(df['plate'], df['assay'], df['key'], df['value'])
+        ])
+
+
+def update_index(store_dir):
+    """
+    Bring the specific activity index up to date with the results dataset. Only partitions written since the last
+    update are read, and partitions that disappeared are dropped from the index.
+    :param store_dir: root directory of the results dataset
+    :return: dictionary of the number of added, updated, unchanged and removed partitions
+    """
+    counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+    connection = connect(store_dir)
+    try:
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in connection.execute(
+            'SELECT path, size, mtime_ns FROM partitions')}
+        seen = set()
+        for table in INDEXED_TABLES:
+            for experiment_id, run_start, path in partition_files(store_dir, table):
+                seen.add(str(path))
+                stat = os.stat(path)
+                if known.get(str(path)) == (stat.st_size, stat.st_mtime_ns):
+                    counts['unchanged'] += 1
+                    continue
+                _index_partition(connection, table, experiment_id, run_start, path)
+                counts['updated' if str(path) in known else 'added'] += 1
+        removed = [(path,) for path in known if path not in seen]
+        connection.executemany('DELETE FROM partitions WHERE path = ?', removed)
+        counts['removed'] = len(removed)
+        connection.commit()
+    finally:
+        connection.close()
+    return counts
+
+
+def _run_condition(conditions, assay, key):
+    """
+    :return: dataframe of one condition of every run of an assay, with plate, run_start and the key as columns
+    """
+    rows = conditions[(conditions['assay'] == assay) & (conditions['key'] == key)]
+    return rows[['plate', 'run_start', 'value']].rename(columns={'value': key})
+
+
+def specific_activity(store_dir, plate=None, update=True):
+    """
+    Join the protein concentration of every well of the Pierce runs with the uricase activity of the same source plate
+    well in every Uox run of the results dataset, in one vectorized pass over the whole index. Where a plate was
+    quantified more than once the latest Pierce run is used. The Pierce concentrations are already corrected for the
+    Pierce dilution factor when they are appended, the protein added to an assay well is the concentration divided by
+    the assay sample dilution factor times the assay sample volume.
+    :param store_dir: root directory of the results dataset
+    :param plate: plate barcode, or list of barcodes, to join, defaults to every plate
+    :param update: if True, first index the runs appended since the last update
+    :return: tuple of dataframes of the specific activity of every well of every Uox run and of every sample
+    """
+    if update:
+        update_index(store_dir)
+    connection = connect(store_dir)
+    try:
+        pierce = pd.read_sql_query('SELECT run_start, plate, well, sample, concentration FROM pierce', connection)
+        activity = pd.read_sql_query('SELECT experiment_id, run_start, plate, well, activity FROM activity',
+                                     connection)
+        conditions = pd.read_sql_query('SELECT run_start, plate, assay, key, value FROM conditions', connection)
+    finally:
+        connection.close()
+    if plate is not None:
+        plates = list(np.atleast_1d(plate))
+        pierce = pierce[pierce['plate'].isin(plates)]
+        activity = activity[activity['plate'].isin(plates)]
+
+    # Latest Pierce quantification of every source plate well
+    pierce = pierce.merge(_run_condition(conditions, 'pierce', PIERCE_DILUTION), on=['plate', 'run_start'], how='left')
+    pierce = (pierce.sort_values('run_start', kind='stable').drop_duplicates(['plate', 'well'], keep='last')
+              .rename(columns={'run_start': 'pierce_run_start', 'concentration': 'Protein Concentration (mg/mL)',
+                               PIERCE_DILUTION: 'Pierce Dilution Factor'}))
+    for key in [ASSAY_DILUTION, ASSAY_VOLUME]:
+        activity = activity.merge(_run_condition(conditions, 'uox', key), on=['plate', 'run_start'], how='left')
+    wells = activity.merge(pierce, on=['plate', 'well'], how='inner').rename(columns={
+        'activity': 'Activity (A292/min)', ASSAY_DILUTION: 'Assay Sample Dilution Factor',
+        ASSAY_VOLUME: 'Assay Sample Volume (uL)'})
+
+    protein = (wells['Protein Concentration (mg/mL)'].to_numpy(dtype=np.float64) /
+               wells['Assay Sample Dilution Factor'].to_numpy(dtype=np.float64) *
+               wells['Assay Sample Volume (uL)'].to_numpy(dtype=np.float64) / 1000)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wells['Assay Protein (mg)'] = protein
+        wells['Specific Activity (A292/min/mg)'] = np.where(
+            protein > 0, wells['Activity (A292/min)'].to_numpy(dtype=np.float64) / protein, np.nan)
+    wells = wells.sort_values(['plate', 'run_start'], kind='stable').reset_index(drop=True)
+
+    samples = (wells.dropna(subset=['sample'])
+               .groupby(['sample'], sort=True)['Specific Activity (A292/min/mg)']
+               .agg(['mean', 'std', 'count', 'median'])
+               .rename(columns={'mean': 'Mean Specific Activity (A292/min/mg)',
+                                'std': 'SD Specific Activity (A292/min/mg)', 'count': 'Wells',
+                                'median': 'Median Specific Activity (A292/min/mg)'}))
+    samples['Plates'] = wells.dropna(subset=['sample']).groupby('sample')['plate'].nunique()
+    return wells, samples.reset_index().rename(columns={'sample': 'Sample Name'})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Specific activity of every sample quantified by Pierce and assayed "
+                                                 "for uricase activity")
+    parser.add_argument('--store', default=STORE_DIR, help="results dataset (default: $UOX_RESULTS_STORE)")
+    parser.add_argument('--plate', nargs='+', default=None, help="only join these plates")
+    parser.add_argument('-o', '--output', default=None, help="write the well and sample tables to this xlsx file")
+    args = parser.parse_args(argv)
+    if not args.store:
+        parser.error("no results dataset given and UOX_RESULTS_STORE is not set")
+
+    start = time.perf_counter()
+    counts = update_index(args.store)
+    print(f"Index: {', '.join(f'{count} {name}' for name, count in counts.items())} partitions "
+          f"in {time.perf_counter() - start:.2f}s")
+    start = time.perf_counter()
+    wells, samples = specific_activity(args.store, args.plate, update=False)
+    print(f"Joined {len(wells)} wells of {wells['plate'].nunique()} plates into {len(samples)} samples "
+          f"in {time.perf_counter() - start:.2f}s")
+    with pd.option_context('display.max_rows', 50, 'display.width', 200):
+        print(samples.to_string(index=False))
+    if args.output:
+        with pd.ExcelWriter(args.output) as writer:
+            samples.to_excel(writer, sheet_name='Samples', index=False)
+            wells.to_excel(writer, sheet_name='Wells', index=False)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import pickle
+import time
+from pathlib import Path
+
+from RunTrace import span
+
+# Outputs of the analysis stages are cached here, keyed by the content of everything upstream of the stage
+CACHE_DIR = Path(os.environ.get('UOX_STAGE_CACHE', Path.home() / '.cache' / 'UricaseActivityAssay' / 'stages'))
+# Least recently used entries are evicted once the cache grows past this size
+MAX_BYTES = int(os.environ.get('UOX_STAGE_CACHE_BYTES', 2 * 1024 ** 3))
+
+
+class StageCache:
+    """
+    Size-bounded on-disk cache of pipeline stage outputs, stored as pickles. An entry is keyed by the stage name, the
+    stage version and the keys of its upstream entries (or the content hashes of its input files), so a changed input
+    or stage code only invalidates the stages downstream of it.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = Path(cache_dir or CACHE_DIR)
+        self.max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(stage, version, upstream):
+        """
+        :param stage: stage name, e.g. 'remove_background'
+        :param version: stage version, the RunLedger.code_version of the modules the stage runs
+        :param upstream: list of the keys of the upstream entries or the content hashes of the input files
+        :return: hex sha256 key of the entry
+        """
+        return hashlib.sha256('\n'.join([stage, str(version), *upstream]).encode()).hexdigest()
+
+    def _path(self, stage, key):
+        return self.cache_dir / f'{stage}-{key}.pkl'
+
+    def get(self, stage, key):
+        """
+        :param stage: stage name
+        :param key: entry key
+        :return: the cached stage output, raises KeyError if there is none or it cannot be loaded
+        """
+        path = self._path(stage, key)
+        try:
+            with open(path, 'rb') as file:
+                value = pickle.load(file)
+        except FileNotFoundError:
+            raise KeyError(key) from None
+        except Exception:
+            # Truncated, or pickled by code whose classes have since changed, drop it so the stage runs again
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            raise KeyError(key) from None
+        self._touch(path)
+        return value
+
+    @staticmethod
+    def _touch(path):
+        # The modification time orders the entries for eviction, set at full resolution as the file system clock can
+        # be too coarse to order entries used in quick succession
+        now = time.time_ns()
+        try:
+            os.utime(path, ns=(now, now))
+        except OSError:
+            pass
+
+    def put(self, stage, key, value):
+        """
+        Store a stage output, then evict the least recently used entries past max_bytes
+        :param stage: stage name
+        :param key: entry key
+        :param value: picklable stage output
+        :return:
+        """
+        path = self._path(stage, key)
+        try:
+            # Write to a temporary name first so parallel workers never read a partial file
+            tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as file:
+                pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        self._touch(path)
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache fits in max_bytes
+        :return: number of deleted entries
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        deleted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            deleted += 1
+        return deleted
+
+
+def run_stage(cache, stage, version, upstream, function, *args):
+    """
+    Return the cached output of a stage, or run it and cache the output
+    :param cache: StageCache, None to always run the stage
+    :param stage: stage name
+    :param version: stage version, the RunLedger.code_version of the modules the stage runs
+    :param upstream: list of the keys of the upstream entries or the content hashes of the input files
+    :param function: stage function
+    :param args: arguments of the stage function
+    :return: tuple of the stage output and its key, the key is None without a cache
+    """
+    with span(stage, cached=False) as details:
+        if cache is None:
+            return function(*args), None
+        key = cache.key(stage, version, upstream)
+        try:
+            value = cache.get(stage, key)
+            details['cached'] = True
+            return value, key
+        except KeyError:
+            value = function(*args)
+            cache.put(stage, key, value)
+            return value, key
@@ -0,0 +1,268 @@
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from PlateGeometry import GEOMETRIES, PLATE_96
+from PierceStandardCurve import STANDARD_CONCENTRATIONS, STANDARD_COLUMNS
+from PlateLayout import PIERCE_SAMPLE_COLUMNS
+
+# Plate descriptions of the trailer, by number of wells
+PLATE_DESCRIPTIONS = {
+    96: '[NUN96fw_LumiNunc FluoroNunc] - Thermo Fisher Scientific-Nunclon 96 Flat White',
+    384: '[GRE384fw] - Greiner 384 Flat White',
+    1536: '[GRE1536fw] - Greiner 1536 Flat White',
+}
+# Pierce 660 absorbance of the BSA standards, 4 parameter logistic (bottom, hill slope, ec50, top)
+PIERCE_CURVE = (0.11, 1.05, 2.4, 3.1)
+# Wells per sample of the Uox plate maps, and the number of samples at the start of the plate that are controls
+REPLICATES = 2
+N_CONTROLS = 2
+
+
+def _number(value):
+    return 'OVER' if np.isnan(value) else f'{value:.5g}'
+
+
+def _rows(values):
+    return [','.join(_number(v) for v in row) + ',' for row in np.atleast_2d(values)]
+
+
+def write_ascii(path, values, relative_time, temperature, measured_at, geometry=PLATE_96, labels=('Absorbance',),
+                wavelengths=(292,), calculated=None, calculated_name='Single conc. (mg/mL)', kinetic_interval=None):
+    """
+    Write reads in the Magellan ascii export format: UTF-16 with CRLF line ends, a 'Raw data' block of one row per
+    kinetic cycle, then the measurement trailer.
+    :param path: output file path
+    :param values: float array of reads, (cycles x wells) or (labels x cycles x wells), NaN is written as OVER
+    :param relative_time: float array of the relative time of each cycle in seconds
+    :param temperature: float array of the temperature of each cycle in °C
+    :param measured_at: datetime of the measurement
+    :param geometry: PlateGeometry of the plate, the read covers the whole plate
+    :param labels: measurement label names, one per leading slice of a 3D values array
+    :param wavelengths: measurement wavelength in nm of each label
+    :param calculated: optional float array of one row per well calculated by the method, e.g. concentrations
+    :param calculated_name: title line of the calculated rows
+    :param kinetic_interval: seconds between kinetic cycles, None for an endpoint read
+    :return: path
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    if values.ndim == 2:
+        values = values[np.newaxis]
+    lines = []
+    for label_values in values:
+        lines.append('Raw data')
+        if calculated is not None:
+            lines.append(calculated_name)
+        lines += [f'{time:.0f}s,{temp:.1f} °C,' + row
+                  for time, temp, row in zip(relative_time, temperature, _rows(label_values))]
+        if calculated is not None:
+            lines += [',,' + row for row in _rows(calculated)]
+
+    last = geometry.row_names()[-1] + str(geometry.n_columns)
+    lines += [
+        f"Date of measurement: {measured_at:%Y-%m-%d}/Time of measurement: {measured_at:%H:%M:%S}",
+        f'{Path(path).stem}.mth',
+        rf'C:\Users\Public\Documents\Tecan\Magellan Pro\mth\{Path(path).stem}.mth',
+        f'{Path(path).stem}.wsp',
+        rf'C:\USERS\TECAN\DESKTOP\DATA FILES\{Path(path).stem}.wsp',
+        f'{wavelengths[0]}nm',
+        'Unknown user',
+        'infinite 200Pro',
+        'Instrument serial number: 0000000000',
+        'Plate',
+        f"Plate Description: {PLATE_DESCRIPTIONS.get(geometry.n_wells, f'{geometry.n_wells} well plate')}",
+        'Plate with Cover: No',
+        'Barcode: No',
+        '  Part of Plate',
+        f'  Range: A1:{last}',
+        '    Temperature',
+        '    Mode: On',
+        f'    Temperature: {np.nanmean(temperature):.1f} °C',
+    ]
+    indent = '    '
+    if kinetic_interval:
+        total = timedelta(seconds=int(kinetic_interval * len(relative_time)))
+        lines += ['    Kinetic Cycle', f'    Duration: {str(total).zfill(8)}',
+                  f'    Kinetic Interval: {str(timedelta(seconds=int(kinetic_interval))).zfill(8)}']
+        indent = '      '
+    for label, wavelength in zip(labels, wavelengths):
+        lines += [f'{indent}Absorbance', f'{indent}Measurement Wavelength: {wavelength} nm',
+                  f'{indent}Measurement Bandwidth: 5 nm', f'{indent}Number of Reads: 15', f'{indent}Settle Time: 0 ms',
+                  f'{indent}Label: {label}']
+    lines.append('Barcode: Synthetic Plate')
+    if kinetic_interval:
+        seconds = int(relative_time[-1]) if len(relative_time) else 0
+        lines.append(f'Total kinetic run time: {seconds // 60}min {seconds % 60}s ')
+    else:
+        lines += [f'Meas. temperature: Raw data: {temperature[0]:.1f} °C',
+                  f'Date: {measured_at:%Y-%m-%d}, Time: {measured_at:%H:%M:%S}']
+    with open(path, 'wb') as file:
+        file.write(('\r\n'.join(lines) + '\r\n').encode('utf-16'))
+    return path
+
+
+def write_yaml(path, start, protocol, version, input_plates, output_plates, metadata, end):
+    """
+    Write a FluentControl yaml log
+    :return: path
+    """
+    log = {
+        'Start': f'{start:%Y-%m-%d_%H-%M-%S}',
+        'User': 'Synthetic User',
+        'Protocol': {'Name': protocol, 'Version': version},
+        'Input Plates': list(input_plates),
+        'Output Plates': list(output_plates) or None,
+        'Metadata': metadata,
+        'End': f'{end:%Y-%m-%d_%H-%M-%S}',
+    }
+    with open(path, 'w') as file:
+        yaml.safe_dump(log, file, sort_keys=False, default_flow_style=False, indent=4)
+    return path
+
+
+def write_platemap(path, well_names, replicates=REPLICATES, n_controls=N_CONTROLS, control='Negative'):
+    """
+    Write an xlsx plate map giving every group of replicates consecutive wells the same sample name
+    :param path: output file path
+    :param well_names: list of the well names to map
+    :param replicates: number of wells per sample
+    :param n_controls: number of samples marked as controls
+    :param control: Control? entry of the controls, 'Negative' for controls that consume no uric acid
+    :return: path
+    """
+    sample = np.arange(len(well_names)) // replicates
+    pd.DataFrame({
+        'Well Name': well_names,
+        'Sample Name': [f'Var{i}' for i in sample],
+        'Control?': np.where(sample < n_controls, control, None)
+    }).to_excel(path, index=False)
+    return path
+
+
+def uox_run(out_dir, n_wells=96, n_cycles=17, interval=54, n_labels=1, seed=0, start=datetime(2024, 9, 5, 12, 34, 53)):
+    """
+    Generate a Uox activity run: background and kinetic reads, FluentControl log and plate map. Each well holds a
+    first order decay of the uric acid absorbance with a random rate per sample, the controls are negative controls
+    and do not decay.
+    :param out_dir: run folder to write
+    :param n_wells: 96, 384 or 1536
+    :param n_cycles: number of kinetic cycles
+    :param interval: seconds between kinetic cycles
+    :param n_labels: number of measurement labels of the kinetic read, at 292 nm and 10 nm steps above
+    :param seed: random seed
+    :param start: run start
+    :return: run dictionary as read by BatchAnalysis
+    """
+    rng = np.random.default_rng(seed)
+    geometry = GEOMETRIES[n_wells]
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    plate = f'{2000 + seed % 1000:04d}-UOX-{seed % 10000:04d}'
+    stamp = f'{start:%y%m%d}'
+
+    background = rng.normal(0.55, 0.03, n_wells)
+    uric_acid = rng.normal(0.85, 0.05, n_wells)
+    # One rate per sample of the plate map, its replicate wells only differ by a few % of pipetting noise
+    sample = np.arange(n_wells) // REPLICATES
+    rate = rng.lognormal(np.log(8e-4), 0.8, sample[-1] + 1)
+    rate[:N_CONTROLS] = 0
+    rate = rate[sample] * rng.lognormal(0, 0.03, n_wells)
+    relative_time = np.arange(n_cycles) * float(interval)
+    decay = np.exp(-np.outer(relative_time, rate))
+    kinetic = np.stack([
+        background * scale + uric_acid * scale * decay + rng.normal(0, 0.004, (n_cycles, n_wells))
+        for scale in np.linspace(1, 0.6, n_labels)
+    ])
+
+    bg_start = start + timedelta(minutes=7, seconds=31)
+    kinetic_start = bg_start + timedelta(minutes=2, seconds=9)
+    metadata = {
+        'Lysis': False, 'Lysis Volume': 340, 'Lysate Type': 'Clarified', 'Assay Sample Dilution Factor': 1,
+        'Assay Sample Volume': 4, 'Uricase Sample Addition Timestamp': start + timedelta(minutes=1, seconds=21),
+        'Uric Acid Addition Timestamp': kinetic_start - timedelta(seconds=85)
+    }
+    paths = {
+        'background': write_ascii(out_dir / f'UoxBG_WCL-{stamp}-{2 * seed + 1:03d}.asc',
+                                  background + rng.normal(0, 0.004, n_wells), [0.0], rng.normal(37.2, 0.3, 1),
+                                  bg_start, geometry, labels=['BaseRead'], wavelengths=[292]),
+        'kinetic': write_ascii(out_dir / f'UoxKinetic_WCL-{stamp}-{2 * seed + 2:03d}.asc', kinetic, relative_time,
+                               rng.normal(37.2, 0.3, n_cycles), kinetic_start, geometry,
+                               labels=[f'UoxActivity{i or ""}' for i in range(n_labels)],
+                               wavelengths=[292 + 10 * i for i in range(n_labels)], kinetic_interval=interval),
+        'platemap': write_platemap(out_dir / 'platemap.xlsx', geometry.well_names()),
+        'yaml': write_yaml(out_dir / f'{start:%Y-%m-%d_%H-%M-%S}_Synthetic.yaml', start, 'HT Uricase Activity v2.0', 2,
+                           [plate], [], metadata, kinetic_start + timedelta(seconds=interval * n_cycles + 60)),
+    }
+    return {'type': 'uox', 'name': out_dir.name, **{key: str(path) for key, path in paths.items()}}
+
+
+def pierce_run(out_dir, n_plates=2, seed=0, start=datetime(2024, 10, 16, 11, 36, 9)):
+    """
+    Generate a Pierce run of 96 well reader plates with the standards in columns 1-3 and the samples in columns 4-9,
+    the Magellan concentrations in the calculated row and a plate map of the source plate
+    :param out_dir: run folder to write
+    :param n_plates: number of reader plates, even counts cover whole 96 well source plates
+    :param seed: random seed
+    :param start: run start
+    :return: run dictionary as read by BatchAnalysis
+    """
+    rng = np.random.default_rng(seed)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    bottom, slope, ec50, top = PIERCE_CURVE
+    rows, columns = PLATE_96.well_rows(), PLATE_96.well_columns()
+    plate = f'{2000 + seed % 1000:04d}-TST-{seed % 10000:04d}'
+
+    run = {'type': 'pierce', 'name': out_dir.name}
+    for i in range(n_plates):
+        concentration = rng.uniform(0.05, 1.8, PLATE_96.n_wells)
+        is_standard = np.isin(columns, STANDARD_COLUMNS)
+        concentration[is_standard] = STANDARD_CONCENTRATIONS[rows[is_standard]]
+        concentration[~is_standard & ~np.isin(columns, PIERCE_SAMPLE_COLUMNS)] = 0
+        absorbance = top + (bottom - top) / (1 + (concentration / ec50) ** slope)
+        absorbance += rng.normal(0, 0.004, PLATE_96.n_wells)
+        measured_at = start + timedelta(days=1, hours=2, minutes=10 + i)
+        path = write_ascii(out_dir / f'PierceData-{measured_at:%y%m%d}-{i + 1:03d}.asc', absorbance, [0.0],
+                           rng.normal(25.4, 0.2, 1), measured_at, PLATE_96, labels=['OD600 Read'], wavelengths=[660],
+                           calculated=np.maximum(concentration + rng.normal(0, 0.01, PLATE_96.n_wells), 0))
+        run[f'pierce{i + 1}'] = str(path)
+    # The default layout puts plates beyond the second on the next row band of a 384 well source plate
+    source = PLATE_96 if n_plates <= 2 else GEOMETRIES[384]
+    run['platemap'] = str(write_platemap(out_dir / 'platemap.xlsx', source.well_names(), replicates=1, n_controls=0))
+    run['yaml'] = str(write_yaml(out_dir / f'{start:%Y-%m-%d_%H-%M-%S}_Synthetic.yaml', start,
+                                 'Pierce 660 Full Plate v1.0', 1, [plate],
+                                 [f'{plate[:4]}-PRC-{i + 1:04d}' for i in range(n_plates)],
+                                 {'Source Plate Type': 'PCR', 'Dilution Factor': 2, 'Interferent': 'No'},
+                                 start + timedelta(minutes=11, seconds=15)))
+    return run
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic Uox activity and Pierce runs")
+    parser.add_argument('out_dir', help="folder to write one run folder per generated run into")
+    parser.add_argument('--uox', type=int, default=1, help="number of Uox activity runs")
+    parser.add_argument('--pierce', type=int, default=0, help="number of Pierce runs")
+    parser.add_argument('--wells', type=int, choices=sorted(GEOMETRIES), default=96, help="wells per Uox plate")
+    parser.add_argument('--cycles', type=int, default=17, help="kinetic cycles per Uox run")
+    parser.add_argument('--labels', type=int, default=1, help="measurement labels per kinetic read")
+    parser.add_argument('--pierce-plates', type=int, default=2, help="reader plates per Pierce run")
+    parser.add_argument('--seed', type=int, default=0, help="random seed of the first run")
+    args = parser.parse_args(argv)
+
+    out_dir = Path(args.out_dir)
+    runs = [uox_run(out_dir / f'uox{i + 1}', args.wells, args.cycles, n_labels=args.labels, seed=args.seed + i)
+            for i in range(args.uox)]
+    runs += [pierce_run(out_dir / f'pierce{i + 1}', args.pierce_plates, seed=args.seed + i) for i in range(args.pierce)]
+    # Manifest for BatchAnalysis, paths relative to the output folder. Not named .yaml so folder discovery skips it.
+    with open(out_dir / 'manifest.yml', 'w') as file:
+        yaml.safe_dump([{key: str(Path(value).relative_to(out_dir)) if key not in ('type', 'name') else value
+                         for key, value in run.items()} for run in runs], file, sort_keys=False)
+    print(f"Wrote {len(runs)} runs to {out_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,467 @@
+import io
+import re
+from datetime import datetime
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from PlateGeometry import GEOMETRIES, PlateGeometry, infer_geometry, parse_well_names
+
+# Cell values Magellan writes in place of a number
+NA_VALUES = ['NoCalc', 'OVER', 'Invalid']
+# "54s,37.3 °C," prefix of a raw data row, reduced to "54,37.3,"
+FRAME_PREFIX = re.compile(r'^(-?\d+)s,\s*(-?[\d.]+)\s*°C,', re.MULTILINE)
+# "Range: A1:H12" trailer line of the measured part of the plate
+PLATE_RANGE = re.compile(r'Range:\s*([A-Z]+\d+)\s*:\s*([A-Z]+\d+)')
+# "Plate Description: [COS96ft] - Costar 96 Flat Transparent"
+PLATE_WELLS = re.compile(r'Plate Description:.*\b(96|384|1536)\b')
+# "Date of measurement: 2024-09-05/Time of measurement: 12:44:33" trailer line of the start of the read
+MEASUREMENT_TIME = re.compile(r'Date of measurement:\s*([\d-]+)/Time of measurement:\s*([\d:]+)')
+# Bytes of a results file parsed at a time when streaming its frames
+CHUNK_BYTES = 1 << 22
+
+
+class AsciiData(NamedTuple):
+    """
+    Numeric contents of a Tecan Plate Reader ascii results file
+    values: float array of raw reads, one row per kinetic cycle (frames x wells)
+    relative_time: float array of the relative time of each frame in seconds
+    temperature: float array of the temperature of each frame in °C
+    calculated: float array of rows calculated by the Magellan method (e.g. concentrations), NaN where not calculated
+    well_names: list of well names matching the columns of values
+    well_index: integer array of the plate well index of every column of values
+    geometry: PlateGeometry of the plate
+    """
+    values: np.ndarray
+    relative_time: np.ndarray
+    temperature: np.ndarray
+    calculated: np.ndarray
+    well_names: list
+    well_index: np.ndarray = None
+    geometry: PlateGeometry = None
+
+
+def plate_headers(n_rows=8, n_columns=12):
+    """
+    Build the well names of a plate in the column-major order used by the Magellan ascii export (A1, B1, ..., H12)
+    :param n_rows: number of plate rows
+    :param n_columns: number of plate columns
+    :return: list of well name strings
+    """
+    return PlateGeometry(n_rows, n_columns).well_names()
+
+
+def plate_wells(trailer, n_wells, geometry=None):
+    """
+    Work out the plate and the wells a read covers from the Range and Plate Description trailer lines. Reads without a
+    usable trailer are taken to cover a whole standard plate, or a plate of 8 rows.
+    :param trailer: trailer text of the ascii results file
+    :param n_wells: number of wells in the read
+    :param geometry: PlateGeometry of the plate, overrides the plate description
+    :return: tuple of the PlateGeometry and the integer array of the well index of every column of the read
+    """
+    range_match = PLATE_RANGE.search(trailer)
+    if range_match:
+        (first_row, last_row), (first_column, last_column) = parse_well_names(range_match.groups())
+        if geometry is None:
+            described = PLATE_WELLS.search(trailer)
+            geometry = GEOMETRIES[int(described.group(1))] if described else infer_geometry(range_match.groups())
+        # The read covers the range column by column
+        columns, rows = np.meshgrid(np.arange(first_column, last_column + 1), np.arange(first_row, last_row + 1),
+                                    indexing='ij')
+        well_index = geometry.index(rows.ravel(), columns.ravel())
+        if len(well_index) == n_wells and (well_index >= 0).all():
+            return geometry, well_index
+    if geometry is None:
+        geometry = GEOMETRIES.get(n_wells, PlateGeometry(8, n_wells // 8))
+    return geometry, np.arange(n_wells, dtype=np.intp)
+
+
+def _parse_block(lines):
+    """
+    Convert comma separated rows of numbers into a float array in a single pass of the pandas C parser
+    :param lines: list of row strings
+    :return: 2D float array with the trailing empty column removed
+    """
+    if not lines:
+        return np.empty((0, 0))
+    block = pd.read_csv(io.StringIO('\n'.join(lines)), header=None, na_values=NA_VALUES, engine='c')
+    # Unexpected text in a column leaves it as object dtype, coerce those columns as a whole
+    for col in block.columns[block.dtypes == object]:
+        block[col] = pd.to_numeric(block[col], errors='coerce')
+    values = block.to_numpy(dtype=np.float64)
+    # Every row ends in a comma, which gives an empty last column
+    if lines[0].rstrip().endswith(','):
+        values = values[:, :-1]
+    return np.ascontiguousarray(values)
+
+
+class LabelInfo(NamedTuple):
+    """
+    Measurement settings of one label of a read, from the trailer
+    name: label name, e.g. 'UoxActivty'
+    mode: measurement mode, e.g. 'Absorbance'
+    wavelength: measurement (or emission) wavelength in nm, None if not given
+    settle_time: settle time in ms, None if not given
+    settings: dictionary of every setting line of the label, e.g. {'Number of Reads': '13'}
+    """
+    name: str
+    mode: str = None
+    wavelength: float = None
+    settle_time: float = None
+    settings: dict = None
+
+
+class MultiLabelData(NamedTuple):
+    """
+    Numeric contents of a Tecan Plate Reader ascii results file with one or more labels (wavelengths or modes)
+    values: float array of raw reads (labels x cycles x wells), NaN past the last cycle of a label with fewer cycles
+    relative_time: float array of the relative time of each cycle of each label in seconds (labels x cycles)
+    temperature: float array of the temperature of each cycle of each label in °C (labels x cycles)
+    calculated: list of float arrays of the rows calculated by the Magellan method, one (rows x wells) array per label
+    labels: list of LabelInfo of each label, in the order of the first axis
+    well_names: list of well names matching the last axis of values
+    well_index: integer array of the plate well index of every well of values
+    geometry: PlateGeometry of the plate
+    """
+    values: np.ndarray
+    relative_time: np.ndarray
+    temperature: np.ndarray
+    calculated: list
+    labels: list
+    well_names: list
+    well_index: np.ndarray
+    geometry: PlateGeometry
+
+    def label_position(self, label):
+        """
+        :param label: label index, or label name
+        :return: index of the label along the first axis
+        """
+        return label_index(self.labels, label)
+
+    def label(self, label=0):
+        """
+        :param label: label index, or label name
+        :return: AsciiData of the reads of one label
+        """
+        position = self.label_position(label)
+        relative_time = self.relative_time[position]
+        n_cycles = int((~np.isnan(relative_time)).sum())
+        return AsciiData(
+            values=np.ascontiguousarray(self.values[position, :n_cycles]),
+            relative_time=np.ascontiguousarray(relative_time[:n_cycles]),
+            temperature=np.ascontiguousarray(self.temperature[position, :n_cycles]),
+            calculated=self.calculated[position],
+            well_names=self.well_names,
+            well_index=self.well_index,
+            geometry=self.geometry
+        )
+
+
+def label_settings(trailer):
+    """
+    Read the settings of every label from the trailer. Each label is a group of "Key: value" setting lines under a
+    mode line such as "Absorbance", closed by its "Label: name" line.
+    :param trailer: trailer text of the ascii results file
+    :return: list of LabelInfo in the order of the labels
+    """
+    labels = []
+    mode, settings = None, {}
+    for line in trailer.splitlines():
+        key, colon, value = (part.strip() for part in line.partition(':'))
+        if not key:
+            continue
+        if not colon:
+            mode, settings = key, {}
+        elif key == 'Label':
+            wavelength = settings.get('Measurement Wavelength', settings.get('Emission Wavelength'))
+            settle_time = settings.get('Settle Time')
+            labels.append(LabelInfo(
+                name=value,
+                mode=mode,
+                wavelength=_number(wavelength),
+                settle_time=_number(settle_time),
+                settings=settings
+            ))
+            mode, settings = None, {}
+        else:
+            settings[key] = value
+    return labels
+
+
+def label_index(labels, label):
+    """
+    :param labels: list of LabelInfo of a read
+    :param label: label index, or label name
+    :return: index of the label
+    """
+    if isinstance(label, str):
+        names = [info.name for info in labels]
+        if label not in names:
+            raise KeyError(f"No label {label}, the read has {', '.join(names) or 'no named labels (yet)'}")
+        return names.index(label)
+    return label
+
+
+def _number(text):
+    match = re.match(r'-?[\d.]+', text or '')
+    return float(match.group()) if match else None
+
+
+def measurement_time(trailer):
+    """
+    Read the date and time the read started from the trailer of an ascii results file
+    :param trailer: trailer text, or list of trailer lines, of the ascii results file
+    :return: datetime of the measurement, or None if the trailer has not been written yet
+    """
+    match = MEASUREMENT_TIME.search(trailer if isinstance(trailer, str) else '\n'.join(trailer))
+    if not match:
+        return None
+    return datetime.strptime(f'{match.group(1)} {match.group(2)}', '%Y-%m-%d %H:%M:%S')
+
+
+def parse_ascii_labels(filepath, geometry=None):
+    """
+    Parse every label of a Tecan Plate Reader ascii results file in a single pass. Magellan writes one "Raw data" block
+    per label (e.g. a measurement and a reference wavelength); the data rows of all blocks are converted together in
+    one bulk conversion and laid out as a (labels x cycles x wells) array.
+    :param filepath: file path of the input ascii file
+    :param geometry: PlateGeometry of the plate, defaults to the plate described in the file
+    :return: a MultiLabelData tuple of the raw reads, relative time, temperature, calculated rows and label settings
+    """
+    text = Path(filepath).read_bytes().decode('utf-16')
+    end = text.find('Date of measurement')
+    body = text[:end] if end != -1 else text
+    trailer = text[end:] if end != -1 else ''
+
+    # Raw reads carry a temperature, rows calculated by the method have empty time and temperature fields
+    frame_lines, calculated_lines = [], []
+    frame_counts, calculated_counts = [], []
+    for block in body.split('Raw data')[1:]:
+        lines = block.splitlines()[1:]
+        frames = [line for line in lines if '°C' in line]
+        calculated = [line[2:] for line in lines if line.startswith(',,')]
+        frame_lines += frames
+        calculated_lines += calculated
+        frame_counts.append(len(frames))
+        calculated_counts.append(len(calculated))
+    n_labels = len(frame_counts)
+
+    frames = _parse_block(FRAME_PREFIX.sub(r'\1,\2,', '\n'.join(frame_lines)).splitlines())
+    calculated = _parse_block(calculated_lines)
+    n_wells = frames.shape[1] - 2 if frames.size else calculated.shape[1]
+    # Split the calculated rows back into their labels, a read without any keeps the empty array for every label
+    if calculated.size:
+        calculated = np.split(calculated, np.cumsum(calculated_counts)[:-1])
+    else:
+        calculated = [calculated] * n_labels
+    if not frames.size:
+        frames = np.empty((0, n_wells + 2))
+    values = _stack_blocks(frames[:, 2:], frame_counts)
+    relative_time = _stack_blocks(frames[:, 0], frame_counts)
+    temperature = _stack_blocks(frames[:, 1], frame_counts)
+
+    geometry, well_index = plate_wells(trailer, n_wells, geometry)
+    names = geometry.well_names()
+    labels = label_settings(trailer)[:n_labels]
+    # Reads without a trailer, or with fewer labels described than read, get numbered labels
+    labels += [LabelInfo(name=f'Label{i + 1}', settings={}) for i in range(len(labels), n_labels)]
+    return MultiLabelData(
+        values=values,
+        relative_time=relative_time,
+        temperature=temperature,
+        calculated=calculated,
+        labels=labels,
+        well_names=[names[i] for i in well_index],
+        well_index=well_index,
+        geometry=geometry
+    )
+
+
+def _stack_blocks(rows, counts):
+    """
+    Lay out consecutive blocks of rows as a (blocks x rows x ...) array, padding shorter blocks with NaN
+    :param rows: float array of the rows of all blocks, block after block
+    :param counts: list of the number of rows of each block
+    :return: float array with a leading block axis
+    """
+    counts = np.asarray(counts, dtype=np.intp)
+    if len(counts) and (counts == counts[0]).all():
+        # Blocks of equal length, e.g. every single label read, are a reshape without padding
+        return np.ascontiguousarray(rows).reshape(len(counts), counts[0], *rows.shape[1:])
+    stacked = np.full((len(counts), counts.max(initial=0), *rows.shape[1:]), np.nan)
+    block = np.repeat(np.arange(len(counts)), counts)
+    row = np.arange(len(block)) - np.repeat(np.cumsum(counts) - counts, counts)
+    stacked[block, row] = rows
+    return stacked
+
+
+def parse_ascii(filepath, geometry=None, label=0):
+    """
+    Parse a Tecan Plate Reader ascii results file into numeric arrays. The UTF-16 file is decoded in one read and all
+    data rows are converted in bulk, without converting cells one at a time.
+    :param filepath: file path of the input ascii file
+    :param geometry: PlateGeometry of the plate, defaults to the plate described in the file
+    :param label: label index or name of a read with several labels, defaults to the first
+    :return: an AsciiData tuple of the raw reads, relative time, temperature and calculated rows
+    """
+    return parse_ascii_labels(filepath, geometry).label(label)
+
+
+def read_ascii(filepath, calculated=False, geometry=None, label=0):
+    """
+    Parse a Tecan Plate Reader ascii results file into a numeric pandas dataframe
+    :param filepath: file path of the input ascii file
+    :param calculated: if True, the rows calculated by the Magellan method are appended after the raw reads with empty
+    relative time and temperature
+    :param geometry: PlateGeometry of the plate, defaults to the plate described in the file
+    :param label: label index or name of a read with several labels, defaults to the first
+    :return: a python dataframe variable storing the contents of the Tecan Plate Reader ascii results file
+    """
+    data = parse_ascii(filepath, geometry, label)
+    values = data.values
+    relative_time = data.relative_time
+    temperature = data.temperature
+    if calculated and data.calculated.size:
+        n_calc = data.calculated.shape[0]
+        values = np.vstack([values, data.calculated]) if values.size else data.calculated
+        relative_time = np.concatenate([relative_time, np.full(n_calc, np.nan)])
+        temperature = np.concatenate([temperature, np.full(n_calc, np.nan)])
+
+    return frames_dataframe(values, relative_time, temperature, data.well_names)
+
+
+def frames_dataframe(values, relative_time, temperature, well_names):
+    """
+    Build the dataframe layout of read_ascii from frame arrays
+    :param values: float array of reads (frames x wells)
+    :param relative_time: float array of the relative time of each frame in seconds
+    :param temperature: float array of the temperature of each frame in °C
+    :param well_names: list of well names matching the columns of values
+    :return: pandas dataframe with 'Relative Time' and 'Temperature' columns followed by one column per well
+    """
+    df = pd.DataFrame(values, columns=well_names)
+    if not np.isnan(relative_time).any():
+        relative_time = relative_time.astype(int)
+    df.insert(0, 'Temperature', temperature)
+    df.insert(0, 'Relative Time', relative_time)
+    return df
+
+
+def read_trailer(filepath, tail_bytes=1 << 16):
+    """
+    Read the trailer of an ascii results file from its end, without reading the data rows before it
+    :param filepath: file path of the input ascii file
+    :param tail_bytes: number of bytes read from the end of the file, enough for the trailer of any read
+    :return: trailer text from the "Date of measurement" line on, empty if the file has no trailer (yet)
+    """
+    with open(filepath, 'rb') as f:
+        bom = f.read(2)
+        size = f.seek(0, io.SEEK_END)
+        # Start on a whole UTF-16 code unit after the byte order mark
+        start = max(2, size - tail_bytes)
+        f.seek(start - start % 2)
+        data = f.read()
+    text = data.decode('utf-16-be' if bom == b'\xfe\xff' else 'utf-16-le', errors='replace')
+    start = text.find('Date of measurement')
+    return text[start:] if start != -1 else ''
+
+
+def iter_frames(filepath, chunk_bytes=CHUNK_BYTES, label=0):
+    """
+    Parse the kinetic frames of a finished ascii results file a chunk at a time, so only one chunk of the file is ever
+    held in memory however many cycles it contains
+    :param filepath: file path of the input ascii file
+    :param chunk_bytes: number of bytes of the file parsed per chunk
+    :param label: index or name of the label whose frames are parsed
+    :return: generator of tuples of float arrays (values, relative_time, temperature) of consecutive blocks of frames
+    """
+    tail = AsciiTail(filepath, label)
+    size = Path(filepath).stat().st_size
+    while True:
+        final = tail.offset + chunk_bytes >= size
+        values, relative_time, temperature = tail.read_frames(chunk_bytes, final)
+        if relative_time.size:
+            yield values, relative_time, temperature
+        if final:
+            return
+
+
+class AsciiTail:
+    """
+    Incremental reader for an ascii results file that the plate reader is still writing. Each call to read_frames
+    parses only the bytes appended since the previous call and returns the newly completed kinetic frames of one label.
+    """
+
+    def __init__(self, filepath, label=0):
+        """
+        :param filepath: file path of the ascii file
+        :param label: index of the label whose frames are returned, a read with several labels has a "Raw data" block
+        per label. Labels are only named in the trailer, so a label name is resolved from the trailer the file has when
+        the reader is created, i.e. for complete files only.
+        """
+        self.filepath = Path(filepath)
+        self.label = label_index(label_settings(read_trailer(filepath)), label) if isinstance(label, str) else label
+        self.n_blocks = 0
+        self.offset = 0
+        self.encoding = None
+        self.pending = ''
+        self.in_data = False
+        self.n_frames = 0
+        self.trailer = []
+        # Set once the "Total kinetic run time" line is written at the end of the file
+        self.finished = False
+
+    def _read_text(self, max_bytes=None):
+        with open(self.filepath, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(max_bytes) if max_bytes else f.read()
+        if self.encoding is None:
+            if len(data) < 2:
+                return ''
+            self.encoding = 'utf-16-be' if data.startswith(b'\xfe\xff') else 'utf-16-le'
+            if data[:2] in (b'\xff\xfe', b'\xfe\xff'):
+                data = data[2:]
+                self.offset += 2
+        # Only decode whole UTF-16 code units, the rest is picked up by the next read
+        data = data[:len(data) - len(data) % 2]
+        self.offset += len(data)
+        return data.decode(self.encoding, errors='replace')
+
+    def read_frames(self, max_bytes=None, final=False):
+        """
+        Parse the lines appended to the file since the last call
+        :param max_bytes: read at most this many bytes, the rest is left for the next call
+        :param final: if True the file is complete, so a last line without a line break is parsed too
+        :return: tuple of float arrays (values, relative_time, temperature) of the new frames, empty if there are none
+        """
+        text = self.pending + self._read_text(max_bytes)
+        lines = text.split('\n')
+        # The last element is an incomplete line unless the text ended in a line break
+        self.pending = '' if final else lines.pop()
+
+        frame_lines = []
+        for line in lines:
+            line = line.rstrip('\r')
+            if 'Raw data' in line:
+                self.in_data = True
+                self.n_blocks += 1
+            elif 'Date of measurement' in line:
+                self.in_data = False
+                self.trailer.append(line)
+            elif self.in_data and '°C' in line:
+                if self.n_blocks == self.label + 1:
+                    frame_lines.append(line)
+            elif not self.in_data and line:
+                self.trailer.append(line)
+                if line.startswith('Total kinetic run time'):
+                    self.finished = True
+
+        frames = _parse_block(FRAME_PREFIX.sub(r'\1,\2,', '\n'.join(frame_lines)).splitlines())
+        if not frames.size:
+            return np.empty((0, 0)), np.empty(0), np.empty(0)
+        self.n_frames += frames.shape[0]
+        return np.ascontiguousarray(frames[:, 2:]), frames[:, 0].copy(), frames[:, 1].copy()
@@ -1,17 +1,26 @@
 import pandas as pd
-import matplotlib.pyplot as plt
-import yaml
-import tkinter as tk
-from tkinter import filedialog
-from Foundry import get_collaboration_path
-from LabGuruAPI import Experiment, Protocol, SESSION
 import os
-import requests
 from pathlib import Path
-from AWSHelper import get_aws_secret
+from TecanAscii import read_ascii
+from PlateMap import load_platemap
+from PierceStandardCurve import quantify_plate
+from PlateLayout import PlateLayout, apply_layout, compile_layout, load_layout, pierce_layout
+from ResultsStore import STORE_DIR, append_pierce_run
+from RunCatalog import load_yaml
+from RunLedger import LEDGER_PATH, RunLedger
+from RunTrace import discard_trace, span, trace_to, traced
+from LabGuruUploader import LabGuruUploader, report
+from Backends import get_backend
+
+# Modules the concentrations are computed with, a change to any of them redoes every stage of a run
+PIERCE_MODULES = ['TecanPierceAnalysis', 'TecanAscii', 'PlateGeometry', 'PlateMap', 'PlateLayout',
+                  'PierceStandardCurve', 'RunCatalog']
 
 
 def select_file(title_str, filetype):
+    import tkinter as tk
+    from tkinter import filedialog
+
     root = tk.Tk()
     root.withdraw()
     if filetype == "yaml":
@@ -26,44 +35,12 @@ def select_file(title_str, filetype):
 
 
 def read_yaml(yaml_path):
-    # read the yaml file
-    with open(yaml_path, 'r') as file:
-        filedata = file.read()
-    # replace all tabs with four spaces to avoid read in error
-    filedata = filedata.replace('\t', '    ')
-    # write the file again
-    with open(yaml_path, 'w') as file:
-        file.write(filedata)
-    with open(yaml_path, 'r') as stream:
-        yaml_dict = yaml.safe_load(stream)
-
-    return yaml_dict
-
-
-def read_ascii(filepath):
-    read_lines = False
-    lines = []
-    line_counter = 0
-    with open(filepath, 'r', encoding='utf-16') as f:
-        for line in f:
-            line_counter += 1
-            if line_counter in [3, 4]:
-                lines.append(line)
-
-    # The lines that we read will be a list of strings. We will need to convert this to a dataframe
-    # Assuming each line is a comma-separated list of values
-    repeat_headers = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']
-    headers = ['Relative Time', 'Temperature']
-    for i in range(1, 13):
-        headers += [f'{header}{i}' for header in repeat_headers]
-
-    # Create empty DataFrame with headers
-    df = pd.DataFrame([line.split(',')[:-1] for line in lines], columns=headers)
-    return df
+    # Tabs are replaced in memory, the log itself is left untouched
+    return load_yaml(yaml_path)
 
 
 def map_sample_names(df, samplemap_path):
-    platemap = pd.read_excel(samplemap_path)
+    platemap = load_platemap(samplemap_path)
     # Create a dictionary from Well Name to Sample Name
     name_dict = platemap.set_index('Well Name')['Sample Name'].to_dict()
     control_dict = platemap.set_index('Well Name')['Control?'].to_dict()
@@ -79,130 +56,206 @@ def map_sample_names(df, samplemap_path):
     return df_raw
 
 
-# Select Files
-yaml_filepath = Path(select_file("YAML File Selection", "yaml"))
-pierce_filepath1 = Path(select_file("Pierce1 A660 File Selection", "asc"))
-pierce_filepath2 = Path(select_file("Pierce2 A660 File Selection", "asc"))
-platemap_filepath = Path(select_file("Plate Map File Selection", "xlsx"))
-
-# Read in YAML file
-yaml_dict = read_yaml(yaml_filepath)
-expt_id = int(yaml_dict['Input Plates'][0][0:4])
-# Get Collaborations Path
-p_base = get_collaboration_path(expt_id)
-# Create folder in collabs path
-work_dir = p_base / f"TecanPierce_{yaml_dict['Input Plates'][0]}_{yaml_dict['Start']}"
-os.makedirs(work_dir, exist_ok=True)
-# Read ASCII files for background and kinetic reads
-# pierce_df = pd.concat([read_ascii(pierce_filepath1),read_ascii(pierce_filepath2)])
-# pierce_df = pierce_df.reset_index()
-pierce_df1 = read_ascii(pierce_filepath1)
-pierce_df2 = read_ascii(pierce_filepath2)
-
-# Create a three column Excel Doc of Well Name, DiluFactor*Conc, Sample Name
-platemap = pd.read_excel(platemap_filepath)
-# Create a dictionary from Well Name to Sample Name
-name_dict = platemap.set_index('Well Name')['Sample Name'].to_dict()
-control_dict = platemap.set_index('Well Name')['Control?'].to_dict()
-# for col in pierce_df.columns:
-#     (str(name_dict.get(col, col)) + ' (Control)' if isinstance(control_dict.get(col), str)
-#      else name_dict.get(col, col))
-
-data = []  # This list will hold the rows for the new DataFrame
-
-for key in pierce_df1.columns:
-    if len(key) > 3 or int(key[1]) in [1,2,3]:
-        continue
-    well_name = key[0] + str(int(key[1])-3)
-    try:
-        protein_concentration = float(pierce_df1.loc[1, key]) * yaml_dict['Metadata']['Dilution Factor']
-    except:
-        protein_concentration = ""
-    dict_value = name_dict.get(well_name, None)
-
-    # Populate a new row for the DataFrame
-    row = {'Well Name': well_name, 'Protein Concentration (mg/mL)': protein_concentration, 'Sample Name': dict_value}
-    data.append(row)
-for key in pierce_df2.columns:
-    if len(key) > 3 or int(key[1]) in [1,2,3]:
-        continue
-    well_name = key[0] + str(int(key[1])+3)
-    try:
-        protein_concentration = float(pierce_df2.loc[1, key]) * yaml_dict['Metadata']['Dilution Factor']  # Assuming the second row corresponds to index 1
-    except:
-        protein_concentration = ""
-    dict_value = name_dict.get(well_name, None)  # Get the value from the dictionary, if it exists
-
-    # Populate a new row for the DataFrame
-    row = {'Well Name': well_name, 'Protein Concentration (mg/mL)': protein_concentration, 'Sample Name': dict_value}
-    data.append(row)
-
-# Create new DataFrame
-new_df = pd.DataFrame(data)
-new_df.to_excel(work_dir / f"TecanPierce_{yaml_dict['Input Plates'][0]}_{yaml_dict['Start']}.xlsx", index=False)
-
-#LabGuru updates
-if yaml_dict['Metadata']['Interferent'] == 'No':
-    proto_stdcrv_string = "Standard Curve aliquots were stamped from a pre-made standard curve deep well plate into two Sample Dilution plates. The pre-made standard curve plate is made by hand via transferring solution from the Thermo - Pierce Bovine Serum Albumin Standard Pre-Diluted Set (23208) into the first three columns of a deep well plate, such that columns 1, 2, and 3 are triplicates of a standard curve composed of BSA at the following concentrations: 2.0, 1.5, 1.0, 0.75, 0.5, 0.125, 0.05, 0.0"
-else:
-    proto_stdcrv_string = "Interferent buffer was stamped into the first three columns of two Sample Dilution plates. Then Standard Curve aliquots were stamped from a pre-made standard curve deep well plate into those first three columns of both Sample Dilution plates, such that the protein concentrations of the standards and concentrations of the interferent were diluted 2-fold for each well. The pre-made standard curve plate is made by hand via transferring solution from the Thermo - Pierce Bovine Serum Albumin Standard Pre-Diluted Set (23208) into the first three columns of a deep well plate, such that columns 1, 2, and 3 are triplicates of a standard curve composed of BSA at the following concentrations: 2.0, 1.5, 1.0, 0.75, 0.5, 0.125, 0.05, 0.0. Those standard concentrations were all halved in this experiment via the interferent reagent. All standard protein concentration values are correctly set in the plate reader software to reflect the dilution."
-
-
-# Create Section in LG
-expt = Experiment.from_id(expt_id)
-cur_section = expt.add_section(f"Tecan_PierceProteinQuant_{yaml_dict['Input Plates'][0]}_{yaml_dict['Start']}", -1)
-# Use Pre-made LG Protocol
-cur_protocol = Protocol.from_id(177)
-# Add Text and Steps Elements to LG experiment section
-cur_section.add_text_element(cur_protocol.sections[0].elements[0].format_data(
-    input_plate=yaml_dict['Input Plates'][0]
-))
-sample_vol = 30/yaml_dict['Metadata']['Dilution Factor']
-diluent_vol = str(30-sample_vol)
-cur_section.add_steps_element(cur_protocol.sections[0].elements[1].format_data(
-    standard_curve=proto_stdcrv_string,
-    diluent_vol=diluent_vol,
-    sample_vol=sample_vol
-))
-
-output_file_paths = [
-    work_dir / f"TecanPierce_{yaml_dict['Input Plates'][0]}_{yaml_dict['Start']}.xlsx",
-    yaml_filepath,
-    pierce_filepath1,
-    pierce_filepath2,
-    platemap_filepath
-]
-
-# Get the instrument LG Token
-SESSION.login()
-cur_token = SESSION.token
-# Add attachment section
-attachments_element_resp = requests.post(f'https://my.labguru.com/api/v1/elements', json={
-    'token': cur_token,
-    'item': {
-        'container_id': cur_section.id,
-        'container_type': 'ExperimentProcedure',
-        'element_type': 'attachments',
-        'name': 'Attachments',
-        'data': '[]'
-    }
-})
-# Add attachment
-for cur_path in output_file_paths:
-    url = 'https://my.labguru.com/api/v1/attachments'
-    headers = {
-        'accept': '*/*',
-    }
-    filepath = cur_path
-    # make sure to open your file in binary mode
-    with filepath.open('rb') as file:
-        files = {
-            'token': (None, cur_token),
-            'item[attachment]': (filepath.name, file),
-            'item[attach_to_uuid]': (None, expt.uuid),
-            'item[section_id]': (None, cur_section.id),
-            'item[element_id]': (None, attachments_element_resp.json()['id'])
+@traced('AnalysisTrace.json')
+def run_analysis(yaml_filepath, pierce_filepath1, pierce_filepath2, platemap_filepath, work_dir=None,
+                 results_store=STORE_DIR, curve_model=None, layout=None, extra_pierce_filepaths=(), ledger=LEDGER_PATH,
+                 force=False):
+    # Read in YAML file
+    with span('read_yaml'):
+        yaml_dict = read_yaml(yaml_filepath)
+    expt_id = int(yaml_dict['Input Plates'][0][0:4])
+    # Get Collaborations Path
+    with span('collaboration_path'):
+        if work_dir is None:
+            p_base = get_backend().collaboration_path(expt_id)
+        else:
+            p_base = Path(work_dir)
+        # Create folder in collabs path
+        work_dir = p_base / f"TecanPierce_{yaml_dict['Input Plates'][0]}_{yaml_dict['Start']}"
+        os.makedirs(work_dir, exist_ok=True)
+    trace_to(work_dir)
+    summary_path = work_dir / f"TecanPierce_{yaml_dict['Input Plates'][0]}_{yaml_dict['Start']}.xlsx"
+    pierce_filepaths = [pierce_filepath1, pierce_filepath2, *extra_pierce_filepaths]
+
+    # Skip the stages whose inputs and code are unchanged since the run ledger last recorded them
+    stages = ['summary', 'results'] if results_store else ['summary']
+    run_key = f"pierce:{yaml_dict['Input Plates'][0]}:{yaml_dict['Start']}"
+    run_ledger = RunLedger(ledger) if ledger else None
+    fingerprints = {}
+    done = {stage: None for stage in stages}
+    if run_ledger:
+        inputs = [yaml_filepath, *pierce_filepaths, platemap_filepath]
+        if layout is not None and not isinstance(layout, PlateLayout):
+            inputs.append(layout)
+        params = {'work_dir': str(work_dir), 'results_store': str(results_store), 'curve_model': curve_model,
+                  'layout': layout}
+        with span('ledger_lookup'):
+            for stage in stages:
+                modules = PIERCE_MODULES + (['ResultsStore'] if stage == 'results' else [])
+                fingerprints[stage] = run_ledger.fingerprint(inputs, modules, params)
+                done[stage] = None if force else run_ledger.current(run_key, stage, fingerprints[stage])
+    stages = {stage: 'skipped' if outputs is not None else 'ran' for stage, outputs in done.items()}
+    if all(outputs is not None for outputs in done.values()):
+        # Nothing ran, keep the trace of the run that wrote the outputs
+        discard_trace()
+        return {
+            'yaml_dict': yaml_dict,
+            'work_dir': work_dir,
+            'summary_path': summary_path,
+            'stages': stages
         }
-        response = requests.post(url, headers=headers, files=files)
+
+    # Read ASCII files of every reader plate
+    with span('read_ascii', plates=len(pierce_filepaths)):
+        pierce_dfs = [read_ascii(filepath, calculated=True) for filepath in pierce_filepaths]
+    # Map the reader plates onto the source plate, two plates by default
+    if layout is None:
+        layout = pierce_layout(len(pierce_filepaths))
+    elif not isinstance(layout, PlateLayout):
+        layout = load_layout(layout)
+    well_names = [col for col in pierce_dfs[0].columns if col not in ['Relative Time', 'Temperature']]
+    compiled = compile_layout(layout, well_names)
+
+    # Row 1 holds the Magellan concentrations, unless they are back-calculated from a standard curve fitted here
+    curves = {}
+    plate_concentrations = []
+    interferent = yaml_dict['Metadata'].get('Interferent', 'No') != 'No'
+    with span('quantify', curve_model=curve_model):
+        for i, (filepath, df) in enumerate(zip(pierce_filepaths, pierce_dfs)):
+            if curve_model:
+                curves[f'Pierce{i + 1}'], concentrations = quantify_plate(filepath, interferent, curve_model,
+                                                                         standard_columns=layout.standard_columns)
+                plate_concentrations.append(concentrations.reindex(well_names).to_numpy())
+            else:
+                plate_concentrations.append(df.loc[1, well_names].to_numpy(dtype=float))
+
+    # Create a three column Excel Doc of Well Name, DiluFactor*Conc, Sample Name
+    with span('remap'):
+        platemap = load_platemap(platemap_filepath)
+        sample_names = platemap.drop_duplicates('Well Name', keep='last').set_index('Well Name')['Sample Name']
+        new_df = pd.DataFrame({
+            'Well Name': compiled.source_wells,
+            'Protein Concentration (mg/mL)': apply_layout(compiled, plate_concentrations,
+                                                          yaml_dict['Metadata']['Dilution Factor']),
+            'Sample Name': sample_names.reindex(compiled.source_wells).to_numpy()
+        })
+    if done['summary'] is None:
+        with span('write_summary'), pd.ExcelWriter(summary_path) as writer:
+            new_df.to_excel(writer, index=False)
+            if curves:
+                pd.DataFrame([
+                    {'Plate': name, 'Model': curve.model, 'Parameters': ', '.join(f'{p:.6g}' for p in curve.params),
+                     'R2': curve.r2, 'Standards': curve.n_points}
+                    for name, curve in curves.items()
+                ]).to_excel(writer, sheet_name='StandardCurves', index=False)
+        if run_ledger:
+            run_ledger.record(run_key, 'summary', fingerprints['summary'], paths=[summary_path])
+    # Append the concentrations to the results dataset
+    if results_store and done['results'] is None:
+        with span('append_results'):
+            append_pierce_run(results_store, yaml_dict, new_df)
+        if run_ledger:
+            run_ledger.record(run_key, 'results', fingerprints['results'])
+
+    return {
+        'yaml_dict': yaml_dict,
+        'work_dir': work_dir,
+        'summary_path': summary_path,
+        'stages': stages
+    }
+
+
+def create_labguru_section(yaml_dict):
+    backend = get_backend()
+
+    #LabGuru updates
+    if yaml_dict['Metadata']['Interferent'] == 'No':
+        proto_stdcrv_string = "Standard Curve aliquots were stamped from a pre-made standard curve deep well plate into two Sample Dilution plates. The pre-made standard curve plate is made by hand via transferring solution from the Thermo - Pierce Bovine Serum Albumin Standard Pre-Diluted Set (23208) into the first three columns of a deep well plate, such that columns 1, 2, and 3 are triplicates of a standard curve composed of BSA at the following concentrations: 2.0, 1.5, 1.0, 0.75, 0.5, 0.125, 0.05, 0.0"
+    else:
+        proto_stdcrv_string = "Interferent buffer was stamped into the first three columns of two Sample Dilution plates. Then Standard Curve aliquots were stamped from a pre-made standard curve deep well plate into those first three columns of both Sample Dilution plates, such that the protein concentrations of the standards and concentrations of the interferent were diluted 2-fold for each well. The pre-made standard curve plate is made by hand via transferring solution from the Thermo - Pierce Bovine Serum Albumin Standard Pre-Diluted Set (23208) into the first three columns of a deep well plate, such that columns 1, 2, and 3 are triplicates of a standard curve composed of BSA at the following concentrations: 2.0, 1.5, 1.0, 0.75, 0.5, 0.125, 0.05, 0.0. Those standard concentrations were all halved in this experiment via the interferent reagent. All standard protein concentration values are correctly set in the plate reader software to reflect the dilution."
+
+    expt_id = int(yaml_dict['Input Plates'][0][0:4])
+    # Create Section in LG
+    with span('Experiment.from_id', 'labguru'):
+        expt = backend.experiment(expt_id)
+    with span('add_section', 'labguru'):
+        cur_section = expt.add_section(
+            f"Tecan_PierceProteinQuant_{yaml_dict['Input Plates'][0]}_{yaml_dict['Start']}", -1)
+    # Use Pre-made LG Protocol
+    with span('Protocol.from_id', 'labguru'):
+        cur_protocol = backend.protocol(177)
+    # Add Text and Steps Elements to LG experiment section
+    with span('add_text_element', 'labguru'):
+        cur_section.add_text_element(cur_protocol.sections[0].elements[0].format_data(
+            input_plate=yaml_dict['Input Plates'][0]
+        ))
+    sample_vol = 30/yaml_dict['Metadata']['Dilution Factor']
+    diluent_vol = str(30-sample_vol)
+    with span('add_steps_element', 'labguru'):
+        cur_section.add_steps_element(cur_protocol.sections[0].elements[1].format_data(
+            standard_curve=proto_stdcrv_string,
+            diluent_vol=diluent_vol,
+            sample_vol=sample_vol
+        ))
+    return expt, cur_section
+
+
+@traced('UploadTrace.json')
+def upload_to_labguru(yaml_dict, yaml_filepath, pierce_filepath1, pierce_filepath2, platemap_filepath, summary_path,
+                      base_url=None, max_workers=4, extra_pierce_filepaths=(), ledger=LEDGER_PATH, force=False):
+    trace_to(Path(summary_path).parent)
+    output_file_paths = [
+        summary_path,
+        yaml_filepath,
+        pierce_filepath1,
+        pierce_filepath2,
+        *extra_pierce_filepaths,
+        platemap_filepath
+    ]
+    # Nothing to do if these files were uploaded already, otherwise update the run's existing section
+    backend = get_backend()
+    base_url = base_url or backend.base_url
+    # Uploads to a stand-in are recorded apart from the real ones, a dry run records nothing
+    run_ledger = RunLedger(ledger) if ledger and backend.upload_stage else None
+    run_key = f"pierce:{yaml_dict['Input Plates'][0]}:{yaml_dict['Start']}"
+    if run_ledger:
+        fingerprint = run_ledger.fingerprint(output_file_paths, ['LabGuruUploader'], {'base_url': base_url})
+        uploaded = None if force else run_ledger.current(run_key, backend.upload_stage, fingerprint)
+        if uploaded:
+            return [{'path': str(path), 'status': 'skipped', 'attachment_id': uploaded['files'].get(str(path)),
+                     'attempts': 0, 'error': None} for path in output_file_paths]
+
+    status_path = Path(summary_path).parent / backend.status_file if backend.status_file else None
+    uploader = LabGuruUploader(base_url=base_url, max_workers=max_workers, status_path=status_path,
+                               attachment_index=backend.attachment_index)
+    previous = run_ledger.lookup(run_key, backend.upload_stage) if run_ledger else None
+    if previous:
+        uploader.resume(previous['outputs'])
+    if not uploader.state.get('element_id'):
+        expt, cur_section = create_labguru_section(yaml_dict)
+        uploader.begin(cur_section.id, expt.uuid)
+
+    statuses = uploader.upload_files(output_file_paths)
+    report(statuses)
+    if run_ledger:
+        run_ledger.record(run_key, backend.upload_stage, fingerprint, {
+            **{key: value for key, value in uploader.state.items() if key != 'files'},
+            'files': {status['path']: status['attachment_id'] for status in statuses}
+        })
+    return statuses
+
+
+def main():
+    # Select Files
+    yaml_filepath = Path(select_file("YAML File Selection", "yaml"))
+    pierce_filepath1 = Path(select_file("Pierce1 A660 File Selection", "asc"))
+    pierce_filepath2 = Path(select_file("Pierce2 A660 File Selection", "asc"))
+    platemap_filepath = Path(select_file("Plate Map File Selection", "xlsx"))
+
+    results = run_analysis(yaml_filepath, pierce_filepath1, pierce_filepath2, platemap_filepath)
+    upload_to_labguru(results['yaml_dict'], yaml_filepath, pierce_filepath1, pierce_filepath2, platemap_filepath,
+                      results['summary_path'])
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+import argparse
+import time
+import warnings
+from datetime import datetime
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from ResultsStore import STORE_DIR, load_results
+from TecanAscii import measurement_time
+
+# FluentControl yaml metadata of the times the enzyme samples and the uric acid substrate were added to the assay plate
+ENZYME_ADDITION = 'Uricase Sample Addition Timestamp'
+SUBSTRATE_ADDITION = 'Uric Acid Addition Timestamp'
+# Columns naming a run of the results dataset
+RUN_KEYS = ['experiment_id', 'run_start', 'plate']
+
+
+class RunTiming(NamedTuple):
+    """
+    Wall clock times of a Uox activity run, None where they were not recorded
+    enzyme_added: datetime the uricase samples were added to the assay plate
+    substrate_added: datetime the uric acid substrate was added to the assay plate
+    background_measured: datetime the background read started
+    kinetic_measured: datetime the kinetic read started, relative time 0 of its frames
+    """
+    enzyme_added: datetime = None
+    substrate_added: datetime = None
+    background_measured: datetime = None
+    kinetic_measured: datetime = None
+
+    @staticmethod
+    def _seconds(start, end):
+        return (end - start).total_seconds() if start is not None and end is not None else np.nan
+
+    @property
+    def substrate_offset(self):
+        """
+        :return: seconds from the substrate addition to the first kinetic frame, NaN if either time is unknown
+        """
+        return self._seconds(self.substrate_added, self.kinetic_measured)
+
+    @property
+    def enzyme_offset(self):
+        """
+        :return: seconds from the enzyme addition to the first kinetic frame, NaN if either time is unknown
+        """
+        return self._seconds(self.enzyme_added, self.kinetic_measured)
+
+    def to_frame(self, plate):
+        """
+        :param plate: source plate barcode of the run
+        :return: single row dataframe of the timing table of the results dataset
+        """
+        def text(value):
+            return value.isoformat(sep=' ') if value is not None else None
+
+        return pd.DataFrame({
+            'plate': [plate],
+            'enzyme_added': [text(self.enzyme_added)],
+            'substrate_added': [text(self.substrate_added)],
+            'background_measured': [text(self.background_measured)],
+            'kinetic_measured': [text(self.kinetic_measured)],
+            'substrate_offset': [self.substrate_offset],
+            'enzyme_offset': [self.enzyme_offset],
+        })
+
+
+def _timestamp(value):
+    """
+    :param value: yaml timestamp, loaded as a datetime, or its text
+    :return: datetime, or None if the value is missing or not a timestamp
+    """
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return None
+
+
+def run_timing(yaml_dict, kinetic_trailer, bg_trailer=''):
+    """
+    Collect the wall clock times of a run from the FluentControl yaml log and the plate reader trailers
+    :param yaml_dict: dictionary of the Tecan FluentControl yaml log file contents
+    :param kinetic_trailer: trailer text of the kinetic ascii read
+    :param bg_trailer: trailer text of the background ascii read
+    :return: RunTiming of the run
+    """
+    metadata = yaml_dict.get('Metadata') or {}
+    return RunTiming(
+        enzyme_added=_timestamp(metadata.get(ENZYME_ADDITION)),
+        substrate_added=_timestamp(metadata.get(SUBSTRATE_ADDITION)),
+        background_measured=measurement_time(bg_trailer),
+        kinetic_measured=measurement_time(kinetic_trailer)
+    )
+
+
+def common_grid(times, step=None, overlap=True):
+    """
+    Build an evenly spaced time grid for a batch of runs
+    :param times: float array of the frame times of every run (runs x frames), NaN padded
+    :param step: grid spacing in seconds, defaults to the median frame interval of the runs
+    :param overlap: if True the grid spans the time covered by every run, otherwise the time covered by any run
+    :return: float array of grid times
+    """
+    times = np.asarray(times, dtype=np.float64)
+    with warnings.catch_warnings():
+        # Runs without frames are all NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        firsts, lasts = np.nanmin(times, axis=1), np.nanmax(times, axis=1)
+        if step is None:
+            step = np.nanmedian(np.diff(times, axis=1))
+        first = np.nanmax(firsts) if overlap else np.nanmin(firsts)
+        last = np.nanmin(lasts) if overlap else np.nanmax(lasts)
+    if not step > 0 or not last >= first:
+        return np.empty(0)
+    return first + step * np.arange(int(np.floor((last - first) / step + 1e-9)) + 1)
+
+
+def resample(times, values, grid):
+    """
+    Linearly interpolate every well of a batch of runs onto a common time grid in one vectorized pass. The runs are
+    laid end to end on one increasing time axis, each shifted past the end of the one before, so a single sorted
+    search finds the bracketing frames of every grid time of every run.
+    :param times: float array of the frame times of every run (runs x frames), increasing along each run, NaN padded
+    :param values: float array of the reads of every run (runs x frames x wells)
+    :param grid: float array of the times to interpolate at
+    :return: float array of the interpolated reads (runs x grid x wells), NaN outside the time covered by a run
+    """
+    times = np.asarray(times, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    grid = np.asarray(grid, dtype=np.float64)
+    n_runs = len(times)
+    out = np.full((n_runs, len(grid), values.shape[2]), np.nan)
+    valid = ~np.isnan(times)
+    n_valid = valid.sum(axis=1)
+    if not len(grid) or not valid.any():
+        return out
+
+    low = min(times[valid].min(), grid.min())
+    span = max(times[valid].max(), grid.max()) - low + 1
+    shift = np.arange(n_runs) * span - low
+    flat = (times + shift[:, np.newaxis])[valid]
+    flat_values = values[valid]
+    starts = np.concatenate([[0], np.cumsum(n_valid)[:-1]])
+    last = flat[np.maximum(starts + n_valid - 1, 0)] - shift
+
+    # Number of frames of each run at or before each grid time
+    position = np.searchsorted(flat, grid + shift[:, np.newaxis], side='right') - starts[:, np.newaxis]
+    inside = (position >= 1) & (grid <= last[:, np.newaxis]) & (n_valid >= 2)[:, np.newaxis]
+    left = starts[:, np.newaxis] + np.clip(position - 1, 0, np.maximum(n_valid - 2, 0)[:, np.newaxis])
+    right = np.minimum(left + 1, len(flat) - 1)
+    t_left = flat[left] - shift[:, np.newaxis]
+    t_right = flat[right] - shift[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(t_right > t_left, (grid - t_left) / (t_right - t_left), 0.0)[inside]
+    out[inside] = (flat_values[left[inside]] * (1 - weight)[:, np.newaxis] +
+                   flat_values[right[inside]] * weight[:, np.newaxis])
+    return out
+
+
+class AlignedRuns(NamedTuple):
+    """
+    Reads of a batch of runs resampled onto a common grid of time since the substrate addition
+    values: float array of the resampled reads (runs x time x wells), NaN outside the time covered by a run
+    time: float array of the grid times in seconds since the substrate addition
+    runs: dataframe of the experiment_id, run_start, plate and substrate_offset of every run
+    well_names: list of well names matching the last axis of values
+    """
+    values: np.ndarray
+    time: np.ndarray
+    runs: pd.DataFrame
+    well_names: list
+
+
+def align_store(store_dir, measure='standardized', experiment=None, plate=None, step=None, overlap=True):
+    """
+    Align the kinetic reads of many runs of the results dataset on the time since the substrate was added. The reads
+    of all runs are loaded in one scan of the reads table, shifted by the substrate offset of their run and resampled
+    together. Runs without a recorded substrate offset are left out.
+    :param store_dir: root directory of the results dataset
+    :param measure: measure of the reads table to align, e.g. 'raw', 'background_subtracted' or 'standardized'
+    :param experiment: experiment id, or list of ids, to align, defaults to every run
+    :param plate: plate barcode, or list of barcodes, to align
+    :param step: grid spacing in seconds, defaults to the median frame interval of the runs
+    :param overlap: if True the grid spans the time covered by every run, otherwise the time covered by any run
+    :return: AlignedRuns
+    """
+    timing = load_results(store_dir, 'timing', experiment=experiment, plate=plate,
+                          columns=RUN_KEYS + ['substrate_offset']).dropna(subset=['substrate_offset'])
+    reads = load_results(store_dir, 'reads', experiment=experiment, plate=plate, measure=measure,
+                         columns=RUN_KEYS + ['well', 'frame', 'relative_time', 'value'])
+    reads = reads.merge(timing, on=RUN_KEYS, how='inner')
+    if reads.empty:
+        return AlignedRuns(np.empty((0, 0, 0)), np.empty(0), pd.DataFrame(columns=RUN_KEYS + ['substrate_offset']), [])
+
+    run_index, runs = pd.MultiIndex.from_frame(reads[RUN_KEYS]).factorize()
+    runs = runs.to_frame(index=False, name=RUN_KEYS).merge(timing, on=RUN_KEYS, how='left')
+    well_index, well_names = pd.factorize(reads['well'])
+    frame = reads['frame'].to_numpy()
+    n_runs, n_wells, n_frames = len(runs), len(well_names), int(frame.max()) + 1
+
+    times = np.full((n_runs, n_frames), np.nan)
+    values = np.full((n_runs, n_frames, n_wells), np.nan)
+    times[run_index, frame] = (reads['relative_time'].to_numpy(dtype=np.float64) +
+                               reads['substrate_offset'].to_numpy(dtype=np.float64))
+    values[run_index, frame, well_index] = reads['value'].to_numpy(dtype=np.float64)
+
+    grid = common_grid(times, step, overlap)
+    return AlignedRuns(resample(times, values, grid), grid, runs, list(well_names))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Align the kinetic reads of Uox activity runs on the time since the "
+                                                 "substrate was added")
+    parser.add_argument('--store', default=STORE_DIR, help="results dataset (default: $UOX_RESULTS_STORE)")
+    parser.add_argument('--measure', default='standardized', help="measure of the reads table to align")
+    parser.add_argument('--experiment', type=int, nargs='+', default=None, help="only align these experiment ids")
+    parser.add_argument('--plate', nargs='+', default=None, help="only align these plates")
+    parser.add_argument('--step', type=float, default=None, help="grid spacing in seconds")
+    parser.add_argument('--union', action='store_true', help="span the time covered by any run, not every run")
+    parser.add_argument('-o', '--output', default='aligned.npz', help="write the aligned reads to this npz file")
+    args = parser.parse_args(argv)
+    if not args.store:
+        parser.error("no results dataset given and UOX_RESULTS_STORE is not set")
+
+    start = time.perf_counter()
+    aligned = align_store(args.store, args.measure, args.experiment, args.plate, args.step, overlap=not args.union)
+    print(f"Aligned {len(aligned.runs)} runs x {len(aligned.time)} times x {len(aligned.well_names)} wells in "
+          f"{time.perf_counter() - start:.2f}s")
+    if len(aligned.time):
+        print(f"Time since substrate addition {aligned.time[0]:.0f}s to {aligned.time[-1]:.0f}s")
+    np.savez(args.output, values=aligned.values, time=aligned.time, well_names=np.asarray(aligned.well_names),
+             **{key: np.asarray(aligned.runs[key].tolist()) for key in aligned.runs.columns})
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
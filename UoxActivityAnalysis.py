@@ -1,14 +1,36 @@
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import yaml
-import tkinter as tk
-from tkinter import filedialog
-from Foundry import get_collaboration_path
-from LabGuruAPI import Experiment, Protocol, SESSION
 import os
-import requests
+import tempfile
 from pathlib import Path
-from AWSHelper import get_aws_secret
+from TecanAscii import frames_dataframe, iter_frames, plate_wells, read_ascii, read_trailer
+from KineticFits import fit_reads
+from KineticStream import PLOT_FRAMES, KineticStream, background_columns
+from PlateMap import average_replicates, compile_platemap, file_hash, load_platemap
+from PlateQC import uox_run_qc
+from PlateRun import PlateRun
+from ResultsStore import STORE_DIR, append_uox_run
+from RunCatalog import load_yaml
+from RunLedger import LEDGER_PATH, RunLedger, code_version
+from StageCache import CACHE_DIR as STAGE_CACHE_DIR, StageCache, run_stage
+from TimeAlignment import run_timing
+from RunTrace import discard_trace, span, trace_to, traced
+from LabGuruUploader import LabGuruUploader, report
+from Backends import get_backend
+from PlotRendering import (plate_run_figure_tasks, render_figures, render_percentage_consumed, render_sample_names,
+                           render_uric_acid_remaining, render_well_columns, split_columns)
+
+# Modules the summary workbook is computed with, a change to any of them redoes every stage of a run
+SUMMARY_MODULES = ['UoxActivityAnalysis', 'TecanAscii', 'PlateGeometry', 'PlateMap', 'KineticFits', 'KineticStream',
+                   'PlateQC', 'PlateRun', 'PlotRendering', 'RunCatalog']
+# Modules the cached data preparation stages are computed with. The stage cache keys hold the code_version of these,
+# as the run ledger fingerprints do, so a code change invalidates the stage and every stage downstream of it
+STAGE_MODULES = {
+    'read_ascii': ['TecanAscii', 'PlateGeometry'],
+    'plate_run': ['UoxActivityAnalysis', 'PlateRun', 'PlateMap', 'PlateGeometry', 'KineticStream', 'KineticFits',
+                  'PlotRendering', 'TecanAscii'],
+}
+
 
 def select_file(title_str, filetype):
     """
@@ -17,6 +39,9 @@ def select_file(title_str, filetype):
     :param filetype: string detailing what type of file to show in the FileExplorer window
     :return: the file path of the selected file
     """
+    import tkinter as tk
+    from tkinter import filedialog
+
     root = tk.Tk()
     root.withdraw()
     if filetype == "yaml":
@@ -36,52 +61,8 @@ def read_yaml(yaml_path):
     :param yaml_path: file path of the input yaml file
     :return: a dictionary variable storing the contents of the yaml file
     """
-    # read the yaml file
-    with open(yaml_path, 'r') as file:
-        filedata = file.read()
-    # replace all tabs with four spaces to avoid read in error
-    filedata = filedata.replace('\t', '    ')
-    # write the file again
-    with open(yaml_path, 'w') as file:
-        file.write(filedata)
-    with open(yaml_path, 'r') as stream:
-        yaml_dict = yaml.safe_load(stream)
-
-    return yaml_dict
-
-
-def read_ascii(filepath):
-    """
-    Parse a Tecan Plate Reader ascii results file into a pandas dataframe
-    :param filepath: file path of the input ascii file
-    :return: a python dataframe variable storing the contents of the Tecan Plate Reader ascii results file
-    """
-    read_lines = False
-    lines = []
-    with open(filepath, 'r', encoding='utf-16') as f:
-        for line in f:
-            # Start reading when encountering "Raw data"
-            if 'Raw data' in line.strip():
-                read_lines = True
-                continue
-
-            # Stop reading when encountering "Date of measurement"
-            if 'Date of measurement' in line.strip():
-                read_lines = False
-                continue
-
-            # If we should read a line, append it to the list variable
-            if read_lines and "°C" in line:
-                lines.append(line)
-
-    # The lines read will be a list of strings. Convert this to a dataframe
-    repeat_headers = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']
-    headers = ['Relative Time', 'Temperature']
-    for i in range(1, 13):
-        headers += [f'{header}{i}' for header in repeat_headers]
-
-    df = pd.DataFrame([line.split(',')[:-1] for line in lines], columns=headers)
-    return df
+    # Tabs are replaced in memory, the log itself is left untouched
+    return load_yaml(yaml_path)
 
 
 def remove_background(t0_data, kinetic_data):
@@ -92,18 +73,16 @@ def remove_background(t0_data, kinetic_data):
     :param kinetic_data: pandas dataframe of the substrate plus enzyme solution absorbance reads
     :return: pandas dataframe of the resulting kinetic read values
     """
-    headers_to_exclude = ['Relative Time', 'Temperature']
-    headers_to_include = [col for col in kinetic_data.columns if col not in headers_to_exclude]
+    _, kinetic_values, kinetic_wells = split_columns(kinetic_data)
+    _, bg_values, bg_wells = split_columns(t0_data)
+    # Match the background well of every kinetic well by plate well index
+    columns = background_columns(kinetic_wells, bg_wells)
 
-    # Create subset dataframes
-    t0_df_subset = t0_data.loc[:, headers_to_include].map(pd.to_numeric, errors='coerce')
-    kinetic_df_subset = kinetic_data.loc[:, headers_to_include].map(pd.to_numeric, errors='coerce')
-
-    # Perform subtraction
-    result_df = kinetic_df_subset - t0_df_subset.values
+    # Perform subtraction on the numeric reads, broadcasting the single background frame over every kinetic frame
+    result_df = pd.DataFrame(kinetic_values - bg_values[0, columns], columns=kinetic_wells, index=kinetic_data.index)
 
     # Add back the excluded columns from df2 to the result dataframe
-    result_df.insert(0, 'Relative Time', kinetic_data['Relative Time'].str.replace('s', '').astype(int))
+    result_df.insert(0, 'Relative Time', kinetic_data['Relative Time'])
     result_df.insert(0, 'Temperature', kinetic_data['Temperature'])
     return result_df
 
@@ -123,58 +102,28 @@ def standardize_data(df):
 
 def scatterplot_wellnames_relative_abs(df, date_time, expt_id, dest_dir):
     """
-
-    :param df:
-    :param date_time:
-    :param expt_id:
-    :param dest_dir:
-    :return:
+    Scatter plot the standardized absorbance of every well, one figure per plate column
+    :param df: standardized dataframe with well name columns
+    :param date_time: run start used in the file names
+    :param expt_id: experiment id used in the file names
+    :param dest_dir: output directory
+    :return: list of the written file paths
     """
-    headers_to_exclude = ['Relative Time', 'Temperature']
-    headers_to_include = [col for col in df.columns if col not in headers_to_exclude]
-    for n in range(1, 13):
-        plt.figure(figsize=(20, 12))
-        for column in headers_to_include:
-            if str(n) in column:
-                if n == 1 or n == 2:
-                    if len(column) == 2:
-                        plt.scatter(df['Relative Time'], df[column], label=column)
-                else:
-                    plt.scatter(df['Relative Time'], df[column], label=column)
-
-        plt.xlabel('Relative Time (s)')
-        plt.ylabel('Relative A292 (% of t0s)')
-        plt.title(f'Relative Absorbance Over Time \n Column {n}')
-        plt.legend()  # to show labels of each scatter plot
-        plt.ylim([0, 110])
-        plt.tight_layout()
-        plt.savefig(dest_dir / f"{date_time}_{expt_id}_Column{n}.png")
-        plt.close()
-        # plt.show()
+    relative_time, values, well_names = split_columns(df)
+    return render_well_columns(relative_time, values, well_names, date_time, expt_id, dest_dir)
 
 
 def map_sample_names(df, samplemap_path):
     """
-
-    :param df:
-    :param samplemap_path:
-    :return:
+    Rename the well columns to their sample names from the plate map and average the replicate wells of each sample
+    :param df: pandas dataframe with 'Relative Time' and 'Temperature' columns followed by one column per well
+    :param samplemap_path: file path of the xlsx plate map
+    :return: pandas dataframe with one column per sample, controls suffixed with ' (Control)'
     """
-    platemap = pd.read_excel(samplemap_path)
-    # Create a dictionary from Well Name to Sample Name
-    name_dict = platemap.set_index('Well Name')['Sample Name'].to_dict()
-    control_dict = platemap.set_index('Well Name')['Control?'].to_dict()
-    # Replace column names
-    df.columns = [
-        (str(name_dict.get(col, col)) + ' (Control)' if isinstance(control_dict.get(col), str)
-         else name_dict.get(col, col))
-        for col in df.columns
-    ]
-    df = df.loc[:, df.columns.notnull()]
-    # Remove columns not in platemap
-    df_raw = df[[col for col in df.columns if isinstance(col, str) and not col in ['Relative Time', 'Temperature']]]
+    relative_time, values, well_names = split_columns(df)
+    compiled = compile_platemap(load_platemap(samplemap_path), well_names)
     # If there are replicates, consolidate into a column of averages
-    df_avg = df_raw.T.groupby(level=0).mean().T
+    df_avg = pd.DataFrame(average_replicates(values, compiled), columns=compiled.labels, index=df.index)
     df_avg.insert(0, 'Relative Time', df['Relative Time'])
     df_avg.insert(0, 'Temperature', df['Temperature'])
     return df_avg
@@ -182,249 +131,414 @@ def map_sample_names(df, samplemap_path):
 
 def scatterplot_samplenames_relative_abs(df, date_time, expt_id, dest_dir):
     """
-
-    :param df:
-    :param date_time:
-    :param expt_id:
-    :param dest_dir:
-    :return:
+    Scatter plot the standardized absorbance of every sample
+    :param df: standardized dataframe with sample name columns
+    :param date_time: run start used in the file name
+    :param expt_id: experiment id used in the file name
+    :param dest_dir: output directory
+    :return: the written file path
     """
-    headers_to_exclude = ['Relative Time', 'Temperature']
-    headers_to_include = [col for col in df.columns if col not in headers_to_exclude]
-    # separate control column names
-    control_columns = [col for col in headers_to_include if '(Control)' in col]
-    experiment_columns = [col for col in headers_to_include if '(Control)' not in col]
-    num_cols = len(experiment_columns)
-    if num_cols > 10:
-        fig, axs = plt.subplots(3, 3, figsize=(25, 15))
-        axs = axs.ravel()
-        # Plot controls
-        for i in range(0,9):
-            ax = axs[i]
-            for control_col in control_columns:
-                ax.scatter(df['Relative Time'], df[control_col], label=control_col, zorder=3, marker='x')
-        for i, column in enumerate(experiment_columns):
-            ax = axs[i % 9]  # Determine the appropriate subplot for this plot
-            ax.scatter(df['Relative Time'], df[column], label=column)
-            ax.set_xlabel('Relative Time (s)')
-            ax.set_ylabel('Relative A292 (% of t0s)')
-            ax.set_title(f'Relative Absorbance Over Time')
-            ax.legend()  # to show labels of each scatter plot
-            ax.set_ylim([0, 110])
-
-        plt.savefig(dest_dir / f"{date_time}_{expt_id}_SampleNames.png")
-        # plt.show()
-        plt.close()
-    else:
-        plt.figure(figsize=(10, 6))
-        for column in headers_to_include:
-            plt.scatter(df['Relative Time'], df[column], label=column)
-        plt.xlabel('Relative Time (s)')
-        plt.ylabel('Relative A292 (% of t0s)')
-        plt.title(f'Relative Absorbance Over Time')
-        plt.legend()  # to show labels of each scatter plot
-        plt.ylim([0, 110])
-        plt.tight_layout()
-        plt.savefig(dest_dir / f"{date_time}_{expt_id}_SampleNames.png")
-        plt.close()
-    return dest_dir / f"{date_time}_{expt_id}_SampleNames.png"
+    relative_time, values, labels = split_columns(df)
+    return render_sample_names(relative_time, values, labels, date_time, expt_id, dest_dir)
 
 
 def final_percentage_consumed(df, date_time, expt_id, dest_dir):
     """
-
-    :param df:
-    :param date_time:
-    :param expt_id:
-    :param dest_dir:
-    :return:
+    Bar charts of the % of uric acid consumed and remaining from the first to the last plate read
+    :param df: standardized dataframe with sample name columns
+    :param date_time: run start used in the file names
+    :param expt_id: experiment id used in the file names
+    :param dest_dir: output directory
+    :return: list of the written file paths
     """
-    headers_to_exclude = ['Relative Time', 'Temperature']
-    headers_to_include = [col for col in df.columns if col not in headers_to_exclude]
-
-    # Create subset dataframes
-    df_subset = df.loc[:, headers_to_include]
-    plt.figure(figsize=(30, 12))
-    # Perform subtraction
-    difference_series = df_subset.iloc[0] - df_subset.iloc[-1]
-    difference_series = difference_series.sort_values(ascending=False)
-    # Generate color array for plot
-    colors = ['red' if "(Control)" in index else 'blue' for index in difference_series.index]
-    difference_series.plot(kind='bar', color=colors)
-    plt.ylabel('15 minute % Consumed')
-    plt.title('% of Uric Acid Consumed \nfrom First to Last Plate Read')
-    plt.tight_layout()
-    plt.savefig(dest_dir / f"{date_time}_{expt_id}_PercentConsumed.png")
-    # plt.show()
-    plt.close()
-    # Perform subtraction
-    plt.figure(figsize=(30, 12))
-    difference_series = 100 - (df_subset.iloc[0] - df_subset.iloc[-1])
-    difference_series = difference_series.sort_values(ascending=True)
-    difference_series.plot(kind='bar', color=colors)
-    plt.ylabel('15 minute % Uric Acid Remaining')
-    plt.title('% of Uric Acid Remaining \nfrom First to Last Plate Read')
-    plt.tight_layout()
-    plt.savefig(dest_dir / f"{date_time}_{expt_id}_PercentRemaining.png")
-    # plt.show()
-    plt.close()
-    return
+    _, values, labels = split_columns(df)
+    return render_percentage_consumed(values, labels, date_time, expt_id, dest_dir)
 
 
 def final_overall_uric_acid(bg_removed_df, date_time, expt_id, dest_dir):
     """
+    Bar chart of the background subtracted absorbance at the last plate read
+    :param bg_removed_df: background subtracted dataframe with sample name columns
+    :param date_time: run start used in the file name
+    :param expt_id: experiment id used in the file name
+    :param dest_dir: output directory
+    :return: the written file path
+    """
+    _, values, labels = split_columns(bg_removed_df)
+    return render_uric_acid_remaining(values, labels, date_time, expt_id, dest_dir)
 
-    :param bg_removed_df:
-    :param date_time:
-    :param expt_id:
-    :param dest_dir:
-    :return:
+
+def write_summary(summary_path, bg_df, plate_run, sample_fits, well_fits, qc=None):
     """
-    headers_to_exclude = ['Relative Time', 'Temperature']
-    headers_to_include = [col for col in bg_removed_df.columns if col not in headers_to_exclude]
-
-    # Create subset dataframes
-    df_subset = bg_removed_df.loc[:, headers_to_include]
-    plt.figure(figsize=(30, 12))
-    # Perform subtraction
-    lastval_series = df_subset.iloc[-1].sort_values(ascending=True)
-    colors = ['red' if "(Control)" in index else 'blue' for index in lastval_series.index]
-    lastval_series.plot(kind='bar', color=colors)
-    plt.ylabel('Background Subtracted Abs at 15 Min')
-    plt.title('Uric Acid Remaining\nat Last Plate Read')
-    plt.tight_layout()
-    plt.savefig(dest_dir / f"{date_time}_{expt_id}_UricAcidRemaining.png")
-    # plt.show()
-    plt.close()
-    return
-
-
-# Select Files
-yaml_filepath = Path(select_file("YAML File Selection", "yaml"))
-bg_filepath = Path(select_file("Background Read File Selection", "asc"))
-kinetic_filepath = Path(select_file("Kinetic Read File Selection", "asc"))
-platemap_filepath = Path(select_file("Plate Map File Selection", "xlsx"))
-
-# Read in YAML file
-yaml_dict = read_yaml(yaml_filepath)
-expt_id = int(yaml_dict['Input Plates'][0][0:4])
-# Get Collaborations Path
-p_base = get_collaboration_path(expt_id)
-# Create folder in collabs path
-work_dir = p_base / f"UoxActivity_{yaml_dict['Input Plates'][0]}_{yaml_dict['Start']}"
-os.makedirs(work_dir, exist_ok=True)
-# Read ASCII files for background and kinetic reads
-bg_df = read_ascii(bg_filepath)
-kinetic_df = read_ascii(kinetic_filepath)
-# Remove the background absorbance values
-transformed_data = remove_background(bg_df, kinetic_df)
-# Map the sample names to the well names based on an xlsx doc
-sample_df = map_sample_names(transformed_data, platemap_filepath)
-# Standardize the absorbance values by the kinetic read t0
-standardized_data = standardize_data(sample_df)
-# Plot the standardized absorbance data using the sample names
-scatterplot_path = scatterplot_samplenames_relative_abs(standardized_data, yaml_dict['Start'],
-                                                        yaml_dict['Input Plates'][0][0:4], work_dir)
-# Create bar charts of % consumed and % remaining uric acid
-final_percentage_consumed(standardized_data, yaml_dict['Start'], yaml_dict['Input Plates'][0][0:4], work_dir)
-# Create bar chart
-sample_absolute_df = map_sample_names(transformed_data, platemap_filepath)
-final_overall_uric_acid(sample_absolute_df, yaml_dict['Start'], yaml_dict['Input Plates'][0][0:4], work_dir)
-# Export Dataframes into excel file in working directory
-with pd.ExcelWriter(
-        work_dir / f"UoxActivitySummary_{yaml_dict['Input Plates'][0]}_{yaml_dict['Start']}.xlsx") as writer:
-    bg_df.to_excel(writer, sheet_name='RawBackground')
-    kinetic_df.to_excel(writer, sheet_name='RawKinetic')
-    standardized_data.to_excel(writer, sheet_name='Standardized')
-# Create Section in LG
-expt = Experiment.from_id(expt_id)
-cur_section = expt.add_section(f"UoxActivity_{yaml_dict['Input Plates'][0]}_{yaml_dict['Start']}", -1)
-# Use Pre-made LG Protocol
-cur_protocol = Protocol.from_id(173)
-# Set conditional LG experiment details
-if yaml_dict['Metadata']['Lysis']:
-    if yaml_dict['Metadata']['Lysis Buffer'] == "BPer":
-        lysis_desc = f"Lysis was performed on the Tecan. The samples were resuspended in {yaml_dict['Metadata']['Lysis Volume']}μL of {yaml_dict['Metadata']['Lysis Buffer']} followed by a 30 minute shaking incubation at 25°C"
-    else:
-        lysis_desc = f"Lysis was performed on the Tecan. The samples were resuspended in {yaml_dict['Metadata']['Lysis Volume']}μL of {yaml_dict['Metadata']['Lysis Buffer']}  buffer by pipetting, then incubated at 25 C while shaking at 900 RPM for 30 minutes.\nAdditional sodium chloride and 10% triton x-100 were added to each sample. Samples were mixed by pipetting 1/2 volume 10 times, then shaking at 900 RPM for 1 minute. Samples were left to incubate at 4 C for 5 minutes to mimic the time in between triton addition and sonication as is done in large scale preps."
-else:
-    lysis_desc = "Lysis was not performed on the Tecan."
-
-if yaml_dict['Metadata']['Lysate Type'] == 'Clarified':
-    lysate_desc = "After lysis, the plate was spun at 3000rcf for 10 minutes to pellet the lysate. Clarified lysate was used as the sample for the duration of the assay."
-else:
-    lysate_desc = "Whole cell lysate was used for the duration of the assay."
-
-if yaml_dict['Metadata']['Assay Sample Dilution Factor'] == 1:
-    dilution_desc = "Samples were taken directly from the lysis plate and were not further diluted before addition to the assay plate."
-else:
-    dil_sample_vol = 100 / yaml_dict['Metadata']['Assay Sample Dilution Factor']
-    dil_buffer_vol = 100 - dil_sample_vol
-    dilution_desc = (
-        f"Samples were diluted by a factor of {yaml_dict['Metadata']['Assay Sample Dilution Factor']} with 100mM Sodium Phosphate buffer in a separate BioRad HardShell PCR Plate. "
-        f"{dil_sample_vol}μL of sample was added to {dil_buffer_vol}μL of 100mM Sodium Phosphate buffer in the dilution plate, and the plate was pipet mixed.")
-# Add Text and Steps Elements to LG experiment section
-cur_section.add_text_element(cur_protocol.sections[0].elements[0].format_data(
-    input_plate=yaml_dict['Input Plates'][0]
-))
-cur_section.add_steps_element(cur_protocol.sections[0].elements[1].format_data(
-    lysis_description=lysis_desc,
-    lysate_description=lysate_desc,
-    dilution_description=dilution_desc,
-    sodiumphos_vol=50 - yaml_dict['Metadata']['Assay Sample Volume'],
-    sample_vol=yaml_dict['Metadata']['Assay Sample Volume']
-))
-
-# List out the input / output filepaths to be attached to the LG Experiment
-output_file_paths = [
-    work_dir / f"UoxActivitySummary_{yaml_dict['Input Plates'][0]}_{yaml_dict['Start']}.xlsx",
-    yaml_filepath,
-    bg_filepath,
-    kinetic_filepath,
-    platemap_filepath,
-    scatterplot_path
-]
-# Get the instrument LG Token
-SESSION.login()
-cur_token = SESSION.token
-# Add attachment section
-attachments_element_resp = requests.post(f'https://my.labguru.com/api/v1/elements', json={
-    'token': cur_token,
-    'item': {
-        'container_id': cur_section.id,
-        'container_type': 'ExperimentProcedure',
-        'element_type': 'attachments',
-        'name': 'Attachments',
-        'data': '[]'
+    Export the raw reads, standardized reads, kinetic fits and QC checks into the summary workbook
+    :param summary_path: file path of the xlsx workbook
+    :param bg_df: pandas dataframe of the background read
+    :param plate_run: PlateRun of the run, the kinetic and standardized sheets are built from its views
+    :param sample_fits: pandas dataframe of the kinetic fits of the samples
+    :param well_fits: pandas dataframe of the kinetic fits of the wells
+    :param qc: optional pandas dataframe of the QC checks from PlateQC.uox_run_qc, flagged checks are listed first
+    :return: summary_path
+    """
+    with pd.ExcelWriter(summary_path) as writer:
+        bg_df.to_excel(writer, sheet_name='RawBackground')
+        plate_run.to_frame('raw').to_excel(writer, sheet_name='RawKinetic')
+        # The standardized samples keep the column order of map_sample_names
+        standardized_df = plate_run.to_frame('sample_standardized')
+        standardized_df[['Temperature', 'Relative Time', *plate_run.labels]].to_excel(writer, sheet_name='Standardized')
+        sample_fits.to_excel(writer, sheet_name='KineticFits')
+        well_fits.to_excel(writer, sheet_name='KineticFitsWells')
+        if qc is not None:
+            qc.sort_values('flagged', ascending=False, kind='stable').to_excel(writer, sheet_name='QC', index=False)
+    return summary_path
+
+
+def build_plate_run(bg_df, kinetic_df, samplemap_path):
+    """
+    Map the sample names onto the reads of a run and keep them in a PlateRun, which gives the background removed,
+    sample averaged and standardized reads as views. The raw reads are stored in float64 rather than the float32
+    default: they are written to the workbook and results dataset as parsed, and the fits match the dataframe stages.
+    :param bg_df: pandas dataframe of the background read
+    :param kinetic_df: pandas dataframe of the kinetic read
+    :param samplemap_path: file path of the xlsx plate map
+    :return: PlateRun
+    """
+    compiled = compile_platemap(load_platemap(samplemap_path), split_columns(kinetic_df)[2])
+    return PlateRun.from_frames(bg_df, kinetic_df, compiled, dtype=np.float64)
+
+
+def prepare_data(bg_filepath, kinetic_filepath, platemap_filepath, stage_cache=STAGE_CACHE_DIR):
+    """
+    Parse the reads, remove the background, map the sample names and standardize. Every stage output is cached on
+    disk keyed by the contents of its inputs and the source of its modules, so only the stages downstream of a changed
+    input or module run.
+    :param bg_filepath: file path of the background (substrate only) ascii read
+    :param kinetic_filepath: file path of the kinetic ascii read
+    :param platemap_filepath: file path of the xlsx plate map
+    :param stage_cache: directory of the stage cache, None to run every stage without caching
+    :return: a dictionary of the raw background dataframe and the PlateRun of the background removed, sample averaged
+    and standardized reads
+    """
+    cache = StageCache(stage_cache) if stage_cache else None
+    versions = {stage: code_version(modules) for stage, modules in STAGE_MODULES.items()}
+    # Read ASCII files for background and kinetic reads
+    bg_df, bg_key = run_stage(cache, 'read_ascii', versions['read_ascii'], [file_hash(bg_filepath)], read_ascii,
+                              bg_filepath)
+    kinetic_df, kinetic_key = run_stage(cache, 'read_ascii', versions['read_ascii'], [file_hash(kinetic_filepath)],
+                                        read_ascii, kinetic_filepath)
+    # Remove the background, map the sample names from the xlsx plate map and standardize by the kinetic read t0
+    plate_run, _ = run_stage(cache, 'plate_run', versions['plate_run'],
+                             [bg_key, kinetic_key, file_hash(platemap_filepath)], build_plate_run, bg_df, kinetic_df,
+                             platemap_filepath)
+    # The kinetic dataframe is not returned, the run holds its reads
+    return {
+        'background': bg_df,
+        'plate_run': plate_run
     }
-})
-# Add attachment
-for cur_path in output_file_paths:
-    url = 'https://my.labguru.com/api/v1/attachments'
-    headers = {
-        'accept': '*/*',
+
+
+def stream_data(bg_filepath, kinetic_filepath, platemap_filepath, plot_frames=PLOT_FRAMES):
+    """
+    Single pass alternative to prepare_data and the kinetic fits for very long kinetic reads, e.g. overnight stability
+    runs at second intervals. The kinetic read is parsed a chunk at a time and every block of frames is background
+    subtracted, sample averaged and added to the running fits as it is read, so memory stays bounded however many
+    cycles the read has. The fits cover every frame, the returned dataframes hold evenly spaced frames of the run.
+    :param bg_filepath: file path of the background (substrate only) ascii read
+    :param kinetic_filepath: file path of the kinetic ascii read
+    :param platemap_filepath: file path of the xlsx plate map
+    :param plot_frames: number of frames kept for the figures and the summary workbook
+    :return: a dictionary of the background dataframe and PlateRun of prepare_data with the kinetic frames
+    downsampled, and the kinetic fits of the wells and samples
+    """
+    bg_df = read_ascii(bg_filepath)
+    _, bg_values, bg_wells = split_columns(bg_df)
+    platemap = load_platemap(platemap_filepath)
+    # The trailer names the wells of the read, it is read from the end of the file before the frames
+    trailer = read_trailer(kinetic_filepath)
+    stream = None
+    for values, relative_time, temperature in iter_frames(kinetic_filepath):
+        if stream is None:
+            geometry, well_index = plate_wells(trailer, values.shape[1])
+            names = geometry.well_names()
+            well_names = [names[i] for i in well_index]
+            stream = KineticStream(bg_values[0, background_columns(well_names, bg_wells)], well_names,
+                                   compile_platemap(platemap, well_names), plot_frames)
+        stream.update(values, relative_time, temperature)
+    if stream is None:
+        raise ValueError(f"{kinetic_filepath} has no kinetic frames")
+
+    kinetic_df = frames_dataframe(*stream.buffer.frames(), stream.well_names)
+    return {
+        'background': bg_df,
+        'plate_run': build_plate_run(bg_df, kinetic_df, platemap_filepath),
+        'well_fits': stream.well_fits.result(),
+        'sample_fits': stream.sample_fits.result()
     }
-    filepath = cur_path
-    # make sure to open your file in binary mode
-    with filepath.open('rb') as file:
-        files = {
-            'token': (None, cur_token),
-            'item[attachment]': (filepath.name, file),
-            'item[attach_to_uuid]': (None, expt.uuid),
-            # 'item[title]': (None, ''),
-            'item[section_id]': (None, cur_section.id),
-            'item[element_id]': (None, attachments_element_resp.json()['id'])
+
+
+@traced('AnalysisTrace.json')
+def run_analysis(yaml_filepath, bg_filepath, kinetic_filepath, platemap_filepath, work_dir=None, plot_workers=1,
+                 results_store=STORE_DIR, ledger=LEDGER_PATH, force=False, stage_cache=STAGE_CACHE_DIR, streaming=False,
+                 plot_frames=PLOT_FRAMES):
+    """
+    Run the uricase activity analysis of one plate and write the plots and summary workbook into the working directory.
+    Stages whose inputs and code are unchanged since the run ledger last recorded them are skipped. The time, memory
+    and I/O of every stage are traced into AnalysisTrace.json in the run folder.
+    :param yaml_filepath: file path of the Tecan FluentControl yaml log file
+    :param bg_filepath: file path of the background (substrate only) ascii read
+    :param kinetic_filepath: file path of the kinetic ascii read
+    :param platemap_filepath: file path of the xlsx plate map
+    :param work_dir: parent directory for the run folder, defaults to the experiment collaboration path
+    :param plot_workers: number of worker processes used to render the figures
+    :param results_store: root directory of the columnar results dataset to append the run to, None to skip
+    :param ledger: file path of the run ledger, None to always run every stage without recording it
+    :param force: if True, run every stage even if the ledger has it up to date
+    :param stage_cache: directory of the stage cache of the data preparation, None to not cache it
+    :param streaming: if True, analyse the kinetic read in a single bounded memory pass with stream_data, the figures,
+    workbook and results dataset then hold plot_frames evenly spaced frames of the run
+    :param plot_frames: number of frames kept when streaming
+    :return: a dictionary of the yaml contents, the run folder, the paths of the written outputs and whether each stage
+    ran or was skipped
+    """
+    # Read in YAML file
+    with span('read_yaml'):
+        yaml_dict = read_yaml(yaml_filepath)
+    expt_id = int(yaml_dict['Input Plates'][0][0:4])
+    # Get Collaborations Path
+    with span('collaboration_path'):
+        if work_dir is None:
+            p_base = get_backend().collaboration_path(expt_id)
+        else:
+            p_base = Path(work_dir)
+        # Create folder in collabs path
+        work_dir = p_base / f"UoxActivity_{yaml_dict['Input Plates'][0]}_{yaml_dict['Start']}"
+        os.makedirs(work_dir, exist_ok=True)
+    trace_to(work_dir)
+    summary_path = work_dir / f"UoxActivitySummary_{yaml_dict['Input Plates'][0]}_{yaml_dict['Start']}.xlsx"
+
+    # Look up which stages are out of date
+    stage_modules = {'summary': SUMMARY_MODULES, 'figures': SUMMARY_MODULES}
+    if results_store:
+        stage_modules['results'] = SUMMARY_MODULES + ['ResultsStore', 'TimeAlignment']
+    run_key = f"uox:{yaml_dict['Input Plates'][0]}:{yaml_dict['Start']}"
+    run_ledger = RunLedger(ledger) if ledger else None
+    fingerprints = {}
+    done = {stage: None for stage in stage_modules}
+    if run_ledger:
+        inputs = [yaml_filepath, bg_filepath, kinetic_filepath, platemap_filepath]
+        params = {'work_dir': str(work_dir), 'results_store': str(results_store),
+                  'streaming': plot_frames if streaming else False}
+        with span('ledger_lookup'):
+            for stage, modules in stage_modules.items():
+                fingerprints[stage] = run_ledger.fingerprint(inputs, modules, params)
+                done[stage] = None if force else run_ledger.current(run_key, stage, fingerprints[stage])
+    stages = {stage: 'skipped' if outputs is not None else 'ran' for stage, outputs in done.items()}
+    if all(outputs is not None for outputs in done.values()):
+        # Nothing ran, keep the trace of the run that wrote the outputs
+        discard_trace()
+        return {
+            'yaml_dict': yaml_dict,
+            'work_dir': work_dir,
+            'summary_path': summary_path,
+            'scatterplot_path': Path(done['figures']['scatterplot_path']),
+            'stages': stages
         }
-        response = requests.post(url, headers=headers, files=files)
-
-jpg_name = str(scatterplot_path).split('\\')[-1].replace('.png', '.jpg')
-img_html_path = f'{response.json()["id"]}/annotated/{jpg_name}'
-std_curve_element_response = requests.post(f'https://my.labguru.com/api/v1/elements', json={
-    'token': cur_token,
-    'item': {
-        'container_id': cur_section.id,
-        'container_type': 'ExperimentProcedure',
-        'element_type': 'text',
-        'data': f'<img class="fancybox-image" src="/user_assets/415072/attachments/{img_html_path}" alt="">'
+
+    if streaming:
+        # Parse, background subtract, sample map, standardize and fit in one pass over the kinetic read
+        with span('stream_data', plot_frames=plot_frames):
+            data = stream_data(bg_filepath, kinetic_filepath, platemap_filepath, plot_frames)
+        well_fits, sample_fits = data['well_fits'], data['sample_fits']
+    else:
+        # Parse, background subtract, sample map and standardize, from the stage cache where the inputs are unchanged
+        data = prepare_data(bg_filepath, kinetic_filepath, platemap_filepath, stage_cache)
+        plate_run = data['plate_run']
+        with span('fit_kinetics'):
+            # Fit the kinetic rates of every well
+            well_fits = fit_reads(plate_run.relative_time, plate_run.background_subtracted, plate_run.well_names)
+            # Fit the kinetic rates of the replicate averaged samples
+            sample_fits = fit_reads(plate_run.relative_time, plate_run.sample_absolute, plate_run.labels)
+    # Every later stage reads the views of the one run rather than dataframes of its own
+    bg_df, plate_run = data['background'], data['plate_run']
+    with span('plate_qc'):
+        # Flag saturated, low and negative wells, bad replicates, temperature excursions and failed controls
+        qc = uox_run_qc(plate_run)
+
+    # Render the sample name scatter plot and the % consumed, % remaining and uric acid remaining bar charts
+    if done['figures'] is None:
+        date_time, expt_str = yaml_dict['Start'], yaml_dict['Input Plates'][0][0:4]
+        with span('render_figures', workers=plot_workers):
+            # The memory maps of the run may still be open when the folder is removed, which Windows refuses
+            with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+                figure_run = plate_run
+                if plot_workers and plot_workers > 1:
+                    # Worker processes map the saved run rather than each unpickling a copy of the reads
+                    figure_run = plate_run.save(Path(tmp) / 'run.platerun')
+                figure_paths = render_figures(plate_run_figure_tasks(figure_run, date_time, expt_str, work_dir),
+                                              workers=plot_workers)
+                # Release the memory maps before the folder is removed
+                del figure_run
+        scatterplot_path = figure_paths[0]
+        if run_ledger:
+            paths = [p for result in figure_paths for p in (result if isinstance(result, list) else [result])]
+            run_ledger.record(run_key, 'figures', fingerprints['figures'],
+                              {'scatterplot_path': str(scatterplot_path)}, paths)
+    else:
+        scatterplot_path = Path(done['figures']['scatterplot_path'])
+    # Export Dataframes into excel file in working directory
+    if done['summary'] is None:
+        with span('write_summary'):
+            write_summary(summary_path, bg_df, plate_run, sample_fits, well_fits, qc)
+        if run_ledger:
+            run_ledger.record(run_key, 'summary', fingerprints['summary'], paths=[summary_path])
+    # Append the tidy reads and fitted metrics to the results dataset
+    if results_store and done['results'] is None:
+        with span('append_results'):
+            # Wall clock times of the additions and reads, to align the run with others on time since substrate addition
+            timing = run_timing(yaml_dict, read_trailer(kinetic_filepath), read_trailer(bg_filepath))
+            append_uox_run(results_store, yaml_dict, bg_df, plate_run, sample_fits, well_fits, qc, timing)
+        if run_ledger:
+            run_ledger.record(run_key, 'results', fingerprints['results'])
+
+    return {
+        'yaml_dict': yaml_dict,
+        'work_dir': work_dir,
+        'summary_path': summary_path,
+        'scatterplot_path': scatterplot_path,
+        'stages': stages
     }
-})
+
+
+def create_labguru_section(yaml_dict):
+    """
+    Create the LabGuru experiment section of the run, with the protocol text and steps filled in from the yaml metadata
+    :param yaml_dict: dictionary of the Tecan FluentControl yaml log file contents
+    :return: tuple of the LabGuru experiment and the new section
+    """
+    backend = get_backend()
+
+    expt_id = int(yaml_dict['Input Plates'][0][0:4])
+    # Create Section in LG
+    with span('Experiment.from_id', 'labguru'):
+        expt = backend.experiment(expt_id)
+    with span('add_section', 'labguru'):
+        cur_section = expt.add_section(f"UoxActivity_{yaml_dict['Input Plates'][0]}_{yaml_dict['Start']}", -1)
+    # Use Pre-made LG Protocol
+    with span('Protocol.from_id', 'labguru'):
+        cur_protocol = backend.protocol(173)
+    # Set conditional LG experiment details
+    if yaml_dict['Metadata']['Lysis']:
+        if yaml_dict['Metadata']['Lysis Buffer'] == "BPer":
+            lysis_desc = f"Lysis was performed on the Tecan. The samples were resuspended in {yaml_dict['Metadata']['Lysis Volume']}μL of {yaml_dict['Metadata']['Lysis Buffer']} followed by a 30 minute shaking incubation at 25°C"
+        else:
+            lysis_desc = f"Lysis was performed on the Tecan. The samples were resuspended in {yaml_dict['Metadata']['Lysis Volume']}μL of {yaml_dict['Metadata']['Lysis Buffer']}  buffer by pipetting, then incubated at 25 C while shaking at 900 RPM for 30 minutes.\nAdditional sodium chloride and 10% triton x-100 were added to each sample. Samples were mixed by pipetting 1/2 volume 10 times, then shaking at 900 RPM for 1 minute. Samples were left to incubate at 4 C for 5 minutes to mimic the time in between triton addition and sonication as is done in large scale preps."
+    else:
+        lysis_desc = "Lysis was not performed on the Tecan."
+
+    if yaml_dict['Metadata']['Lysate Type'] == 'Clarified':
+        lysate_desc = "After lysis, the plate was spun at 3000rcf for 10 minutes to pellet the lysate. Clarified lysate was used as the sample for the duration of the assay."
+    else:
+        lysate_desc = "Whole cell lysate was used for the duration of the assay."
+
+    if yaml_dict['Metadata']['Assay Sample Dilution Factor'] == 1:
+        dilution_desc = "Samples were taken directly from the lysis plate and were not further diluted before addition to the assay plate."
+    else:
+        dil_sample_vol = 100 / yaml_dict['Metadata']['Assay Sample Dilution Factor']
+        dil_buffer_vol = 100 - dil_sample_vol
+        dilution_desc = (
+            f"Samples were diluted by a factor of {yaml_dict['Metadata']['Assay Sample Dilution Factor']} with 100mM Sodium Phosphate buffer in a separate BioRad HardShell PCR Plate. "
+            f"{dil_sample_vol}μL of sample was added to {dil_buffer_vol}μL of 100mM Sodium Phosphate buffer in the dilution plate, and the plate was pipet mixed.")
+    # Add Text and Steps Elements to LG experiment section
+    with span('add_text_element', 'labguru'):
+        cur_section.add_text_element(cur_protocol.sections[0].elements[0].format_data(
+            input_plate=yaml_dict['Input Plates'][0]
+        ))
+    with span('add_steps_element', 'labguru'):
+        cur_section.add_steps_element(cur_protocol.sections[0].elements[1].format_data(
+            lysis_description=lysis_desc,
+            lysate_description=lysate_desc,
+            dilution_description=dilution_desc,
+            sodiumphos_vol=50 - yaml_dict['Metadata']['Assay Sample Volume'],
+            sample_vol=yaml_dict['Metadata']['Assay Sample Volume']
+        ))
+    return expt, cur_section
+
+
+@traced('UploadTrace.json')
+def upload_to_labguru(yaml_dict, yaml_filepath, bg_filepath, kinetic_filepath, platemap_filepath, summary_path,
+                      scatterplot_path, base_url=None, max_workers=4, ledger=LEDGER_PATH, force=False):
+    """
+    Record the run in a section of the LabGuru experiment and attach the input and output files. The upload progress
+    is kept next to the summary workbook and in the run ledger, so calling this again after a failure or a re-analysis
+    updates the same section rather than creating a new one, and does nothing if no file changed. The latency of every
+    LabGuru request is traced into UploadTrace.json in the run folder.
+    :param yaml_dict: dictionary of the Tecan FluentControl yaml log file contents
+    :param yaml_filepath: file path of the Tecan FluentControl yaml log file
+    :param bg_filepath: file path of the background ascii read
+    :param kinetic_filepath: file path of the kinetic ascii read
+    :param platemap_filepath: file path of the xlsx plate map
+    :param summary_path: file path of the summary workbook
+    :param scatterplot_path: file path of the sample name scatter plot
+    :param base_url: LabGuru server, defaults to the server of the backend
+    :param max_workers: number of files uploaded at the same time
+    :param ledger: file path of the run ledger, None to not record the upload
+    :param force: if True, upload even if the ledger has the same files uploaded
+    :return: list of per file upload status dictionaries
+    """
+    trace_to(Path(summary_path).parent)
+    # List out the input / output filepaths to be attached to the LG Experiment
+    output_file_paths = [
+        summary_path,
+        yaml_filepath,
+        bg_filepath,
+        kinetic_filepath,
+        platemap_filepath,
+        scatterplot_path
+    ]
+    backend = get_backend()
+    base_url = base_url or backend.base_url
+    # Uploads to a stand-in are recorded apart from the real ones, a dry run records nothing
+    run_ledger = RunLedger(ledger) if ledger and backend.upload_stage else None
+    run_key = f"uox:{yaml_dict['Input Plates'][0]}:{yaml_dict['Start']}"
+    if run_ledger:
+        fingerprint = run_ledger.fingerprint(output_file_paths, ['LabGuruUploader'], {'base_url': base_url})
+        uploaded = None if force else run_ledger.current(run_key, backend.upload_stage, fingerprint)
+        if uploaded:
+            return [{'path': str(path), 'status': 'skipped', 'attachment_id': uploaded['files'].get(str(path)),
+                     'attempts': 0, 'error': None} for path in output_file_paths]
+
+    status_path = Path(summary_path).parent / backend.status_file if backend.status_file else None
+    uploader = LabGuruUploader(base_url=base_url, max_workers=max_workers, status_path=status_path,
+                               attachment_index=backend.attachment_index)
+    previous = run_ledger.lookup(run_key, backend.upload_stage) if run_ledger else None
+    if previous:
+        uploader.resume(previous['outputs'])
+    if not uploader.state.get('element_id'):
+        expt, cur_section = create_labguru_section(yaml_dict)
+        uploader.begin(cur_section.id, expt.uuid)
+
+    statuses = uploader.upload_files(output_file_paths)
+    report(statuses)
+    # Embed the scatter plot using its own attachment id
+    uploader.add_image(statuses[-1]['attachment_id'], scatterplot_path)
+    if run_ledger:
+        run_ledger.record(run_key, backend.upload_stage, fingerprint, {
+            **{key: value for key, value in uploader.state.items() if key != 'files'},
+            'files': {status['path']: status['attachment_id'] for status in statuses}
+        })
+    return statuses
+
+
+def main():
+    # Select Files
+    yaml_filepath = Path(select_file("YAML File Selection", "yaml"))
+    bg_filepath = Path(select_file("Background Read File Selection", "asc"))
+    kinetic_filepath = Path(select_file("Kinetic Read File Selection", "asc"))
+    platemap_filepath = Path(select_file("Plate Map File Selection", "xlsx"))
+
+    results = run_analysis(yaml_filepath, bg_filepath, kinetic_filepath, platemap_filepath)
+    upload_to_labguru(results['yaml_dict'], yaml_filepath, bg_filepath, kinetic_filepath, platemap_filepath,
+                      results['summary_path'], results['scatterplot_path'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+import argparse
+import os
+import re
+import time
+import traceback
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from Backends import add_backend_arguments, apply_backend_arguments
+from KineticStream import PLOT_FRAMES, KineticStream, background_columns
+from RunCatalog import load_yaml
+from TecanAscii import CHUNK_BYTES, AsciiTail, measurement_time, parse_ascii, plate_wells
+
+# "UoxKinetic_WCL-240905-006" -> ("WCL-240905", 6)
+RUN_NUMBER = re.compile(r'^Uox(?:BG|Kinetic)_(.*)-(\d+)$')
+
+
+def find_background(kinetic_path):
+    """
+    Find the background read taken just before a kinetic read, i.e. the UoxBG file of the same prefix with the highest
+    run number below the kinetic run number (UoxBG_WCL-240905-005 for UoxKinetic_WCL-240905-006)
+    :param kinetic_path: file path of the kinetic ascii read
+    :return: file path of the background ascii read, or None if there is none yet
+    """
+    match = RUN_NUMBER.match(kinetic_path.stem)
+    if not match:
+        return None
+    prefix, number = match.group(1), int(match.group(2))
+    candidates = []
+    for path in kinetic_path.parent.glob(f'UoxBG_{prefix}-*.asc'):
+        bg_match = RUN_NUMBER.match(path.stem)
+        if bg_match and int(bg_match.group(2)) < number:
+            candidates.append((int(bg_match.group(2)), path))
+    return max(candidates)[1] if candidates else None
+
+
+def find_yaml(yaml_dir, measured_at):
+    """
+    Find the FluentControl log of the run a plate read belongs to: the latest log started before the measurement.
+    Log files are named after their start time, e.g. 2024-09-05_12-34-53_Donphan.yaml
+    :param yaml_dir: directory of FluentControl yaml log files
+    :param measured_at: datetime of the plate read
+    :return: file path of the yaml log file, or None if there is none yet
+    """
+    best = None
+    for path in Path(yaml_dir).glob('*.yaml'):
+        try:
+            started = datetime.strptime(path.name[:19], '%Y-%m-%d_%H-%M-%S')
+        except ValueError:
+            continue
+        if started <= measured_at and (best is None or started > best[0]):
+            best = (started, path)
+    return best[1] if best else None
+
+
+def find_platemap(platemap_dir, input_plate):
+    """
+    Find the plate map of a source plate, i.e. an xlsx file whose name contains the plate barcode
+    :param platemap_dir: directory of plate map xlsx files
+    :param input_plate: source plate barcode, e.g. 2065-UOX-0001
+    :return: file path of the plate map, or None if there is none yet
+    """
+    matches = sorted(path for path in Path(platemap_dir).glob(f'*{input_plate}*.xlsx')
+                     if not path.name.startswith('~$'))
+    return matches[-1] if matches else None
+
+
+class LiveRun:
+    """
+    Live analysis of one kinetic read. New frames are fed to a KineticStream as they are appended, which background
+    subtracts them, standardizes them to the first kinetic frame, updates the running kinetic fits and keeps a bounded
+    buffer of frames, so a run can be watched for as long as it lasts.
+    """
+
+    def __init__(self, kinetic_path, bg_path, plot_frames=PLOT_FRAMES):
+        self.kinetic_path = Path(kinetic_path)
+        self.bg_path = Path(bg_path)
+        self.tail = AsciiTail(kinetic_path)
+        self.background = parse_ascii(bg_path)
+        self.plot_frames = plot_frames
+        # Created with the first kinetic frames, once the number of wells of the read is known
+        self.stream = None
+        self.finalised = False
+        self.flagged_dead = False
+
+    @property
+    def well_names(self):
+        return self.stream.well_names if self.stream else []
+
+    def _new_stream(self, n_wells):
+        """
+        :param n_wells: number of wells of the kinetic read
+        :return: KineticStream with the background of every kinetic read column matched by plate well index
+        """
+        # The wells of a read are only named in its trailer, until that is written they follow from the number of wells
+        geometry, well_index = plate_wells('\n'.join(self.tail.trailer), n_wells)
+        names = geometry.well_names()
+        well_names = [names[i] for i in well_index]
+        columns = background_columns(well_names, self.background.well_names)
+        return KineticStream(self.background.values[0, columns], well_names, plot_frames=self.plot_frames)
+
+    def update(self, chunk_bytes=CHUNK_BYTES):
+        """
+        Parse and analyse the frames appended since the last update, a chunk at a time
+        :param chunk_bytes: number of bytes of the file parsed per chunk
+        :return: number of new frames
+        """
+        size = self.kinetic_path.stat().st_size
+        n_frames = 0
+        while True:
+            offset = self.tail.offset
+            values, relative_time, temperature = self.tail.read_frames(chunk_bytes)
+            if self.stream is None and len(relative_time):
+                self.stream = self._new_stream(values.shape[1])
+            if self.stream is not None:
+                n_frames += self.stream.update(values, relative_time, temperature)
+            # Stop at the end of the file as it was, or at a trailing partial UTF-16 code unit
+            if self.tail.offset == offset or self.tail.offset >= size - 1:
+                return n_frames
+
+    def curves(self):
+        """
+        :return: tuple of the relative time vector and the standardized (frames x wells) array of the buffered frames
+        """
+        values, relative_time, _ = self.stream.buffer.frames()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return relative_time, (values - self.stream.background) / self.stream.t0 / 0.01
+
+    def summary(self):
+        """
+        :return: dataframe of the current % remaining and % consumed of every well
+        """
+        return self.stream.summary()
+
+    def is_dead(self, after_seconds, min_consumed):
+        """
+        Check whether no well has consumed a meaningful amount of uric acid after a given time
+        :param after_seconds: relative time (s) after which to judge the run
+        :param min_consumed: % of uric acid that at least one well should have consumed by then
+        :return: True if the run looks dead
+        """
+        if self.stream is None or self.stream.relative_time is None or self.stream.relative_time < after_seconds:
+            return False
+        first, last = self.stream.percent_remaining()
+        return not np.nanmax(first - last) >= min_consumed
+
+
+def finalise(run, yaml_dir, platemap_dir, output_dir=None, upload=False):
+    """
+    Run the full UoxActivityAnalysis pipeline on a finished kinetic read
+    :param run: LiveRun of the finished kinetic read
+    :param yaml_dir: directory of FluentControl yaml log files
+    :param platemap_dir: directory of plate map xlsx files
+    :param output_dir: parent directory for the run folder, defaults to the experiment collaboration path
+    :param upload: if True, also create the LabGuru section and attachments
+    :return: True once the analysis ran, False if the yaml log or plate map is not available yet
+    """
+    measured_at = measurement_time(run.tail.trailer)
+    yaml_path = find_yaml(yaml_dir, measured_at) if measured_at else None
+    if yaml_path is None:
+        return False
+    platemap_path = find_platemap(platemap_dir, load_yaml(yaml_path)['Input Plates'][0])
+    if platemap_path is None:
+        return False
+
+    import UoxActivityAnalysis as analysis
+    outputs = analysis.run_analysis(yaml_path, run.bg_path, run.kinetic_path, platemap_path, work_dir=output_dir)
+    if upload:
+        analysis.upload_to_labguru(outputs['yaml_dict'], yaml_path, run.bg_path, run.kinetic_path, platemap_path,
+                                   outputs['summary_path'], outputs['scatterplot_path'])
+    print(f"{run.kinetic_path.name}: finalised -> {outputs['work_dir']}")
+    return True
+
+
+def watch(asc_dir, yaml_dir, platemap_dir, live_dir, output_dir=None, interval=5.0, upload=False,
+          dead_after=300, dead_consumed=5.0, existing=False):
+    """
+    Poll the plate reader data folder, analyse kinetic reads while they are being written and run the full analysis
+    when the "Total kinetic run time" trailer appears
+    :param asc_dir: folder the plate reader writes UoxBG_*.asc and UoxKinetic_*.asc files into
+    :param yaml_dir: folder of FluentControl yaml log files
+    :param platemap_dir: folder of plate map xlsx files, named with the source plate barcode
+    :param live_dir: folder for the live UoxLive_*.csv summaries
+    :param output_dir: parent directory for the run folders, defaults to the experiment collaboration paths
+    :param interval: seconds between polls
+    :param upload: if True, also create the LabGuru sections and attachments
+    :param dead_after: relative time (s) after which a run with no consumption is reported as dead
+    :param dead_consumed: minimum % consumed by the best well for a run to count as alive
+    :param existing: if True, also pick up kinetic reads that were already in the folder at startup
+    :return:
+    """
+    asc_dir = Path(asc_dir)
+    live_dir = Path(live_dir)
+    os.makedirs(live_dir, exist_ok=True)
+    runs = {}
+    ignored = set() if existing else set(asc_dir.glob('UoxKinetic_*.asc'))
+
+    while True:
+        for kinetic_path in sorted(asc_dir.glob('UoxKinetic_*.asc')):
+            if kinetic_path in ignored:
+                continue
+            run = runs.get(kinetic_path)
+            if run is None:
+                bg_path = find_background(kinetic_path)
+                if bg_path is None:
+                    continue
+                run = runs[kinetic_path] = LiveRun(kinetic_path, bg_path)
+                print(f"{kinetic_path.name}: watching (background {bg_path.name})")
+            if run.finalised:
+                continue
+
+            try:
+                if kinetic_path.stat().st_size > run.tail.offset and run.update():
+                    summary = run.summary()
+                    summary.to_csv(live_dir / f"UoxLive_{kinetic_path.stem}.csv", index=False)
+                    consumed = summary['Percent Consumed']
+                    print(f"{kinetic_path.name}: {run.tail.n_frames} frames, "
+                          f"median {np.nanmedian(consumed):.1f}% consumed")
+                    if not run.flagged_dead and run.is_dead(dead_after, dead_consumed):
+                        run.flagged_dead = True
+                        print(f"{kinetic_path.name}: WARNING no well has consumed {dead_consumed}% of the uric acid "
+                              f"after {dead_after}s, the run may be dead")
+                if run.tail.finished:
+                    run.finalised = finalise(run, yaml_dir, platemap_dir, output_dir, upload)
+            except Exception:
+                print(f"{kinetic_path.name}: analysis failed\n{traceback.format_exc()}")
+                run.finalised = True
+        time.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Watch the plate reader folder and analyse Uox kinetic reads live")
+    parser.add_argument('asc_dir', help="folder the plate reader writes the ascii files into")
+    parser.add_argument('--yaml-dir', required=True, help="folder of FluentControl yaml log files")
+    parser.add_argument('--platemap-dir', required=True, help="folder of plate map xlsx files")
+    parser.add_argument('--live-dir', default=None, help="folder for live summaries, defaults to the ascii folder")
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help="write run folders here instead of the experiment collaboration paths")
+    parser.add_argument('--interval', type=float, default=5.0, help="seconds between polls")
+    parser.add_argument('--dead-after', type=float, default=300, help="seconds before judging a run as dead")
+    parser.add_argument('--dead-consumed', type=float, default=5.0,
+                        help="%% consumed the best well must reach for a run to count as alive")
+    parser.add_argument('--existing', action='store_true', help="also analyse kinetic reads present at startup")
+    parser.add_argument('--upload', action='store_true', help="create LabGuru sections and upload attachments")
+    add_backend_arguments(parser)
+    args = parser.parse_args(argv)
+    apply_backend_arguments(args)
+
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    watch(args.asc_dir, args.yaml_dir, args.platemap_dir, args.live_dir or args.asc_dir, output_dir=args.output_dir,
+          interval=args.interval, upload=args.upload, dead_after=args.dead_after, dead_consumed=args.dead_consumed,
+          existing=args.existing)
+
+
+if __name__ == '__main__':
+    main()